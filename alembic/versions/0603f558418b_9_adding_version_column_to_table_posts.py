@@ -0,0 +1,28 @@
+"""9. Adding version column to table: posts
+
+Revision ID: 0603f558418b
+Revises: 89630609ce70
+Create Date: 2026-10-19 11:20:54.870132
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0603f558418b'
+down_revision = '89630609ce70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A constant default, so existing rows get it without rewriting the table.
+    op.add_column("posts", sa.Column("version", sa.Integer(),
+                  nullable=False, server_default="1"))
+    pass
+
+
+def downgrade():
+    op.drop_column("posts", "version")
+    pass
@@ -0,0 +1,102 @@
+"""17. Partitioning table posts by month, creating table posts_archive
+
+Revision ID: 1f6c3e9a7b52
+Revises: 9d3f6a2b8e14
+Create Date: 2026-10-19 20:12:44.518306
+
+"""
+from datetime import timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1f6c3e9a7b52'
+down_revision = '9d3f6a2b8e14'
+branch_labels = None
+depends_on = None
+
+COLUMNS = "id, title, content, published, created_at, users_id, version, deleted_at"
+
+# The columns of "posts" and "posts_archive", along with the constraints named by the table.
+TABLE = """
+    CREATE TABLE {table} (
+        id bigint NOT NULL {id_default},
+        title varchar NOT NULL,
+        content varchar NOT NULL,
+        published boolean NOT NULL DEFAULT TRUE,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        users_id integer NOT NULL,
+        version integer NOT NULL DEFAULT 1,
+        deleted_at timestamptz,
+        CONSTRAINT {table}_pkey PRIMARY KEY (id, created_at),
+        CONSTRAINT {fk} FOREIGN KEY (users_id) REFERENCES users(id) ON DELETE CASCADE
+    ) PARTITION BY RANGE (created_at)"""
+
+# The tables referencing posts by a foreign key, which can't reference the id alone of a partitioned table.
+REFERENCING = ["votes", "post_vote_buckets", "attachments"]
+
+
+# Months counted from year 0, so the bounds of the partitions are computed in UTC whatever the time zone of the session.
+def month_index(moment):
+    moment = moment.astimezone(timezone.utc)
+    return moment.year * 12 + moment.month - 1
+
+
+def month_start(index):
+    return f"{index // 12:04d}-{index % 12 + 1:02d}-01 00:00:00+00"
+
+
+def create_indexes(table):
+    op.execute(f"CREATE INDEX ix_{table}_users_id_created_at_id ON {table} (users_id, created_at DESC, id DESC)")
+    op.execute(f"CREATE INDEX ix_{table}_deleted_at ON {table} (deleted_at) WHERE deleted_at IS NOT NULL")
+
+
+def upgrade():
+    for table in REFERENCING:
+        op.drop_constraint(f"{table}_post_id_fkey", table, type_="foreignkey")
+    op.execute("ALTER TABLE posts RENAME TO posts_unpartitioned")
+    op.execute("ALTER INDEX posts_pkey RENAME TO posts_unpartitioned_pkey")
+    op.execute("ALTER INDEX ix_posts_users_id_created_at_id RENAME TO ix_posts_unpartitioned_users_id_created_at_id")
+    op.execute("ALTER INDEX ix_posts_deleted_at RENAME TO ix_posts_unpartitioned_deleted_at")
+    # The sequence numbering the posts created before sharding, kept for the partitioned table.
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY NONE")
+
+    op.execute(TABLE.format(table="posts", id_default="DEFAULT nextval('posts_id_seq')", fk="post_users_fk"))
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+    create_indexes("posts")
+    op.execute("CREATE TABLE posts_default PARTITION OF posts DEFAULT")
+    # A partition for each month since the first post, and two months ahead. The months older than "posts_hot_months" are moved to the
+    # archive by the first run of the maintainer (see app/partitions.py), without copying the posts again.
+    first, current = op.get_bind().execute(sa.text("""
+        SELECT date_trunc('month', coalesce(min(created_at), now()), 'UTC'), date_trunc('month', now(), 'UTC') FROM posts_unpartitioned""")).one()
+    month, last = month_index(first), month_index(current) + 2
+    while month <= last:
+        op.execute(f"CREATE TABLE posts_{month // 12:04d}_{month % 12 + 1:02d} PARTITION OF posts "
+                   f"FOR VALUES FROM ('{month_start(month)}') TO ('{month_start(month + 1)}')")
+        month += 1
+    op.execute(f"INSERT INTO posts ({COLUMNS}) SELECT {COLUMNS} FROM posts_unpartitioned")
+    op.execute("DROP TABLE posts_unpartitioned")
+
+    op.execute(TABLE.format(table="posts_archive", id_default="", fk="posts_archive_users_id_fkey"))
+    create_indexes("posts_archive")
+    pass
+
+
+def downgrade():
+    op.execute("CREATE TABLE posts_unpartitioned (LIKE posts INCLUDING DEFAULTS)")
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY NONE")
+    op.execute(f"INSERT INTO posts_unpartitioned ({COLUMNS}) SELECT {COLUMNS} FROM posts UNION ALL SELECT {COLUMNS} FROM posts_archive")
+    op.execute("DROP TABLE posts_archive")
+    op.execute("DROP TABLE posts")
+    op.execute("ALTER TABLE posts_unpartitioned RENAME TO posts")
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+    op.create_primary_key("posts_pkey", "posts", ["id"])
+    op.create_foreign_key("post_users_fk", "posts", "users", ["users_id"], ["id"], ondelete="CASCADE")
+    create_indexes("posts")
+    for table in REFERENCING:
+        # Rows of posts removed while there was no foreign key would break it.
+        op.execute(f"DELETE FROM {table} WHERE post_id NOT IN (SELECT id FROM posts)")
+        op.create_foreign_key(f"{table}_post_id_fkey", table, "posts", ["post_id"], ["id"], ondelete="CASCADE")
+    pass
@@ -0,0 +1,57 @@
+"""11. Adding created_at column to table: votes, and creating tables: post_vote_buckets, rollup_backfill
+
+Revision ID: 3a9bc595de1c
+Revises: 6d8b3afdd454
+Create Date: 2026-10-19 13:37:52.204415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9bc595de1c'
+down_revision = '6d8b3afdd454'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The time the existing votes were given isn't known - they all get the time of this migration.
+    # "now()" isn't volatile, so it's evaluated once and the table isn't rewritten.
+    op.add_column("votes", sa.Column("created_at", sa.TIMESTAMP(timezone=True),
+                  server_default=sa.text("now()"), nullable=False))
+    op.create_table("post_vote_buckets",
+                    sa.Column("post_id", sa.Integer(), nullable=False),
+                    sa.Column("resolution", sa.String(), nullable=False),
+                    sa.Column("bucket_start", sa.TIMESTAMP(
+                        timezone=True), nullable=False),
+                    sa.Column("likes", sa.Integer(),
+                              server_default="0", nullable=False),
+                    sa.Column("unlikes", sa.Integer(),
+                              server_default="0", nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ["post_id"], ["posts.id"], ondelete="CASCADE"),
+                    sa.PrimaryKeyConstraint(
+                        "post_id", "resolution", "bucket_start")
+                    )
+    op.create_index("ix_post_vote_buckets_bucket_start",
+                    "post_vote_buckets", ["bucket_start"])
+    # The time the existing votes were stamped with, in the same transaction (so the same "now()"). The votes up to it are counted by
+    # the backfill (see app/rollups.py), the ones after it by the events.
+    op.create_table("rollup_backfill",
+                    sa.Column("votes_until", sa.TIMESTAMP(timezone=True), nullable=False),
+                    sa.Column("last_post_id", sa.BigInteger(), server_default="0", nullable=False),
+                    sa.PrimaryKeyConstraint("votes_until")
+                    )
+    op.execute("INSERT INTO rollup_backfill (votes_until) VALUES (now())")
+    pass
+
+
+def downgrade():
+    op.drop_table("rollup_backfill")
+    op.drop_index("ix_post_vote_buckets_bucket_start",
+                  table_name="post_vote_buckets")
+    op.drop_table("post_vote_buckets")
+    op.drop_column("votes", "created_at")
+    pass
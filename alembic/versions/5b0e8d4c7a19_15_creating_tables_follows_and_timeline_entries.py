@@ -0,0 +1,51 @@
+"""15. Creating tables: follows and timeline_entries, adding followers column to table users
+
+Revision ID: 5b0e8d4c7a19
+Revises: e7a2c5d91f38
+Create Date: 2026-10-19 18:03:25.671042
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0e8d4c7a19'
+down_revision = 'e7a2c5d91f38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("users", sa.Column("followers", sa.Integer(),
+                  nullable=False, server_default="0"))
+    op.create_table("follows",
+                    sa.Column("follower_id", sa.Integer(), nullable=False),
+                    sa.Column("followee_id", sa.Integer(), nullable=False),
+                    sa.Column("created_at", sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text("now()"), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ["follower_id"], ["users.id"], ondelete="CASCADE"),
+                    sa.ForeignKeyConstraint(
+                        ["followee_id"], ["users.id"], ondelete="CASCADE"),
+                    sa.PrimaryKeyConstraint("follower_id", "followee_id")
+                    )
+    op.create_index("ix_follows_followee_id", "follows", ["followee_id"])
+    op.create_table("timeline_entries",
+                    sa.Column("users_id", sa.Integer(), nullable=False),
+                    sa.Column("created_at", sa.TIMESTAMP(timezone=True), nullable=False),
+                    sa.Column("post_id", sa.BigInteger(), nullable=False),
+                    sa.Column("author_id", sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ["users_id"], ["users.id"], ondelete="CASCADE"),
+                    sa.PrimaryKeyConstraint("users_id", "created_at", "post_id")
+                    )
+    pass
+
+
+def downgrade():
+    op.drop_table("timeline_entries")
+    op.drop_index("ix_follows_followee_id", table_name="follows")
+    op.drop_table("follows")
+    op.drop_column("users", "followers")
+    pass
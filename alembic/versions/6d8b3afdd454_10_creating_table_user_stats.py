@@ -0,0 +1,47 @@
+"""10. Creating table: user_stats
+
+Revision ID: 6d8b3afdd454
+Revises: 0603f558418b
+Create Date: 2026-10-19 12:41:08.532917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d8b3afdd454'
+down_revision = '0603f558418b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("user_stats",
+                    sa.Column("users_id", sa.Integer(), nullable=False),
+                    sa.Column("posts", sa.Integer(),
+                              server_default="0", nullable=False),
+                    sa.Column("likes_received", sa.Integer(),
+                              server_default="0", nullable=False),
+                    sa.Column("likes_given", sa.Integer(),
+                              server_default="0", nullable=False),
+                    sa.Column("updated_at", sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text("now()"), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ["users_id"], ["users.id"], ondelete="CASCADE"),
+                    sa.PrimaryKeyConstraint("users_id")
+                    )
+    # Counting the statistics of the existing users. Kept up to date by the app from here on.
+    op.execute("""
+        INSERT INTO user_stats (users_id, posts, likes_received, likes_given)
+        SELECT users.id,
+               (SELECT count(*) FROM posts WHERE posts.users_id = users.id),
+               (SELECT count(*) FROM votes JOIN posts ON posts.id = votes.post_id WHERE posts.users_id = users.id),
+               (SELECT count(*) FROM votes WHERE votes.user_id = users.id)
+        FROM users""")
+    pass
+
+
+def downgrade():
+    op.drop_table("user_stats")
+    pass
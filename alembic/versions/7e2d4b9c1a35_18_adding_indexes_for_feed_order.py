@@ -0,0 +1,31 @@
+"""18. Adding indexes for the order of the feed
+
+Revision ID: 7e2d4b9c1a35
+Revises: 1f6c3e9a7b52
+Create Date: 2026-10-19 21:04:16.730942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e2d4b9c1a35'
+down_revision = '1f6c3e9a7b52'
+branch_labels = None
+depends_on = None
+
+TABLES = ["posts", "posts_archive"]
+
+
+def upgrade():
+    # Matches the ORDER BY of the feed, so a page is read from the index (of the partitions in order), rather than sorting all the posts.
+    for table in TABLES:
+        op.execute(f"CREATE INDEX ix_{table}_created_at_id ON {table} (created_at, id)")
+    pass
+
+
+def downgrade():
+    for table in TABLES:
+        op.execute(f"DROP INDEX ix_{table}_created_at_id")
+    pass
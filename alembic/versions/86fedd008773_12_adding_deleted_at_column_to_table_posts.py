@@ -0,0 +1,33 @@
+"""12. Adding deleted_at column to table: posts
+
+Revision ID: 86fedd008773
+Revises: 3a9bc595de1c
+Create Date: 2026-10-19 14:26:40.718356
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '86fedd008773'
+down_revision = '3a9bc595de1c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("posts", sa.Column(
+        "deleted_at", sa.TIMESTAMP(timezone=True), nullable=True))
+    # Partial index of the posts waiting to be purged.
+    op.create_index("ix_posts_deleted_at", "posts", ["deleted_at"],
+                    postgresql_where=sa.text("deleted_at IS NOT NULL"))
+    pass
+
+
+def downgrade():
+    # Posts still waiting to be purged would reappear otherwise.
+    op.execute("DELETE FROM posts WHERE deleted_at IS NOT NULL")
+    op.drop_index("ix_posts_deleted_at", table_name="posts")
+    op.drop_column("posts", "deleted_at")
+    pass
@@ -0,0 +1,43 @@
+"""8. Creating table: outbox
+
+Revision ID: 89630609ce70
+Revises: b876972b9ca3
+Create Date: 2026-10-19 10:02:17.113904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '89630609ce70'
+down_revision = 'b876972b9ca3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("outbox",
+                    sa.Column("id", sa.BigInteger(), nullable=False),
+                    sa.Column("topic", sa.String(), nullable=False),
+                    sa.Column("payload", postgresql.JSONB(), nullable=False),
+                    sa.Column("created_at", sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text("now()"), nullable=False),
+                    sa.Column("attempts", sa.Integer(),
+                              server_default="0", nullable=False),
+                    sa.Column("available_at", sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text("now()"), nullable=False),
+                    sa.Column("last_error", sa.String(), nullable=True),
+                    sa.PrimaryKeyConstraint("id")
+                    )
+    # The worker picks the events that are due, oldest first.
+    op.create_index("ix_outbox_available_at_id", "outbox",
+                    ["available_at", "id"])
+    pass
+
+
+def downgrade():
+    op.drop_index("ix_outbox_available_at_id", table_name="outbox")
+    op.drop_table("outbox")
+    pass
@@ -0,0 +1,38 @@
+"""16. Creating table: revoked_tokens, adding tokens_valid_after column to table users
+
+Revision ID: 9d3f6a2b8e14
+Revises: 5b0e8d4c7a19
+Create Date: 2026-10-19 18:41:07.392518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3f6a2b8e14'
+down_revision = '5b0e8d4c7a19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("users", sa.Column("tokens_valid_after", sa.TIMESTAMP(timezone=True), nullable=True))
+    op.create_table("revoked_tokens",
+                    sa.Column("jti", sa.String(length=32), nullable=False),
+                    sa.Column("expires_at", sa.TIMESTAMP(timezone=True), nullable=False),
+                    sa.Column("revoked_at", sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text("now()"), nullable=False),
+                    sa.PrimaryKeyConstraint("jti")
+                    )
+    op.create_index("ix_revoked_tokens_revoked_at", "revoked_tokens", ["revoked_at"])
+    op.create_index("ix_revoked_tokens_expires_at", "revoked_tokens", ["expires_at"])
+    pass
+
+
+def downgrade():
+    op.drop_index("ix_revoked_tokens_expires_at", table_name="revoked_tokens")
+    op.drop_index("ix_revoked_tokens_revoked_at", table_name="revoked_tokens")
+    op.drop_table("revoked_tokens")
+    op.drop_column("users", "tokens_valid_after")
+    pass
@@ -0,0 +1,31 @@
+"""7. Adding indexes for per-author post listing
+
+Revision ID: b876972b9ca3
+Revises: b4df3b1ff69d
+Create Date: 2026-10-19 09:12:41.538214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b876972b9ca3'
+down_revision = 'b4df3b1ff69d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Matches the ORDER BY of the per-author listing, so the keyset cursor is resolved by the index alone.
+    op.create_index("ix_posts_users_id_created_at_id", "posts", [
+                    "users_id", sa.text("created_at DESC"), sa.text("id DESC")])
+    # Counting votes per post. The PK of votes leads with "user_id" and can't be used for this.
+    op.create_index("ix_votes_post_id", "votes", ["post_id"])
+    pass
+
+
+def downgrade():
+    op.drop_index("ix_votes_post_id", table_name="votes")
+    op.drop_index("ix_posts_users_id_created_at_id", table_name="posts")
+    pass
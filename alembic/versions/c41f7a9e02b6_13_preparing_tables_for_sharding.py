@@ -0,0 +1,39 @@
+"""13. Preparing tables for sharding: bigint post ids, shard and post counter of users
+
+Revision ID: c41f7a9e02b6
+Revises: 86fedd008773
+Create Date: 2026-10-19 16:02:11.284913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f7a9e02b6'
+down_revision = '86fedd008773'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Ids of new posts are above 2^52 (see app/sharding.py). Rewrites the tables.
+    op.alter_column("posts", "id", type_=sa.BigInteger())
+    op.alter_column("votes", "post_id", type_=sa.BigInteger())
+    op.alter_column("post_vote_buckets", "post_id", type_=sa.BigInteger())
+    # Existing users stay on the main database, which holds all their posts so far.
+    op.add_column("users", sa.Column("shard", sa.Integer(),
+                  nullable=False, server_default="0"))
+    op.add_column("users", sa.Column("last_post_seq", sa.Integer(),
+                  nullable=False, server_default="0"))
+    pass
+
+
+def downgrade():
+    op.drop_column("users", "last_post_seq")
+    op.drop_column("users", "shard")
+    # Fails if there are posts with the new ids - they don't fit into "integer".
+    op.alter_column("post_vote_buckets", "post_id", type_=sa.Integer())
+    op.alter_column("votes", "post_id", type_=sa.Integer())
+    op.alter_column("posts", "id", type_=sa.Integer())
+    pass
@@ -0,0 +1,39 @@
+"""14. Creating table: attachments
+
+Revision ID: e7a2c5d91f38
+Revises: c41f7a9e02b6
+Create Date: 2026-10-19 17:12:48.530217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2c5d91f38'
+down_revision = 'c41f7a9e02b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table("attachments",
+                    sa.Column("post_id", sa.BigInteger(), nullable=False),
+                    sa.Column("sha256", sa.String(length=64), nullable=False),
+                    sa.Column("content_type", sa.String(), nullable=False),
+                    sa.Column("size", sa.BigInteger(), nullable=False),
+                    sa.Column("filename", sa.String(), nullable=True),
+                    sa.Column("thumbnail_sha256", sa.String(length=64), nullable=True),
+                    sa.Column("created_at", sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text("now()"), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ["post_id"], ["posts.id"], ondelete="CASCADE"),
+                    sa.PrimaryKeyConstraint("post_id", "sha256")
+                    )
+    pass
+
+
+def downgrade():
+    # Only the metadata - the files stay in the storage directory, and must be removed by hand.
+    op.drop_table("attachments")
+    pass
@@ -0,0 +1,188 @@
+# Module for admission control - shedding load with "503 Service Unavailable" when the DB connection pool is saturated.
+# Without it, requests pile up in the threadpool waiting for a connection, and latency grows until clients time out anyway.
+
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+from starlette.responses import JSONResponse
+
+from .config import settings
+
+
+# The route class of the request currently being handled. Set by the middleware, and read by the pool and by the DB session.
+# Context variables are copied into the threadpool running the (sync) path operations, so this is visible from there as well.
+current_route_class: ContextVar = ContextVar("current_route_class", default=None)
+
+
+def classify(method: str, path: str):
+    """
+    Returns the route class of a request. Login runs bcrypt and is the most expensive route, so it gets a class of its own.
+    Live update streams stay open for as long as the client is connected, without using the DB pool, so they aren't limited.
+    Neither are the probes - a shed "/readyz" would take the instance out of the load balancer, and "/healthz" would get it restarted.
+    Nor the admin endpoints, for profiling a worker while it's overloaded.
+    """
+    if path.startswith("/live/"):
+        return "stream"
+    if path in ("/healthz", "/readyz"):
+        return "probe"
+    if path.startswith("/admin/"):
+        return "admin"
+    if path.rstrip("/") == "/login":
+        return "auth"
+    if method in ("GET", "HEAD", "OPTIONS"):
+        return "read"
+    return "write"
+
+
+class PoolStats:
+    """
+    Pool wait time and queue depth (requests waiting on a DB connection), tracked for each route class.
+    The wait time is an exponentially weighted moving average, which decays over time when no new connections are checked out.
+    Otherwise a single slow period would keep requests shed forever, since shed requests never check out a connection to lower it again.
+    """
+    half_life_seconds = 1.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waiters = {}
+        self._wait_ms = {}
+        self._updated_at = {}
+
+    def begin_wait(self, route_class):
+        with self._lock:
+            self.waiters[route_class] = self.waiters.get(route_class, 0) + 1
+
+    def end_wait(self, route_class, wait_ms: float):
+        with self._lock:
+            self.waiters[route_class] -= 1
+            # Weighing the newest sample at 20%.
+            self._wait_ms[route_class] = 0.8 * \
+                self._decayed(route_class) + 0.2 * wait_ms
+            self._updated_at[route_class] = time.monotonic()
+
+    def _decayed(self, route_class):
+        if route_class not in self._wait_ms:
+            return 0.0
+        elapsed = time.monotonic() - self._updated_at[route_class]
+        return self._wait_ms[route_class] * 0.5 ** (elapsed / self.half_life_seconds)
+
+    def wait_ms(self, route_class=None):
+        """The average pool wait of a route class, or the worst one of all route classes if none is given."""
+        with self._lock:
+            if route_class is not None:
+                return self._decayed(route_class)
+            return max((self._decayed(name) for name in self._wait_ms), default=0.0)
+
+    def total_waiters(self):
+        with self._lock:
+            return sum(self.waiters.values())
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """The default pool of SQLAlchemy, measuring how long each checkout waits for a free connection."""
+
+    def _do_get(self):
+        route_class = current_route_class.get()
+        pool_stats.begin_wait(route_class)
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.end_wait(
+                route_class, (time.perf_counter() - start) * 1000)
+
+
+class AdmissionController:
+    """
+    Decides whether a request is admitted or shed. Reads keep priority over writes and login - the limits on the pool
+    (queue depth and wait time) are halved for those, so they are shed first, while reads are still being served.
+    """
+
+    def __init__(self):
+        self.max_in_flight = {
+            "read": settings.admission_max_in_flight_read,
+            "write": settings.admission_max_in_flight_write,
+            "auth": settings.admission_max_in_flight_auth,
+        }
+        self.max_pool_waiters = settings.admission_max_pool_waiters
+        self.max_pool_wait_ms = settings.admission_max_pool_wait_ms
+        self.retry_after_seconds = settings.admission_retry_after_seconds
+        self.in_flight = {route_class: 0 for route_class in self.max_in_flight}
+
+    def rejection_reason(self, route_class):
+        """Returns why a request of this route class must be shed, or None if it may be admitted."""
+        if route_class not in self.max_in_flight:
+            return None  # Not subject to admission control.
+
+        if self.in_flight[route_class] >= self.max_in_flight[route_class]:
+            return f"Too many concurrent {route_class} requests"
+
+        # Low priority route classes are shed at half the pool pressure.
+        share = 1.0 if route_class == "read" else 0.5
+        if pool_stats.total_waiters() >= self.max_pool_waiters * share:
+            return "Too many requests waiting for a database connection"
+        if pool_stats.wait_ms() >= self.max_pool_wait_ms * share:
+            return "Database connections are too slow to acquire"
+        return None
+
+
+controller = AdmissionController()
+
+
+class AdmissionMiddleware:
+    """
+    Middleware failing fast with "503 Service Unavailable" and a "Retry-After" header, once the limits of the controller are hit.
+    Written as a plain ASGI middleware, so the requests being shed cost as little as possible.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route_class = classify(scope["method"], scope["path"])
+        reason = controller.rejection_reason(route_class)
+        if reason:
+            response = JSONResponse({"detail": reason}, status_code=503, headers={
+                                    "Retry-After": str(controller.retry_after_seconds)})
+            await response(scope, receive, send)
+            return
+
+        tracked = route_class in controller.in_flight
+        if tracked:
+            controller.in_flight[route_class] += 1
+        token = current_route_class.set(route_class)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_route_class.reset(token)
+            if tracked:
+                controller.in_flight[route_class] -= 1
+
+
+# Postgres "statement_timeout" budget of each route class, in milliseconds.
+statement_timeouts = {
+    "read": settings.statement_timeout_read_ms,
+    "write": settings.statement_timeout_write_ms,
+    "auth": settings.statement_timeout_auth_ms,
+}
+
+
+def apply_statement_timeout(session, transaction, connection):
+    """
+    Session event listener ("after_begin"), setting the statement timeout of the current route class on every transaction of the request.
+    "set_config(..., true)" only lasts until the end of the transaction, so the connection is returned to the pool without the timeout.
+    """
+    timeout = statement_timeouts.get(current_route_class.get())
+    if timeout:
+        connection.execute(text("SELECT set_config('statement_timeout', :timeout, true)"), {
+                           "timeout": f"{timeout}ms"})
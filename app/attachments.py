@@ -0,0 +1,300 @@
+# Module for the files attached to posts (i.e. images). The files are kept out of Postgres - as blobs there, they'd be read through the
+# buffer cache and push the hot rows out of it - in a directory on local disk ("attachments_dir"), and only their metadata is in the DB
+# ("attachments" table, on the shard of the post).
+#
+# Storage is content-addressed: a file is named by the SHA-256 of its content, "<dir>/ab/cd/abcd...". The same file uploaded twice is stored once,
+# a stored file never changes (so it's cached by clients for good), and a file is written completely before it gets its name, so a file
+# found under its name is always complete. Several app servers must share the directory (i.e. a network volume).
+#
+# Uploads are streamed to disk in chunks, hashed on the way, and stopped as soon as they're over "attachment_max_bytes" - never held in memory whole.
+# Downloads are sent straight from the file: with the "http.response.zerocopy" ASGI extension when the server supports it (sendfile, the
+# file is never copied into the process), or read in chunks otherwise. Ranges ("Range: bytes=...") are supported, for resuming and seeking.
+#
+# Thumbnails of images are made in the background by a pool of worker threads, once the upload is committed, and are stored the same way.
+# Made with Pillow (in requirements.txt) - where it isn't installed, no thumbnails are made.
+#
+# Files no longer attached to any post (i.e. of purged posts) are removed by: "python -m app.attachments gc"
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from io import BytesIO
+from typing import Optional, Tuple
+
+import anyio
+from fastapi import Response, status
+from sqlalchemy import update
+
+from . import models, sharding
+from .config import settings
+
+try:
+    from PIL import Image
+except ImportError:  # Optional - thumbnails are only made with Pillow installed.
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Stored files never change, so clients and proxies may keep them for as long as they like. "private", as reading posts needs logging in.
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+class TooLarge(Exception):
+    """Raised when an upload is larger than "attachment_max_bytes"."""
+
+
+def path(sha256: str) -> str:
+    return os.path.join(settings.attachments_dir, sha256[:2], sha256[2:4], sha256)
+
+
+def exists(sha256: str) -> bool:
+    return os.path.isfile(path(sha256))
+
+
+def _touch(final: str) -> bool:
+    """Marks a stored file as just written, so "gc" keeps it for the grace period again (i.e. a file orphaned before, uploaded again
+    before its metadata is committed). False if there's no such file (anymore)."""
+    try:
+        os.utime(final)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _name(temporary: str, sha256: str):
+    # Renaming is atomic. The same content uploaded at the same time is renamed onto the same name twice, which is harmless.
+    final = path(sha256)
+    os.makedirs(os.path.dirname(final), exist_ok=True)
+    if _touch(final):
+        os.remove(temporary)
+    else:
+        os.replace(temporary, final)
+
+
+def _temporary_file():
+    directory = os.path.join(settings.attachments_dir, "tmp")
+    os.makedirs(directory, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=directory, delete=False)
+
+
+async def store_stream(chunks) -> Tuple[str, int]:
+    """
+    Writes the chunks (bytes, from an async iterator, i.e. the body of a request) to the storage. Returns the SHA-256 and the size of the file.
+    Raises "TooLarge" once it's over the limit, and ValueError if it's empty - nothing is stored then.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    file = _temporary_file()
+    try:
+        with file:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > settings.attachment_max_bytes:
+                    raise TooLarge()
+                digest.update(chunk)
+                # Small writes to the page cache - not worth a thread each.
+                file.write(chunk)
+        if size == 0:
+            raise ValueError("The file is empty")
+        sha256 = digest.hexdigest()
+        _name(file.name, sha256)
+        return sha256, size
+    except BaseException:
+        os.remove(file.name)
+        raise
+
+
+def store_bytes(content: bytes) -> str:
+    """Stores a file held in memory (i.e. a thumbnail). Returns its SHA-256."""
+    sha256 = hashlib.sha256(content).hexdigest()
+    if not _touch(path(sha256)):
+        file = _temporary_file()
+        with file:
+            file.write(content)
+        _name(file.name, sha256)
+    return sha256
+
+
+def parse_range(header: Optional[str], size: int):
+    """
+    The (start, end) of the bytes asked for by a "Range" header, with "end" inclusive. None for the whole file - without a header, or with
+    one that isn't a single range of bytes (which may be ignored). Raises ValueError if the range is outside of the file.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:
+            # The last "end" bytes.
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError(f"Range not satisfiable for {size} bytes")
+    return start, end
+
+
+class FileRangeResponse(Response):
+    """
+    A response sending a part of a file (from "start" to "end", inclusive) from disk. Uses the "http.response.zerocopy" ASGI extension when
+    the server supports it, so the server sends the file with sendfile. Otherwise the file is read in chunks, in a thread.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, file_path: str, start: int, end: int, status_code: int, headers: dict, send_body: bool = True):
+        self.file_path = file_path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.send_body = send_body
+        self.background = None
+        self.init_headers({**headers, "content-length": str(end - start + 1)})
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or self.end < self.start:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        count = self.end - self.start + 1
+        if "http.response.zerocopy" in scope.get("extensions", {}):
+            file = await anyio.to_thread.run_sync(open, self.file_path, "rb")
+            try:
+                await send({"type": "http.response.zerocopy", "file": file, "offset": self.start, "count": count, "more_body": False})
+            finally:
+                file.close()
+            return
+
+        async with await anyio.open_file(self.file_path, "rb") as file:
+            await file.seek(self.start)
+            while count > 0:
+                chunk = await file.read(min(self.chunk_size, count))
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0 and bool(chunk)})
+                if not chunk:
+                    break
+
+
+def file_response(sha256: str, content_type: str, range_header: Optional[str], if_none_match: Optional[str], method: str = "GET"):
+    """The response for downloading a stored file, with the part asked for by "Range", and the headers for caching it."""
+    file_path = path(sha256)
+    stat = os.stat(file_path)
+    # The content never changes, so its hash is its ETag.
+    headers = {"etag": f'"{sha256}"', "cache-control": CACHE_CONTROL, "accept-ranges": "bytes",
+               "last-modified": formatdate(stat.st_mtime, usegmt=True), "content-type": content_type,
+               # Served as what it was uploaded as - never sniffed by browsers as something else (i.e. HTML).
+               "x-content-type-options": "nosniff"}
+    if if_none_match and f'"{sha256}"' in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={
+            name: value for name, value in headers.items() if name in ("etag", "cache-control", "last-modified")})
+
+    try:
+        requested = parse_range(range_header, stat.st_size)
+    except ValueError:
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={"content-range": f"bytes */{stat.st_size}"})
+    send_body = method != "HEAD"
+    if requested is None:
+        return FileRangeResponse(file_path, 0, stat.st_size - 1, status.HTTP_200_OK, headers, send_body)
+    start, end = requested
+    headers["content-range"] = f"bytes {start}-{end}/{stat.st_size}"
+    return FileRangeResponse(file_path, start, end, status.HTTP_206_PARTIAL_CONTENT, headers, send_body)
+
+
+def make_thumbnail(file_path: str) -> Optional[bytes]:
+    """A thumbnail of an image, no larger than "thumbnail_size" on either side, as JPEG. None without Pillow."""
+    if Image is None:
+        return None
+    with Image.open(file_path) as image:
+        image.thumbnail((settings.thumbnail_size, settings.thumbnail_size))
+        output = BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=85)
+        return output.getvalue()
+
+
+def thumbnail(post_id: int, sha256: str):
+    """Makes the thumbnail of an attachment, and records it on the shard of the post. Run by the thumbnail workers."""
+    content = make_thumbnail(path(sha256))
+    if content is None:
+        return None
+    thumbnail_sha256 = store_bytes(content)
+
+    main = sharding.router.session(0)
+    shards = sharding.ShardSessions(main, sharding.router)
+    try:
+        db = shards.for_post(post_id)
+        if db is None:
+            return None
+        db.execute(update(models.Attachment).where(models.Attachment.post_id == post_id, models.Attachment.sha256 == sha256).values(
+            thumbnail_sha256=thumbnail_sha256), execution_options={"synchronize_session": False})
+        # The metadata of the post changed, so its ETag does as well.
+        db.execute(update(models.Post).where(models.Post.id == post_id).values(version=models.Post.version + 1),
+                   execution_options={"synchronize_session": False})
+        db.commit()
+        return thumbnail_sha256
+    finally:
+        shards.close()
+        main.close()
+
+
+def _thumbnail_logged(post_id: int, sha256: str):
+    try:
+        return thumbnail(post_id, sha256)
+    except Exception:
+        logger.exception("Making the thumbnail of %s (post %s) failed", sha256, post_id)
+
+
+# The thumbnail workers. Making thumbnails is CPU-bound, but Pillow releases the GIL while decoding and resizing.
+_workers = None
+
+
+def submit_thumbnail(post_id: int, sha256: str, content_type: str):
+    """Queues the thumbnail of an attachment to be made, if it's an image. Returns the future of it, or None."""
+    global _workers
+    if Image is None or not content_type.startswith("image/"):
+        return None
+    if _workers is None:
+        _workers = ThreadPoolExecutor(max_workers=settings.thumbnail_workers, thread_name_prefix="thumbnails")
+    return _workers.submit(_thumbnail_logged, post_id, sha256)
+
+
+def referenced(db):
+    """The SHA-256 of the files and thumbnails attached to the posts of a shard."""
+    names = set()
+    for sha256, thumbnail_sha256 in db.query(models.Attachment.sha256, models.Attachment.thumbnail_sha256):
+        names.add(sha256)
+        if thumbnail_sha256:
+            names.add(thumbnail_sha256)
+    return names
+
+
+def gc(grace_seconds: int = 3600):
+    """
+    Removes the stored files not attached to any post on any shard. Files (and unfinished uploads) younger than the grace period are kept,
+    as they may be uploads whose metadata isn't committed yet. Returns the number of files removed.
+    """
+    keep = set().union(*sharding.router.for_each_shard(referenced))
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    for directory, _, files in os.walk(settings.attachments_dir):
+        for name in files:
+            file_path = os.path.join(directory, name)
+            if name not in keep and os.path.getmtime(file_path) < cutoff:
+                os.remove(file_path)
+                removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if sys.argv[1:] != ["gc"]:
+        sys.exit("Usage: python -m app.attachments gc")
+    logger.info("Removed %s files no longer attached to any post", gc())
@@ -4,20 +4,60 @@ from psycopg2.extras import RealDictCursor
 import time  # For putting a delay on re-attempting connectivity to DB.
 
 
+import threading
+
 # Imports needed when running the script with SQLAlchemy.
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from .config import settings
+from .admission import TimedQueuePool, apply_statement_timeout
+from . import prepared
 
 # First, type of database. Second, username (default is "postgres"). Third, password. Fourth, IP address. Fifth, port number. Sixth, database name.
 SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+_engine = None
+_engine_lock = threading.Lock()
+
+
+# The engine is created on first use (by the startup of the app, see app/warmup.py), rather than when this module is imported.
+# So importing the app (i.e. for tests, or the commands in app/) doesn't set up a pool for a DB it may never use.
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                # The pool measures how long requests wait for a connection, which is used for shedding load in the admission control.
+                engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=TimedQueuePool,
+                                       pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow)
+                # Running the hot queries of app/queries.py as prepared statements.
+                prepared.install(engine)
+                SessionLocal.configure(bind=engine)
+                _engine = engine
+    return _engine
+
+
+# "from .database import engine" still works - the engine is created then.
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazySessionmaker(sessionmaker):
+    """A sessionmaker creating the engine (and binding to it) when the first session is made."""
+
+    def __call__(self, **kwargs):
+        get_engine()
+        return super().__call__(**kwargs)
+
 
 # When wanting to interact with the SQL database, a sessionmaker must be created. Arguments are default arguments.
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = LazySessionmaker(autocommit=False, autoflush=False)
+# Applying the "statement_timeout" budget of the current route class to every transaction.
+event.listen(SessionLocal, "after_begin", apply_statement_timeout)
 
 # The base class for all the models defined to create tabels in Postgres and will be extending from this "Base" class.
 Base = declarative_base()
@@ -0,0 +1,116 @@
+# Module for content negotiation between JSON and MessagePack. MessagePack is a binary format, which is smaller and much cheaper
+# to encode and decode than JSON - used by internal services calling this API at high rates.
+#
+# Responses: "Accept: application/msgpack" returns the response model encoded as MessagePack, instead of JSON.
+# Requests: bodies (i.e. "PostCreate" and "Vote") may be sent as MessagePack with "Content-Type: application/msgpack".
+
+import json
+from contextvars import ContextVar
+from typing import Optional
+
+import msgpack
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+# The media types MessagePack is known by. There's no registered one, so the common variants are all accepted.
+MSGPACK_MEDIA_TYPES = {MSGPACK_MEDIA_TYPE,
+                       "application/x-msgpack", "application/vnd.msgpack"}
+
+# The format the response of the current request is encoded in. Set by the route class below, for each request.
+response_format: ContextVar = ContextVar("response_format", default="json")
+
+
+def accepts_msgpack(accept: Optional[str]):
+    """Whether MessagePack is preferred by an "Accept" header - if it's listed, with a quality at least as high as JSON's."""
+    if not accept or "msgpack" not in accept:
+        return False
+
+    quality = {}
+    for media_range in accept.split(","):
+        media_type, *parameters = [part.strip()
+                                   for part in media_range.split(";")]
+        q = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    q = float(parameter[2:])
+                except ValueError:
+                    q = 0.0
+        quality[media_type.lower()] = max(q, quality.get(media_type.lower(), 0.0))
+
+    msgpack_q = max(quality.get(media_type, 0.0)
+                    for media_type in MSGPACK_MEDIA_TYPES)
+    json_q = max(quality.get(media_type, 0.0)
+                 for media_type in ("application/json", "application/*", "*/*"))
+    return msgpack_q > 0 and msgpack_q >= json_q
+
+
+def is_msgpack(content_type: Optional[str]):
+    return content_type is not None and content_type.split(";")[0].strip().lower() in MSGPACK_MEDIA_TYPES
+
+
+def render_json(content):
+    # The same settings as "JSONResponse" of Starlette.
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def render_msgpack(content):
+    return msgpack.packb(content)
+
+
+class NegotiatedResponse(JSONResponse):
+    """
+    The default response class of the app. Renders the content (the response model, already converted to JSON compatible data by FastAPI)
+    as JSON, or as MessagePack if the client prefers it. The content is encoded once, in the requested format only.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The body depends on the "Accept" header, which caches must take into account.
+        self.headers.add_vary_header("Accept")
+
+    def render(self, content):
+        if response_format.get() == "msgpack":
+            self.media_type = MSGPACK_MEDIA_TYPE
+            return render_msgpack(content)
+        return render_json(content)
+
+
+class MsgPackRequest(Request):
+    """
+    A request with a MessagePack body. FastAPI only parses bodies with a JSON content type (by calling "json()" of the request),
+    so the body is decoded from MessagePack in "json()", and the content type is reported as JSON to FastAPI.
+    """
+
+    def __init__(self, scope, receive):
+        super().__init__(scope, receive)
+        headers = MutableHeaders(raw=list(scope["headers"]))
+        headers["content-type"] = "application/json"
+        self._headers = headers
+
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = msgpack.unpackb(await self.body())
+        return self._json
+
+
+class NegotiatedRoute(APIRoute):
+    """Route class reading the format of the request body and of the response from the headers. Used by all routers of the app."""
+
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def negotiated_route_handler(request: Request):
+            token = response_format.set(
+                "msgpack" if accepts_msgpack(request.headers.get("accept")) else "json")
+            try:
+                if is_msgpack(request.headers.get("content-type")):
+                    request = MsgPackRequest(request.scope, request.receive)
+                return await route_handler(request)
+            finally:
+                response_format.reset(token)
+
+        return negotiated_route_handler
@@ -0,0 +1,36 @@
+# Module for ETags of posts and feeds, used for answering conditional requests ("If-None-Match") with "304 Not Modified".
+# A post is only changed by updating it (which bumps its "version" column) or by voting on it (which changes its vote count),
+# so the id, version and vote count identify the body of a post exactly, and the tag is computed from those alone - without building the body.
+# The JSON and MessagePack encodings of the same post are different bodies, and must have different (strong) tags, so the format is part of the tag.
+
+import hashlib
+
+from fastapi import Response, status
+
+from .encoding import response_format
+
+
+def post_etag(id: int, version: int, votes: int):
+    return f'"p{id}.{version}.{votes}.{response_format.get()}"'
+
+
+def feed_etag(rows):
+    """The tag of a list of posts, given as (id, version, votes) rows in the order they're returned in."""
+    digest = hashlib.sha1()
+    for id, version, votes in rows:
+        digest.update(f"{id}.{version}.{votes};".encode())
+    return f'"f{digest.hexdigest()}.{response_format.get()}"'
+
+
+def matches(if_none_match: str, etag: str):
+    """Whether an "If-None-Match" header holds the tag. Weak tags ("W/...") are compared by their value, as RFC 7232 requires for this header."""
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str):
+    # Varies by "Accept" as the full response does (see app/encoding.py), so caches don't answer other formats with it.
+    response = Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers.add_vary_header("Accept")
+    return response
@@ -0,0 +1,168 @@
+# Module for group commit of new posts (optional, enabled with "post_group_commit_enabled").
+# Creating a post commits a transaction, and a commit waits for the WAL to be flushed to disk (fsync) - so with one commit per post,
+# the rate of posts is bound by the latency of the disk. With group commit, the posts created concurrently (within "post_group_commit_window_ms")
+# on the same shard are written together: one multi-row "INSERT ... RETURNING" and one commit, for up to "post_group_commit_max_posts" posts.
+#
+# The first request of a group waits for the window (or until the group is full), then writes the group, on its own thread.
+# The others wait for it, and each gets its own post back. Each request adds up to the window of latency, in exchange for far fewer commits.
+# A request is only answered once its post is committed, as without group commit - nothing is acknowledged before it's durable.
+#
+# Every request waiting in a group holds a thread of the threadpool running the path operations. So no more than "post_group_commit_max_posts"
+# requests wait in the groups of all shards together - a post arriving past it is written on its own right away, rather than waiting for
+# a thread. And a request waits for its group to be written for "post_group_commit_timeout_ms" at most.
+#
+# Errors stay with their request: a group failing to be written (i.e. one post with a value Postgres doesn't take) is written again
+# one post at a time, so only the request with the failing post gets the error, and the others get their posts.
+
+import threading
+from concurrent.futures import Future, TimeoutError
+from typing import List, Optional
+
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+
+from . import models, outbox, sharding, stats
+from .config import settings
+
+
+class Timeout(Exception):
+    """Raised when a group isn't written in time. Its posts may still be created, once the group is written."""
+
+# Counting the posts of all the users of a group on their shard, for the ids of the posts (see "NEXT_POST_SEQ" in app/sharding.py).
+# The users are locked in the order of their ids first, so two groups with the same users never deadlock on each other.
+# Users who aren't (or no longer) on this shard aren't returned.
+NEXT_POST_SEQS = text("""
+    WITH locked AS (
+        SELECT id FROM users WHERE id = ANY(CAST(:ids AS integer[])) AND shard = :shard ORDER BY id FOR UPDATE
+    )
+    UPDATE users SET last_post_seq = users.last_post_seq + v.n
+    FROM unnest(CAST(:ids AS integer[]), CAST(:counts AS integer[])) AS v(id, n)
+    JOIN locked ON locked.id = v.id
+    WHERE users.id = v.id
+    RETURNING users.id, users.last_post_seq""")
+
+
+def write_posts(db: Session, shard: int, users_ids: List[int], posts: List[dict]) -> List[Optional[dict]]:
+    """
+    Creates posts (the fields of "PostCreate") of users on their shard, in one transaction, and commits it.
+    Returns the rows of the created posts, in the order of the posts - None for the posts of users who aren't on this shard.
+    """
+    counts = {}
+    for users_id in users_ids:
+        counts[users_id] = counts.get(users_id, 0) + 1
+    ids = sorted(counts)
+    last_seqs = dict(db.execute(NEXT_POST_SEQS, {"ids": ids, "counts": [counts[id] for id in ids], "shard": shard}).all())
+
+    # Numbering the posts of each user in the order they arrived.
+    next_seqs = {id: last_seq - counts[id] + 1 for id, last_seq in last_seqs.items()}
+    rows = []
+    for users_id, post in zip(users_ids, posts):
+        if users_id in next_seqs:
+            rows.append({"id": sharding.make_post_id(users_id, next_seqs[users_id]), "users_id": users_id, **post})
+            next_seqs[users_id] += 1
+
+    created = {}
+    if rows:
+        # All the posts in one statement. The columns filled in by Postgres (i.e. "created_at") are returned along with the rest.
+        created = {row["id"]: dict(row) for row in db.execute(insert(models.Post).values(rows).returning(
+            *models.Post.__table__.c)).mappings()}
+        outbox.enqueue_many(db, [("post.created", {"post_id": row["id"], "users_id": row["users_id"]}) for row in rows])
+        deltas = stats.Deltas()
+        for row in rows:
+            deltas.add(row["users_id"], posts=1)
+        deltas.apply(db)
+    db.commit()
+
+    # The rows were made in the order of the posts, skipping the users who aren't on this shard.
+    created_ids = iter(row["id"] for row in rows)
+    return [created[next(created_ids)] if users_id in last_seqs else None for users_id in users_ids]
+
+
+class Group:
+    """The posts waiting to be written together, and the futures of their requests."""
+
+    def __init__(self):
+        self.users_ids = []
+        self.posts = []
+        self.futures = []
+        self.full = threading.Event()
+
+
+class GroupCommit:
+
+    def __init__(self):
+        # Posts are added from any thread of the threadpool running the path operations.
+        self._lock = threading.Lock()
+        self._groups = {}  # Maps a shard to the group of posts being collected for it.
+        self._waiting = 0  # The number of posts in the groups being collected, of all shards.
+
+    def create_post(self, shard: int, users_id: int, post: dict) -> Optional[dict]:
+        """Creates a post along with the other posts created at the same time. Returns the row of the post, or None if the user isn't on the shard."""
+        future = Future()
+        with self._lock:
+            group = self._groups.get(shard)
+            if group is None and self._waiting >= settings.post_group_commit_max_posts:
+                # As many requests as allowed are waiting in the groups of other shards - written on its own, without waiting.
+                group, leader = Group(), True
+                group.full.set()
+            else:
+                leader = group is None
+                if leader:
+                    group = self._groups[shard] = Group()
+                self._waiting += 1
+            group.users_ids.append(users_id)
+            group.posts.append(post)
+            group.futures.append(future)
+            # A full group (or the group which fills up the posts waiting across all shards) is no longer joined - the next post starts
+            # a new one - and is written right away.
+            if self._waiting >= settings.post_group_commit_max_posts and self._groups.get(shard) is group:
+                self._close(shard, group)
+
+        if leader:
+            group.full.wait(settings.post_group_commit_window_ms / 1000)
+            with self._lock:
+                if self._groups.get(shard) is group:
+                    self._close(shard, group)
+            self.write(shard, group)
+        try:
+            return future.result(settings.post_group_commit_timeout_ms / 1000)
+        except TimeoutError:
+            raise Timeout(f"The group of the post wasn't written within {settings.post_group_commit_timeout_ms} ms") from None
+
+    def _close(self, shard: int, group: Group):
+        """Stops a group from being joined, and wakes its leader up to write it. Called with the lock held."""
+        del self._groups[shard]
+        self._waiting -= len(group.posts)
+        group.full.set()
+
+    def write(self, shard: int, group: Group):
+        db = sharding.router.session(shard)
+        try:
+            try:
+                results = write_posts(db, shard, group.users_ids, group.posts)
+            except Exception as error:
+                db.rollback()
+                if len(group.posts) == 1:
+                    group.futures[0].set_exception(error)
+                    return
+                # Written again one post at a time, so the error only goes to the request it belongs to.
+                for users_id, post, future in zip(group.users_ids, group.posts, group.futures):
+                    try:
+                        future.set_result(write_posts(db, shard, [users_id], [post])[0])
+                    except Exception as error:
+                        db.rollback()
+                        future.set_exception(error)
+                return
+            for future, result in zip(group.futures, results):
+                future.set_result(result)
+        except BaseException as error:
+            # Nobody is left waiting, whatever happened.
+            for future in group.futures:
+                if not future.done():
+                    future.set_exception(error)
+            raise
+        finally:
+            db.close()
+
+
+posts = GroupCommit()
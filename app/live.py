@@ -0,0 +1,157 @@
+# Module for live vote count updates. Rather than clients polling "GET /posts/{id}" for new like counts, they subscribe to a set of posts
+# (see app/routers/live.py), and the new counts are pushed to them whenever a vote changes.
+#
+# Votes are published with Postgres "NOTIFY" in the same transaction as the vote, so only committed votes are published.
+# Each worker process has a single "LISTEN" connection, and fans the changes out to all of its subscribers. Changes to the same post
+# are coalesced - the count of a post is read at most once per tick, no matter how many votes it received in that tick.
+# With several shards (see app/sharding.py), votes are published on the shard of the post, so the worker listens on a connection to each shard.
+
+import asyncio
+import logging
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import models, sharding
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "post_votes"
+
+
+def publish_vote_change(db: Session, post_id: int):
+    """Notifies the listeners that the votes of a post changed. Postgres only sends the notification once the transaction commits."""
+    db.execute(text("SELECT pg_notify(:channel, :payload)"),
+               {"channel": CHANNEL, "payload": str(post_id)})
+
+
+def load_vote_counts(post_ids):
+    """Returns the current number of votes of each post, in one query on each shard."""
+    def count(db: Session):
+        return db.query(models.Vote.post_id, func.count(models.Vote.post_id)).filter(
+            models.Vote.post_id.in_(post_ids)).group_by(models.Vote.post_id).all()
+
+    # Posts without any votes don't appear in the result.
+    counts = {post_id: 0 for post_id in post_ids}
+    for rows in sharding.router.for_each_shard(count):
+        counts.update(rows)
+    return counts
+
+
+class Subscription:
+    """
+    The updates waiting to be sent to one client. Only the latest count of each post is kept, so a slow client never builds up a backlog -
+    it simply skips the counts that were replaced before it could receive them. The memory used is bounded by the number of posts subscribed to.
+    """
+
+    def __init__(self, post_ids):
+        self.post_ids = frozenset(post_ids)
+        self.pending = {}
+        self.ready = asyncio.Event()
+
+    def push(self, counts):
+        self.pending.update(counts)
+        self.ready.set()
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        self.ready.clear()
+        return pending
+
+
+class VoteHub:
+    """Listens for vote changes on a single connection (per shard), and fans them out to the subscriptions of this worker process once per tick."""
+
+    def __init__(self, load_counts=load_vote_counts):
+        self.load_counts = load_counts
+        self.subscriptions = {}  # Maps a post id to the subscriptions of that post.
+        self._dirty = set()
+        self._connections = []
+        self._task = None
+
+    def subscribe(self, post_ids):
+        subscription = Subscription(post_ids)
+        for post_id in subscription.post_ids:
+            self.subscriptions.setdefault(post_id, set()).add(subscription)
+        # Listening is only started once there's someone to send the changes to.
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for post_id in subscription.post_ids:
+            subscribers = self.subscriptions.get(post_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscriptions[post_id]
+
+    def mark_dirty(self, post_id: int):
+        self._dirty.add(post_id)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                self._listen()
+                # Notifications may have been missed before (re)connecting, so every subscribed post is refreshed once.
+                self._dirty.update(self.subscriptions)
+                while True:
+                    await asyncio.sleep(settings.live_tick_ms / 1000)
+                    await self.tick()
+            except asyncio.CancelledError:
+                self._close()
+                raise
+            except Exception:
+                logger.exception(
+                    "Listening for vote changes failed, reconnecting")
+                self._close()
+                await asyncio.sleep(1)
+
+    def _listen(self):
+        for shard in range(sharding.router.count):
+            # A connection of its own, detached from the pool, since it's held for as long as the process runs.
+            connection = sharding.router.engine(shard).raw_connection()
+            connection.detach()
+            connection = connection.connection
+            self._connections.append(connection)
+            connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {CHANNEL}")
+            asyncio.get_running_loop().add_reader(
+                connection.fileno(), self._on_notify, connection)
+
+    def _on_notify(self, connection):
+        connection.poll()
+        while connection.notifies:
+            self.mark_dirty(int(connection.notifies.pop().payload))
+
+    def _close(self):
+        for connection in self._connections:
+            asyncio.get_running_loop().remove_reader(connection.fileno())
+            connection.close()
+        self._connections = []
+
+    async def tick(self):
+        # Only the changed posts someone is subscribed to are read.
+        post_ids = [post_id for post_id in self._dirty if post_id in self.subscriptions]
+        self._dirty.clear()
+        if not post_ids:
+            return
+
+        counts = await run_in_threadpool(self.load_counts, post_ids)
+        for post_id, votes in counts.items():
+            for subscription in self.subscriptions.get(post_id, ()):
+                subscription.push({post_id: votes})
+
+
+hub = VoteHub()
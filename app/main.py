@@ -1,9 +1,22 @@
+import asyncio
+
 from fastapi import FastAPI
 # By default the webbrowser domain and this APIs server domain can only connect with eachother, when they are on the same domain.
 # This CORS (Cross Origin Resource Sharing) middleware allows webbrowsers on other domains to send requests to this API endpoints domain.
 from fastapi.middleware.cors import CORSMiddleware
 
-from .routers import post, user, auth, vote
+from .routers import post, user, auth, vote, live, analytics, health, admin, attachment, timeline
+from .admission import AdmissionMiddleware
+from .ratelimit import RateLimitMiddleware
+from .encoding import NegotiatedResponse
+from .config import settings
+from . import outbox, rollups, timelines  # Importing "rollups" and "timelines" registers their outbox handlers.
+from .live import hub
+from .vote_buffer import buffer as vote_buffer
+from .purger import purger
+from . import warmup
+from .revocation import refresher as revocation_refresher
+from .partitions import maintainer as partition_maintainer
 
 
 # This is used to create all of the models used for defining and creating tables in the Postgres DB via ORM (object-relational mapping).
@@ -11,13 +24,20 @@ from .routers import post, user, auth, vote
 # models.Base.metadata.create_all(bind=engine) Not needed, since Alembic is used.
 
 
-app = FastAPI()  # Creating an instance.
+# Responses are encoded as JSON, or as MessagePack for clients asking for it with "Accept: application/msgpack".
+app = FastAPI(default_response_class=NegotiatedResponse)  # Creating an instance.
 """Commands for running the webserver:
 'uvicorn "name_of_file":"name_of_FastAPI_instance"'
 'uvicorn "name_of_file":"name_of_FastAPI_instance" --reload' will watch for changes in the directory, which allows to reload the server, whenever any changes has been made to the code.
 'uvicorn app.main:app --reload' specifically to run this particullar module and app.
 """
 
+# Sheds load with "503" when the DB connection pool is saturated. Added before CORS, so the CORS middleware wraps it and adds its headers to "503" responses as well.
+app.add_middleware(AdmissionMiddleware)
+# Rejects clients sending too many requests with "429". Added after the admission control, so it runs first - rejecting a request
+# for its client costs less than admitting it, and a flood from one client doesn't get the requests of everyone else shed.
+app.add_middleware(RateLimitMiddleware)
+
 # Specify the domains allowed to send requests to this API and all of its endpoints.
 origins = ["*"]
 
@@ -35,9 +55,48 @@ app.add_middleware(
 
 # Importing the router object from "post" and "user", and including all routes defined in both modules, in here.
 app.include_router(post.router)
+app.include_router(attachment.router)
 app.include_router(user.router)
+app.include_router(timeline.router)
 app.include_router(auth.router)
 app.include_router(vote.router)
+app.include_router(live.router)
+app.include_router(analytics.router)
+app.include_router(health.router)
+app.include_router(admin.router)
+
+
+# Background workers running in the same process as the API. Started when the server starts, and stopped gracefully when it shuts down.
+@app.on_event("startup")
+async def start_workers():
+    # Warming up in the background - the server already answers "/healthz" meanwhile, and "/readyz" once it's done.
+    if settings.warmup_enabled:
+        app.state.warmup = asyncio.create_task(warmup.run())
+    else:
+        warmup.readiness.ready = True
+    if settings.outbox_worker_enabled:
+        outbox.worker.start()
+    if settings.vote_buffer_enabled:
+        vote_buffer.start()
+    if settings.purger_enabled:
+        purger.start()
+    if settings.revocation_refresher_enabled:
+        revocation_refresher.start()
+    if settings.partition_maintainer_enabled:
+        partition_maintainer.start()
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    # Writing the buffered votes first, since the outbox events of those votes are written along with them.
+    await vote_buffer.stop()
+    await outbox.worker.stop()
+    await purger.stop()
+    await revocation_refresher.stop()
+    await partition_maintainer.stop()
+    await hub.stop()
+    if settings.warmup_enabled:
+        app.state.warmup.cancel()
 
 
 @app.get("/")
@@ -1,31 +1,99 @@
 # Module for defining models for creating tables.
 
 # For defining the columns via ORM (object-relational mapping).
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, TIMESTAMP, text
+from sqlalchemy import Column, ForeignKey, Integer, BigInteger, String, Boolean, TIMESTAMP, text, Index, DDL, event
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
 from .database import Base  # Model for defining and creating tables.
 
 
 # Class for posting posts. Extends from Base model from SQLalchemy.
+# The table is partitioned by month of "created_at" (see app/partitions.py): "posts" holds the recent months only, older months are moved to
+# "posts_archive" (the "ArchivedPost" below). Queries on "posts" never read the archived months, and only read the archive when asked to.
 class Post(Base):
     __tablename__ = "posts"
 
-    id = Column(Integer, primary_key=True)
+    # Ids of new posts are made from the id of their author, see app/sharding.py. Posts created before were numbered by the "posts_id_seq" sequence.
+    # The PK of a partitioned table must hold the column it's partitioned by, so it's (id, created_at) in the DB. The ids are still unique,
+    # and posts are looked up by their id alone (see "__mapper_args__").
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
     # Server default must be provided, if a default value is desired.
     published = Column(Boolean, nullable=False, server_default="TRUE")
-    created_at = Column(TIMESTAMP(timezone=True),
+    created_at = Column(TIMESTAMP(timezone=True), primary_key=True,
                         nullable=False, server_default=text("now()"))  # Needed for adding current time and timezone.
     # Use the table name you want to establish a relation to, not the class name. The column of the foreign table.
     users_id = Column(Integer, ForeignKey(
         "users.id", ondelete="CASCADE"), nullable=False)
+    # Incremented on every update of the post. Used along with the vote count for the ETag of the post.
+    version = Column(Integer, nullable=False, server_default="1")
+    # Set when the post is deleted. A deleted post is hidden from all reads right away, and removed along with its votes later by the purger (app/purger.py).
+    deleted_at = Column(TIMESTAMP(timezone=True))
 
     # This returns the class of another model. Not the table.
     # This creates a property for each retrieved post, and returns an owner for each post. This just figures out the relationship to User class.
     # Must be included as a field in the returned schema.
     owner = relationship("User")
+    # The metadata of the files attached to the post (not the files themselves, see app/attachments.py). Only read through this relationship -
+    # loaded along with the posts of the feed and of single posts by the queries of app/queries.py, with one extra query per page.
+    # Not a foreign key in the DB (a foreign key can't reference the id alone of a partitioned table), so the join is spelled out.
+    attachments = relationship("Attachment", primaryjoin="Post.id == foreign(Attachment.post_id)",
+                               viewonly=True, order_by="Attachment.created_at")
+
+    __mapper_args__ = {"primary_key": [id]}
+
+    # Composite index backing the per-author listing (newest first). The trailing "id" breaks ties between posts created at the same time,
+    # which lets the keyset cursor "(created_at, id) < (..., ...)" be used directly as an index condition, so any page is reached in constant time.
+    __table_args__ = (
+        Index("ix_posts_users_id_created_at_id", users_id,
+              created_at.desc(), id.desc()),
+        # The order of the feed: the posts in the order they were created, whoever their author.
+        Index("ix_posts_created_at_id", created_at, id),
+        # Only the deleted posts waiting to be purged are in this index, so the purger finds them without scanning the table.
+        Index("ix_posts_deleted_at", deleted_at,
+              postgresql_where=deleted_at.isnot(None)),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+
+# Posts created in months without a partition yet land in the default partition, and are moved to the partition of their month once it's
+# created (see app/partitions.py). Created along with the table, so a new database (i.e. the one of the tests) takes posts right away.
+event.listen(Post.__table__, "after_create", DDL("CREATE TABLE posts_default PARTITION OF posts DEFAULT"))
+
+
+# The archived posts - the months of "posts" older than "posts_hot_months", moved here whole by app/partitions.py (a partition is detached
+# from "posts" and attached here, without copying a row). The same columns and indexes as "posts". Read-only: archived posts are only read,
+# by the reads asking for them ("archive=true"), and removed along with their author.
+class ArchivedPost(Base):
+    __tablename__ = "posts_archive"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    title = Column(String, nullable=False)
+    content = Column(String, nullable=False)
+    published = Column(Boolean, nullable=False, server_default="TRUE")
+    created_at = Column(TIMESTAMP(timezone=True), primary_key=True,
+                        nullable=False, server_default=text("now()"))
+    users_id = Column(Integer, ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    version = Column(Integer, nullable=False, server_default="1")
+    deleted_at = Column(TIMESTAMP(timezone=True))
+
+    owner = relationship("User")
+    attachments = relationship("Attachment", primaryjoin="ArchivedPost.id == foreign(Attachment.post_id)",
+                               viewonly=True, order_by="Attachment.created_at")
+
+    __mapper_args__ = {"primary_key": [id]}
+
+    __table_args__ = (
+        Index("ix_posts_archive_users_id_created_at_id", users_id,
+              created_at.desc(), id.desc()),
+        Index("ix_posts_archive_created_at_id", created_at, id),
+        Index("ix_posts_archive_deleted_at", deleted_at,
+              postgresql_where=deleted_at.isnot(None)),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
 
 # Class for creating a table in Postgres for user registration.
@@ -37,6 +105,15 @@ class User(Base):
     password = Column(String, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text("now()"))  # Needed for adding current time and timezone.
+    # The shard holding the posts of the user, and the number of posts the user created (for the ids of their posts). See app/sharding.py.
+    # The shard is looked up on the main database, and the number of posts is counted on the shard of the user.
+    shard = Column(Integer, nullable=False, server_default="0")
+    last_post_seq = Column(Integer, nullable=False, server_default="0")
+    # The number of followers of the user, kept up to date along with "follows" on the main database (not on the copies of the user on the other shards).
+    # Authors with more followers than "timeline_celebrity_followers" aren't fanned out to the timelines of their followers (see app/timelines.py).
+    followers = Column(Integer, nullable=False, server_default="0")
+    # Set when the user logs out everywhere - the tokens issued before are refused (see app/revocation.py).
+    tokens_valid_after = Column(TIMESTAMP(timezone=True))
 #    name = Column(String, nullable=False)
 
 
@@ -46,5 +123,142 @@ class Vote(Base):
     # Using the ForeignKey method from SQLAlchemy to set the columns as composite keys.
     user_id = Column(Integer, ForeignKey(
         "users.id", ondelete="CASCADE"), primary_key=True)
-    post_id = Column(Integer, ForeignKey(
-        "posts.id", ondelete="CASCADE"), primary_key=True)
+    # Not a foreign key, see "Post.id" - the votes of a post are removed along with it by the purger (app/purger.py).
+    post_id = Column(BigInteger, primary_key=True)
+    created_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text("now()"))
+
+    # The composite PK leads with "user_id", so it can't be used when counting the votes of a post. This index makes those counts index-only.
+    __table_args__ = (
+        Index("ix_votes_post_id", post_id),
+    )
+
+
+# Statistics of each user, for their profile: the number of posts, the likes their posts received, and the likes they gave.
+# Kept up to date in the same transaction as every change of posts and votes (see app/stats.py), rather than counted on every request.
+class UserStats(Base):
+    __tablename__ = "user_stats"
+
+    users_id = Column(Integer, ForeignKey(
+        "users.id", ondelete="CASCADE"), primary_key=True)
+    posts = Column(Integer, nullable=False, server_default="0")
+    likes_received = Column(Integer, nullable=False, server_default="0")
+    likes_given = Column(Integer, nullable=False, server_default="0")
+    updated_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text("now()"))
+
+
+# Rollups of the votes of each post, counted in buckets of time - the likes given and taken back within each hour (or day, for older buckets).
+# Kept up to date by the outbox worker (see app/rollups.py), and read by the analytics endpoints, rather than counting the raw votes.
+class PostVoteBucket(Base):
+    __tablename__ = "post_vote_buckets"
+
+    # Not a foreign key, see "Post.id". Removed along with the post by the purger.
+    post_id = Column(BigInteger, primary_key=True)
+    # "hour" or "day". Hourly buckets are compacted into daily ones once they're old enough.
+    resolution = Column(String, primary_key=True)
+    bucket_start = Column(TIMESTAMP(timezone=True), primary_key=True)
+    likes = Column(Integer, nullable=False, server_default="0")
+    unlikes = Column(Integer, nullable=False, server_default="0")
+
+    # For the buckets of all posts within a time range, i.e. for the top posts of the last 24 hours.
+    __table_args__ = (
+        Index("ix_post_vote_buckets_bucket_start", bucket_start),
+    )
+
+
+# The progress of the backfill of the rollups (see app/rollups.py), one row. The votes given before the rollups existed were all stamped with
+# the time of the migration adding the rollups, kept here - they're counted by the backfill, the ones after it by the events. The posts are
+# backfilled in the order of their ids, and the last one done is kept along with the buckets it was counted in, so a rerun doesn't count it again.
+class RollupBackfill(Base):
+    __tablename__ = "rollup_backfill"
+
+    votes_until = Column(TIMESTAMP(timezone=True), primary_key=True)
+    last_post_id = Column(BigInteger, nullable=False, server_default="0")
+
+
+# Table for the transactional outbox. Events are written in the same transaction as the change they describe, and are delivered
+# to their handlers afterwards by the outbox worker (app/outbox.py), rather than on the request path.
+class OutboxEvent(Base):
+    __tablename__ = "outbox"
+
+    id = Column(BigInteger, primary_key=True)
+    topic = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text("now()"))
+    # The number of failed deliveries, and when the next delivery may be attempted. Used for retrying with a backoff.
+    attempts = Column(Integer, nullable=False, server_default="0")
+    available_at = Column(TIMESTAMP(timezone=True),
+                          nullable=False, server_default=text("now()"))
+    last_error = Column(String)
+
+    __table_args__ = (
+        Index("ix_outbox_available_at_id", available_at, id),
+    )
+
+
+# Files attached to posts (i.e. images). The files are stored outside of the DB, named by the SHA-256 of their content (see app/attachments.py) -
+# only their metadata is stored here, on the shard of the post. A file is attached to a post once, and the same file may be attached to many posts.
+class Attachment(Base):
+    __tablename__ = "attachments"
+
+    # Not a foreign key, see "Post.id". Removed along with the post by the purger.
+    post_id = Column(BigInteger, primary_key=True)
+    sha256 = Column(String(64), primary_key=True)
+    content_type = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    filename = Column(String)
+    # Set by the thumbnail workers once the thumbnail is made, for images.
+    thumbnail_sha256 = Column(String(64))
+    created_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text("now()"))
+
+
+# Users following other users, for their home timelines (see app/timelines.py). On the main database, along with the users.
+class Follow(Base):
+    __tablename__ = "follows"
+
+    follower_id = Column(Integer, ForeignKey(
+        "users.id", ondelete="CASCADE"), primary_key=True)
+    followee_id = Column(Integer, ForeignKey(
+        "users.id", ondelete="CASCADE"), primary_key=True)
+    created_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text("now()"))
+
+    # The PK leads with the follower. This index finds the followers of an author, when fanning out their new posts.
+    __table_args__ = (
+        Index("ix_follows_followee_id", followee_id),
+    )
+
+
+# The precomputed home timelines: an entry for each post of the authors a user follows, written by the outbox worker when the post is created
+# (fan-out on write, see app/timelines.py). On the main database - the posts themselves are on the shards of their authors.
+class TimelineEntry(Base):
+    __tablename__ = "timeline_entries"
+
+    # The PK is the order the timeline is read in (newest first, by a backward scan), so a page of a timeline is one range of the index.
+    users_id = Column(Integer, ForeignKey(
+        "users.id", ondelete="CASCADE"), primary_key=True)
+    created_at = Column(TIMESTAMP(timezone=True), primary_key=True)
+    post_id = Column(BigInteger, primary_key=True)
+    # The author of the post, for removing their posts when they're unfollowed. Not a foreign key, the posts may be on other shards.
+    author_id = Column(Integer, nullable=False)
+
+
+# The denylist of access tokens revoked before they expire (i.e. on logout), by the id of the token ("jti"). Checked in memory by each worker,
+# which reads the new entries periodically (see app/revocation.py). On the main database.
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String(32), primary_key=True)
+    # The expiry of the token. The entry isn't needed anymore after it - an expired token is refused anyway.
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    revoked_at = Column(TIMESTAMP(timezone=True),
+                        nullable=False, server_default=text("now()"))
+
+    # For reading the entries revoked since the last refresh of the workers, and the expired ones for removing them.
+    __table_args__ = (
+        Index("ix_revoked_tokens_revoked_at", revoked_at),
+        Index("ix_revoked_tokens_expires_at", expires_at),
+    )
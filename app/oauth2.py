@@ -7,11 +7,14 @@ from jose import JWTError, jwt
 
 # For generating tokens and handling their expiration time.
 from datetime import datetime, timedelta
+import time
+import uuid
 
 from sqlalchemy.orm import Session
 
 
-from . import schemas, models
+from . import schemas, models, queries
+from .revocation import denylist  # The tokens revoked before they expire, checked in memory.
 from .database import get_db
 from .config import settings
 
@@ -33,6 +36,9 @@ def create_access_token(data: dict):
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     # Adding an extra property of expiration time, to all of the data wanted to be encoded as the JWT.
     to_encode.update({"exp": expire})  # Will show expiration time.
+    # The id of the token, for revoking it (see app/revocation.py), and when it was issued, for revoking all the tokens of a user.
+    # The time of issue is kept to the microsecond, so a token issued right after logging out everywhere is still valid.
+    to_encode.update({"jti": uuid.uuid4().hex, "iat": time.time()})
 
     # First is everything wanted to be put into the payload. Second is secret key. Third is the algorithm.
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
@@ -50,10 +56,14 @@ def verify_access_token(token: str, credentials_exception):
         if id is None:
             # Raising whatever exceptions provided in the function is being raised here.
             raise credentials_exception
-        token_data = schemas.TokenData(id=id)
+        token_data = schemas.TokenData(id=id, jti=payload.get("jti"), iat=payload.get("iat"), exp=payload.get("exp"))
     except JWTError:
         raise credentials_exception
 
+    # A lookup in the in-memory denylist - no query.
+    if token_data.jti is not None and denylist.is_revoked(token_data.jti):
+        raise credentials_exception
+
     return token_data  # Returns the id pretty much.
 
 
@@ -63,6 +73,26 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
 
     token = verify_access_token(token, credentials_exception)
     # Querying to match the id in the verified token to the users id stored in the DB to return the id to the user IF they match. As a service.
-    user = db.query(models.User).filter(models.User.id == token.id).first()
+    # Run on every authenticated request, so the query is built once in app/queries.py (and run as a prepared statement).
+    user = db.execute(queries.user_by_id, {"id": token.id}).scalars().first()
+
+    # The user logged out everywhere after the token was issued. Tokens without a time of issue are from before that as well.
+    if user is not None and user.tokens_valid_after is not None and (token.iat is None or token.iat < user.tokens_valid_after.timestamp()):
+        raise credentials_exception
 
     return user
+
+
+# The claims of the token of the request, for revoking it.
+def get_current_token(token: str = Depends(oauth2_scheme)):
+    return verify_access_token(token, HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Could not validate credentials", headers={"WWW-Authenticate": "Bearer"}))
+
+
+# Only the users listed in the "admin_user_ids" setting may use the admin endpoints.
+def get_current_admin(current_user: models.User = Depends(get_current_user)):
+    if current_user is None or current_user.id not in settings.admin_user_ids:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="Not authorized to perform requested action")
+
+    return current_user
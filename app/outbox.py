@@ -0,0 +1,136 @@
+# Module for the transactional outbox. Side effects of a write (cache invalidation, counters, notifications) are not run on the request path.
+# Instead, the routers write an event to the "outbox" table in the same transaction as the change itself, and the worker below delivers
+# the events to their handlers in batches, after the transaction has committed.
+#
+# Delivery is at-least-once: an event is only removed once its handlers have succeeded, so a crash in between delivers it again.
+# Handlers must therefore be idempotent. Run the worker in-process (started by app.main) or separately with: "python -m app.outbox".
+# Each shard (see app/sharding.py) has an outbox of its own, for the changes made on it. The worker drains all of them, and the handlers
+# are called with the session of the shard of the event.
+
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import models
+from .config import settings
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+# Maps a topic to the functions handling its events.
+handlers = defaultdict(list)
+
+
+def handler(topic: str):
+    """Decorator registering a function as a handler of a topic. Handlers are called with the DB session and the payload of the event."""
+    def register(function):
+        handlers[topic].append(function)
+        return function
+    return register
+
+
+def enqueue(db: Session, topic: str, **payload):
+    """Adds an event to the outbox. Must be called before committing the change the event describes - it's committed along with it."""
+    db.add(models.OutboxEvent(topic=topic, payload=payload))
+
+
+def enqueue_many(db: Session, events):
+    """Adds many events to the outbox in one statement. Takes a list of (topic, payload) tuples."""
+    if events:
+        db.execute(models.OutboxEvent.__table__.insert(), [
+                   {"topic": topic, "payload": payload} for topic, payload in events])
+
+
+def drain(db: Session, batch_size: int = None):
+    """
+    Delivers one batch of due events and returns the number of events in it.
+    "SKIP LOCKED" allows several workers to drain the outbox concurrently, each taking a different batch.
+    Each event is handled in a savepoint, so the DB changes of a failing handler are rolled back without affecting the rest of the batch.
+    """
+    events = db.query(models.OutboxEvent).filter(models.OutboxEvent.available_at <= func.now()).order_by(
+        models.OutboxEvent.available_at, models.OutboxEvent.id).limit(batch_size or settings.outbox_batch_size).with_for_update(skip_locked=True).all()
+
+    for event in events:
+        try:
+            with db.begin_nested():
+                for function in handlers[event.topic]:
+                    function(db, event.payload)
+        except Exception as error:
+            event.attempts += 1
+            event.last_error = repr(error)
+            if event.attempts >= settings.outbox_max_attempts:
+                # Parking the event for a human to look at, rather than retrying it forever.
+                event.available_at = func.now() + timedelta(days=365 * 100)
+                logger.error("Outbox event %s (%s) failed %s times, giving up: %r",
+                             event.id, event.topic, event.attempts, error)
+            else:
+                # Exponential backoff, capped at 5 minutes.
+                event.available_at = func.now() + \
+                    timedelta(seconds=min(2 ** event.attempts, 300))
+                logger.warning("Outbox event %s (%s) failed, retrying: %r",
+                               event.id, event.topic, error)
+        else:
+            db.delete(event)
+
+    db.commit()
+    return len(events)
+
+
+def drain_once():
+    """Delivers a batch of the outbox of each shard. Returns the size of the largest batch, so the worker goes on while any shard has a backlog."""
+    return max(sharding.router.for_each_shard(drain))
+
+
+class OutboxWorker:
+    """Background task draining the outbox. Drains batch after batch while there's a backlog, and polls when the outbox is empty."""
+
+    def __init__(self):
+        self._task = None
+        self._stopping = None
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                delivered = await run_in_threadpool(drain_once)
+            except Exception:
+                logger.exception("Draining the outbox failed")
+                delivered = 0
+
+            # A full batch means there's probably more waiting, so draining again right away.
+            if delivered < settings.outbox_batch_size:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), settings.outbox_poll_interval_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+
+
+worker = OutboxWorker()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    # This file runs as "__main__" here, so the worker must be taken from "app.outbox" - the module the handlers register with.
+    # Importing the modules defining handlers registers them.
+    from app import outbox, rollups, timelines
+
+    async def main():
+        outbox.worker.start()
+        await outbox.worker._task
+
+    asyncio.run(main())
@@ -0,0 +1,266 @@
+# Module for the partitions of the posts. "posts" is partitioned by month of "created_at" (a table "posts_YYYY_MM" for each month, in UTC),
+# and only holds the recent months - the last "posts_hot_months". Older months are archived: their partition is detached from "posts" and
+# attached to "posts_archive" as it is, without copying a row. So the reads of "posts" (everything the app reads by default) only ever scan
+# the indexes of a few months, however many years of posts there are, and the archive is only read when asked for ("archive=true").
+#
+# The maintainer keeps the partitions in shape, on every shard:
+# - The partitions of the hot months and of "posts_premade_months" ahead exist, so new posts never land in the default partition "posts_default".
+#   Posts which did (i.e. created before the partition of their month) are moved into the partition of their month once it's created,
+#   or into the archive if their month is old enough.
+# - The partitions older than the hot months are moved to the archive. The partition is first checked to fit its month (a constraint validated
+#   without blocking writes), so attaching it to the archive doesn't scan it. Detaching it still takes a short exclusive lock of "posts"
+#   ("DETACH CONCURRENTLY" isn't possible along with a default partition), waiting at most "partition_lock_timeout_ms" for it.
+#
+# Archived posts are read-only: they can't be voted on, updated or deleted (they're not found there), and are only removed along with their author.
+# Run the maintainer in-process (started by app.main) or separately, i.e. from cron, with: "python -m app.partitions"
+# Every worker of the app starts a maintainer of its own, so a maintainer only runs on a shard while it holds the advisory lock "MAINTAIN_LOCK"
+# of the shard, and skips the shard until the next run when another one holds it.
+
+import asyncio
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from sqlalchemy import column, insert, table, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import models, sharding
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# The names of the monthly partitions. The bounds of a partition are read from its name.
+PARTITION_NAME = re.compile(r"^posts_(\d{4})_(\d{2})$")
+
+# The columns of the posts, named in the statements moving posts between tables, so they don't depend on the order of the columns of each table.
+COLUMN_NAMES = [column.name for column in models.Post.__table__.c]
+COLUMNS = ", ".join(COLUMN_NAMES)
+
+# The partitions of a partitioned table.
+PARTITIONS = text("""
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = CAST(:parent AS regclass)""")
+
+# "lock_not_available" - a lock wasn't granted within the lock timeout.
+LOCK_NOT_AVAILABLE = "55P03"
+
+# The key of the advisory lock held by the maintainer of a shard (any number, as long as nothing else of the app uses it).
+MAINTAIN_LOCK = 0x706f737473
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def month_of(moment: datetime) -> datetime:
+    """The first moment of the month (in UTC) of a moment - the lower bound of its partition."""
+    moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month: datetime) -> str:
+    return f"posts_{month:%Y_%m}"
+
+
+def bounds(month: datetime) -> str:
+    return f"FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+
+
+def partitions(db: Session, parent: str):
+    """The monthly partitions of "posts" or "posts_archive", by their month."""
+    months = {}
+    for name, in db.execute(PARTITIONS, {"parent": parent}):
+        match = PARTITION_NAME.match(name)
+        if match:
+            months[datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc)] = name
+    return months
+
+
+def set_lock_timeout(db: Session):
+    # For the transaction only. Not waiting behind long queries for a lock, while every query coming after waits behind the change.
+    db.execute(text(f"SET LOCAL lock_timeout = {int(settings.partition_lock_timeout_ms)}"))
+
+
+def create_partition(db: Session, month: datetime):
+    """
+    Creates the partition of "posts" for a month, with the posts of that month found in the default partition (which none are written to
+    meanwhile). The partition is made and filled first, and attached after, as attaching it checks the default partition holds none of its posts.
+    """
+    name = partition_name(month)
+    set_lock_timeout(db)
+    db.execute(text("LOCK TABLE posts_default IN ACCESS EXCLUSIVE MODE"))
+    db.execute(text(f"CREATE TABLE {name} (LIKE posts INCLUDING DEFAULTS)"))
+    db.execute(text(f"""
+        WITH moved AS (DELETE FROM posts_default WHERE created_at >= :start AND created_at < :end RETURNING {COLUMNS})
+        INSERT INTO {name} ({COLUMNS}) SELECT {COLUMNS} FROM moved"""), {"start": month, "end": add_months(month, 1)})
+    db.execute(text(f"ALTER TABLE posts ATTACH PARTITION {name} FOR VALUES {bounds(month)}"))
+    db.commit()
+
+
+def archive_default(db: Session, month: datetime, archived):
+    """Moves the posts of an archived month found in the default partition into the archive. "archived" are the partitions of the archive."""
+    name = partition_name(month)
+    set_lock_timeout(db)
+    if month not in archived:
+        db.execute(text(f"CREATE TABLE {name} PARTITION OF posts_archive FOR VALUES {bounds(month)}"))
+    db.execute(text(f"""
+        WITH moved AS (DELETE FROM posts_default WHERE created_at >= :start AND created_at < :end RETURNING {COLUMNS})
+        INSERT INTO posts_archive ({COLUMNS}) SELECT {COLUMNS} FROM moved"""), {"start": month, "end": add_months(month, 1)})
+    db.commit()
+
+
+def archive_partition(db: Session, month: datetime):
+    """Moves the partition of a month from "posts" to "posts_archive" - all of its posts at once, without copying them."""
+    name = partition_name(month)
+    constraint = f"{name}_bounds"
+    # The constraint is added in a transaction of its own (it takes an exclusive lock, briefly), and validated in another one, which only
+    # blocks other changes of the table's definition - not its reads and writes.
+    validated = db.execute(text("SELECT convalidated FROM pg_constraint WHERE conname = :constraint AND conrelid = CAST(:name AS regclass)"),
+                           {"constraint": constraint, "name": name}).scalar()
+    if validated is None:
+        set_lock_timeout(db)
+        db.execute(text(f"""ALTER TABLE {name} ADD CONSTRAINT {constraint}
+                            CHECK (created_at >= '{month.isoformat()}' AND created_at < '{add_months(month, 1).isoformat()}') NOT VALID"""))
+        db.commit()
+    if not validated:
+        db.execute(text(f"ALTER TABLE {name} VALIDATE CONSTRAINT {constraint}"))
+        db.commit()
+
+    # The constraint proves the posts fit the bounds of the partition, so attaching it doesn't scan them.
+    set_lock_timeout(db)
+    db.execute(text(f"ALTER TABLE posts DETACH PARTITION {name}"))
+    db.execute(text(f"ALTER TABLE posts_archive ATTACH PARTITION {name} FOR VALUES {bounds(month)}"))
+    db.execute(text(f"ALTER TABLE {name} DROP CONSTRAINT {constraint}"))
+    db.commit()
+
+
+def attempt(db: Session, change, *args) -> bool:
+    """Makes a change, or leaves it for the next run if one of its locks isn't granted in time. Returns whether it was made."""
+    try:
+        change(db, *args)
+        return True
+    except OperationalError as error:
+        db.rollback()
+        if getattr(error.orig, "pgcode", None) != LOCK_NOT_AVAILABLE:
+            raise
+        logger.warning("Partition change %s%s is waiting for a lock, trying again later", change.__name__, args[:1])
+        return False
+
+
+def maintain(db: Session, now: datetime = None):
+    """Creates the partitions needed, and archives the old ones, on one shard. Returns the months created and the months archived."""
+    current = month_of(now or datetime.now(timezone.utc))
+    hot_start = add_months(current, -(settings.posts_hot_months - 1))
+    last = add_months(current, settings.posts_premade_months)
+    created, archived = [], []
+
+    # The posts of months without a partition, in the default partition. The ones of the months after "last" wait for their partition.
+    months = db.execute(text("SELECT DISTINCT date_trunc('month', created_at, 'UTC') FROM posts_default")).scalars().all()
+    db.commit()
+    for month in sorted(month_of(month) for month in months):
+        if month < hot_start:
+            if attempt(db, archive_default, month, partitions(db, "posts_archive")):
+                archived.append(month)
+        elif month <= last and attempt(db, create_partition, month):
+            created.append(month)
+
+    hot = partitions(db, "posts")
+    db.commit()
+    month = hot_start
+    while month <= last:
+        if month not in hot and attempt(db, create_partition, month):
+            created.append(month)
+        month = add_months(month, 1)
+
+    for month in sorted(partitions(db, "posts")):
+        db.commit()
+        if month < hot_start and attempt(db, archive_partition, month):
+            archived.append(month)
+    db.commit()
+    return sorted(created), sorted(set(archived))
+
+
+def copy_archived(db: Session, rows, batch_size: int):
+    """
+    Inserts archived posts (i.e. moved from another shard, see app/rebalance.py) into the partitions of their months, made in the archive
+    if there are none. Into the partitions directly, as a month may still be in "posts" on this shard. The caller commits.
+    """
+    by_month = defaultdict(list)
+    for row in rows:
+        by_month[month_of(row["created_at"])].append(dict(row))
+    existing = {**partitions(db, "posts"), **partitions(db, "posts_archive")}
+    for month, month_rows in sorted(by_month.items()):
+        if month not in existing:
+            db.execute(text(f"CREATE TABLE {partition_name(month)} PARTITION OF posts_archive FOR VALUES {bounds(month)}"))
+        partition = table(partition_name(month), *[column(name) for name in COLUMN_NAMES])
+        for start in range(0, len(month_rows), batch_size):
+            db.execute(insert(partition), month_rows[start:start + batch_size])
+
+
+def describe(created, archived) -> str:
+    return f"created the partitions of {[f'{month:%Y-%m}' for month in created]}, archived {[f'{month:%Y-%m}' for month in archived]}"
+
+
+def maintain_exclusively(db: Session, now: datetime = None):
+    """Runs "maintain" on one shard, unless another maintainer is running there (nothing is made then)."""
+    # A lock of the session, not of a transaction, as "maintain" commits after every change. Held by a connection of its own, as the
+    # session may be handed another connection of the pool after each commit. Released along with the connection if it's lost.
+    with db.get_bind().engine.connect() as lock:
+        if not lock.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": MAINTAIN_LOCK}).scalar():
+            logger.info("Another maintainer is running on the shard, skipping it")
+            return [], []
+        try:
+            return maintain(db, now)
+        finally:
+            lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MAINTAIN_LOCK})
+
+
+def maintain_once():
+    """Maintains the partitions on each shard. Returns the months created and archived on each shard."""
+    return sharding.router.for_each_shard(maintain_exclusively)
+
+
+class Maintainer:
+    """Background task maintaining the partitions every "partition_interval_minutes"."""
+
+    def __init__(self):
+        self._task = None
+        self._stopping = None
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                for shard, (created, archived) in enumerate(await run_in_threadpool(maintain_once)):
+                    if created or archived:
+                        logger.info("Shard %s: %s", shard, describe(created, archived))
+            except Exception:
+                logger.exception("Maintaining the partitions of the posts failed")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), settings.partition_interval_minutes * 60)
+            except asyncio.TimeoutError:
+                pass
+
+
+maintainer = Maintainer()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    for shard, (created, archived) in enumerate(maintain_once()):
+        logger.info("Shard %s: %s", shard, describe(created, archived))
@@ -0,0 +1,74 @@
+# Module for running hot queries as server-side prepared statements. Postgres then parses and plans them once per connection,
+# rather than for every request. psycopg2 has no API for that, so statements marked with the execution option "prepare"
+# (see app/queries.py) are rewritten on their way to the DB: "PREPARE" is sent the first time a connection sees a statement, and "EXECUTE" after.
+#
+# Prepared statements belong to a DB session, which doesn't work with poolers in transaction mode (i.e. pgbouncer) - the next transaction
+# may run on another server connection. Turn it off with "db_prepared_statements" there.
+
+import hashlib
+import re
+
+from sqlalchemy import event
+
+from .config import settings
+
+# The most statements prepared on one connection. Statements marked after that are sent unprepared, so memory on the server stays bounded.
+MAX_PREPARED_PER_CONNECTION = 200
+
+# SQLAlchemy renders bound parameters for psycopg2 as "%(name)s". Literal percent signs are escaped as "%%".
+PARAMETER = re.compile(r"%\((\w+)\)s|%%")
+
+# Maps the SQL of a statement to its name and the names of its parameters, in the order of "$1", "$2", etc.
+_statements = {}
+
+
+def install(engine):
+    event.listen(engine, "before_cursor_execute", prepare_statement, retval=True)
+    event.listen(engine, "handle_error", discard_invalid_statements)
+
+
+def parse(statement: str):
+    """Returns the name of a statement, its SQL with numbered parameters as "PREPARE" expects, and the names of its parameters."""
+    names = []
+
+    def number(match):
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    sql = PARAMETER.sub(number, statement)
+    name = "q_" + hashlib.sha1(statement.encode()).hexdigest()[:20]
+    return name, sql, names
+
+
+def prepare_statement(conn, cursor, statement, parameters, context, executemany):
+    if (executemany or not settings.db_prepared_statements or context is None
+            or not context.execution_options.get("prepare") or not isinstance(parameters, dict)):
+        return statement, parameters
+
+    if statement not in _statements:
+        _statements[statement] = parse(statement)
+    name, sql, names = _statements[statement]
+
+    # The statements prepared on a connection are kept in the "info" of the connection, which lives as long as the DBAPI connection does.
+    prepared = conn.connection.info.setdefault("prepared_statements", set())
+    if name not in prepared:
+        if len(prepared) >= MAX_PREPARED_PER_CONNECTION:
+            return statement, parameters
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+
+    if not names:
+        return f"EXECUTE {name}", parameters
+    return f"EXECUTE {name}({', '.join(f'%({parameter})s' for parameter in names)})", parameters
+
+
+def discard_invalid_statements(context):
+    """
+    A prepared statement fails when the tables it reads have changed in a way that changes its result (i.e. a migration added a column).
+    The connection is thrown away then, like a broken one, so the statements are prepared again on a new connection.
+    """
+    if getattr(context.original_exception, "pgcode", None) == "0A000" and "cached plan" in str(context.original_exception):
+        context.is_disconnect = True
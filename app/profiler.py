@@ -0,0 +1,156 @@
+# In-process sampling profiler, for finding out what a worker burns its CPU on in production, where external profilers can't be attached.
+# A thread samples the stacks of all threads of the process (the event loop, and the threadpool running the sync path operations)
+# every interval, with "sys._current_frames()". Nothing is traced in between, so the overhead is a few microseconds per thread and sample.
+#
+# Samples are labelled with the route being handled (when the path operation is on the stack) and the SQL statement being executed.
+# Exported as collapsed stacks (for flamegraph.pl, speedscope and most flame graph tools) or as a speedscope file (https://www.speedscope.app).
+# Served by "GET /admin/profile", see app/routers/admin.py.
+
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Leaf frames of threads waiting for work: the event loop waiting for IO, and idle threads of the threadpool. Left out unless asked for.
+IDLE_FRAMES = {("selectors", "select"), ("threading", "wait")}
+
+# The length SQL statements are shortened to in labels.
+SQL_LABEL_LENGTH = 100
+
+# The SQL statement each thread is executing, while a profile is being taken. Set by the cursor events of SQLAlchemy below.
+_active_sql = {}
+_profiling = threading.Lock()
+
+
+class Busy(Exception):
+    """A profile is already being taken in this process."""
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    if _profiling.locked():
+        # The statement as compiled, rather than "EXECUTE q_..." it's rewritten to for prepared statements (app/prepared.py).
+        statement = getattr(context, "statement", None) or statement
+        _active_sql[threading.get_ident()] = "sql:" + " ".join(statement.split())[:SQL_LABEL_LENGTH]
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def clear_statement(conn, cursor, statement, parameters, context, executemany):
+    _active_sql.pop(threading.get_ident(), None)
+
+
+@event.listens_for(Engine, "handle_error")
+def clear_failed_statement(context):
+    _active_sql.pop(threading.get_ident(), None)
+
+
+def route_labels(app):
+    """Maps the code of each path operation of the app to the label of its route, i.e. "GET /posts/{id}"."""
+    labels = {}
+    for route in app.routes:
+        endpoint = getattr(route, "endpoint", None)
+        if endpoint is not None and hasattr(endpoint, "__code__"):
+            labels[endpoint.__code__] = f"route:{','.join(sorted(getattr(route, 'methods', None) or ['WS']))} {route.path}"
+    return labels
+
+
+class Sampler:
+    """
+    Samples the stacks of all other threads every "interval_ms", until stopped. Each sample is kept as the name of its thread,
+    its frames from the root to the leaf, and its weight (the time since the previous sample, in milliseconds).
+    Frames are tuples of a name, a file and a line - labels are frames without a file. The route label becomes the root frame,
+    so flame graphs group the stacks by route, and the SQL label the leaf frame.
+    """
+
+    def __init__(self, interval_ms: float = 10, routes: dict = None, idle: bool = False):
+        self.interval = interval_ms / 1000
+        self.routes = routes or {}
+        self.idle = idle
+        self.samples = []
+        self._frames = {}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not _profiling.acquire(blocking=False):
+            raise Busy()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        _active_sql.clear()
+        _profiling.release()
+
+    def _run(self):
+        own = threading.get_ident()
+        previous = time.perf_counter()
+        while not self._stopping.wait(self.interval):
+            now = time.perf_counter()
+            weight, previous = (now - previous) * 1000, now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._sample(names.get(ident, str(ident)), ident, frame, weight)
+
+    def _frame(self, frame):
+        code = frame.f_code
+        if code not in self._frames:
+            module = frame.f_globals.get("__name__", "?")
+            self._frames[code] = (f"{module}.{code.co_name}", code.co_filename, code.co_firstlineno)
+        return self._frames[code]
+
+    def _sample(self, thread_name, ident, frame, weight):
+        if not self.idle and (frame.f_globals.get("__name__"), frame.f_code.co_name) in IDLE_FRAMES:
+            return
+
+        stack = []
+        route = None
+        while frame is not None:
+            stack.append(self._frame(frame))
+            # The outermost path operation on the stack. The same code runs in another thread for the dependencies of a request, unlabelled.
+            route = self.routes.get(frame.f_code, route)
+            frame = frame.f_back
+        stack.reverse()
+
+        if route is not None:
+            stack.insert(0, (route, None, None))
+        sql = _active_sql.get(ident)
+        if sql is not None:
+            stack.append((sql, None, None))
+        self.samples.append((thread_name, tuple(stack), weight))
+
+
+def collapsed(samples):
+    """Collapsed stacks: a line per distinct stack, with its frames separated by ";" (the thread first) and its count of samples."""
+    counts = {}
+    for thread_name, stack, _ in samples:
+        line = ";".join([thread_name] + [name.replace(";", ",") for name, _, _ in stack])
+        counts[line] = counts.get(line, 0) + 1
+    return "".join(f"{line} {count}\n" for line, count in sorted(counts.items()))
+
+
+def speedscope(samples, name: str):
+    """A speedscope file, with a sampled profile per thread. Samples are weighted by the time they stand for, in milliseconds."""
+    frames = []
+    indexes = {}
+    profiles = {}
+    for thread_name, stack, weight in samples:
+        stack_indexes = []
+        for frame in stack:
+            if frame not in indexes:
+                indexes[frame] = len(frames)
+                frame_name, file, line = frame
+                frames.append({"name": frame_name, "file": file, "line": line} if file else {"name": frame_name})
+            stack_indexes.append(indexes[frame])
+        profile = profiles.setdefault(thread_name, {"type": "sampled", "name": thread_name, "unit": "milliseconds",
+                                                    "startValue": 0, "endValue": 0, "samples": [], "weights": []})
+        profile["samples"].append(stack_indexes)
+        profile["weights"].append(weight)
+        profile["endValue"] += weight
+
+    return {"$schema": "https://www.speedscope.app/file-format-schema.json", "name": name, "exporter": "zocialli",
+            "shared": {"frames": frames}, "profiles": list(profiles.values())}
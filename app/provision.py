@@ -0,0 +1,118 @@
+# Command for creating many users at once (i.e. the accounts of a partner organisation), from a CSV file with the columns "email" and "password".
+# Creating them through "POST /users/" hashes the passwords one at a time (bcrypt is slow on purpose) and commits each user on its own.
+# Here the passwords are hashed on a pool of processes, one per core, and the users are inserted in batches.
+#
+# Safe to restart: each batch is committed on its own, users which already exist are skipped (before hashing their passwords),
+# and "ON CONFLICT (email) DO NOTHING" skips users created concurrently. Running it again after a crash picks up where it stopped.
+# The file holds passwords in plain text - delete it once the users are created.
+#
+# Run from the root of the project: "python -m app.provision users.csv [--batch-size 1000] [--workers 8]"
+
+import argparse
+import csv
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from pydantic import ValidationError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from . import models, schemas, utils, sharding
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def read_batches(rows, batch_size: int):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def provision(db: Session, rows, batch_size: int = 1000, executor=None, total: int = None):
+    """
+    Creates the users of the given rows (dicts with "email" and "password"), a batch at a time.
+    Passwords are hashed with "executor.map" (i.e. of a process pool), or in this process without an executor.
+    Returns the counts of users created, already existing, and rows which aren't valid.
+    """
+    counts = {"created": 0, "existing": 0, "invalid": 0}
+    started = time.perf_counter()
+    done = 0
+
+    for batch in read_batches(rows, batch_size):
+        # Validated as by "POST /users/". The last row of an email wins, if it's listed more than once.
+        users = {}
+        for number, row in enumerate(batch, start=done + 1):
+            try:
+                user = schemas.UserCreate(email=row.get("email"), password=row.get("password"))
+            except ValidationError as error:
+                counts["invalid"] += 1
+                logger.warning("Row %s is not valid, skipping it: %s", number,
+                               "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors()))
+                continue
+            users[user.email] = user.password
+
+        # Skipping the users which already exist before hashing, which is where all the time goes.
+        existing = {email for email, in db.query(models.User.email).filter(models.User.email.in_(list(users)))}
+        new_users = [(email, password) for email, password in users.items() if email not in existing]
+
+        passwords = [password for _, password in new_users]
+        hashes = executor.map(utils.hash, passwords, chunksize=max(1, len(passwords) // (4 * (os.cpu_count() or 1)))) \
+            if executor is not None else map(utils.hash, passwords)
+
+        created = []
+        if new_users:
+            created = db.execute(insert(models.User).values(
+                [{"email": email, "password": hashed, "shard": sharding.router.place(email)}
+                 for (email, _), hashed in zip(new_users, hashes)]).on_conflict_do_nothing(
+                index_elements=["email"]).returning(models.User)).all()
+        db.commit()
+        # Copied to the other shards, as "POST /users/" does (see app/sharding.py).
+        sharding.router.replicate_users(created)
+        created = len(created)
+
+        done += len(batch)
+        counts["created"] += created
+        counts["existing"] += len(users) - created
+        elapsed = time.perf_counter() - started
+        logger.info("%s rows%s: %s created, %s existing, %s invalid - %.1f rows/s",
+                    done, f" of {total} ({done / total:.0%})" if total else "", counts["created"], counts["existing"],
+                    counts["invalid"], done / elapsed)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Creates users from a CSV file with the columns \"email\" and \"password\".")
+    parser.add_argument("file")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Processes hashing passwords. Defaults to the number of cores.")
+    args = parser.parse_args()
+
+    # Counting the rows first, for reporting the progress. Cheap compared to hashing.
+    with open(args.file, newline="") as file:
+        total = sum(1 for _ in csv.DictReader(file))
+
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        with open(args.file, newline="") as file, ProcessPoolExecutor(max_workers=args.workers) as executor:
+            counts = provision(db, csv.DictReader(file), batch_size=args.batch_size, executor=executor, total=total)
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - started
+    logger.info("Done in %.1f s (%.1f users created/s): %s created, %s existing, %s invalid", elapsed,
+                counts["created"] / elapsed, counts["created"], counts["existing"], counts["invalid"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    main()
@@ -0,0 +1,113 @@
+# Module for purging deleted posts. Deleting a post only marks it as deleted ("deleted_at"), which hides it from all reads right away.
+# The purger removes the votes of the deleted posts afterwards, a small batch per transaction with a pause in between, and then the posts themselves.
+# Rather than deleting a post with all of its votes in one transaction, which holds its locks for seconds for a viral post.
+#
+# The likes of a purged vote are taken off the statistics (app/stats.py) in the same transaction as the vote is removed.
+# Run the purger in-process (started by app.main) or separately with: "python -m app.purger". It purges the deleted posts of every shard.
+
+import asyncio
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import models, stats
+from .config import settings
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+# Removing a batch of the votes of a post. Using the index "ix_votes_post_id" to find them.
+DELETE_VOTES = text("""
+    DELETE FROM votes WHERE post_id = :post_id AND user_id IN (
+        SELECT user_id FROM votes WHERE post_id = :post_id LIMIT :batch_size)
+    RETURNING user_id""")
+
+
+def purge(db: Session, batch_size: int = None):
+    """
+    Purges one batch: removes a batch of the votes of a deleted post, or the post itself once it has no votes left.
+    Returns the number of rows removed, 0 when there's nothing left to purge.
+    "SKIP LOCKED" allows several purgers to run concurrently, each purging another post.
+    """
+    # Posts deleted shortly before their month was archived (see app/partitions.py) are purged from the archive.
+    for model in (models.Post, models.ArchivedPost):
+        post = db.query(model).filter(model.deleted_at.isnot(None)).order_by(
+            model.deleted_at).with_for_update(skip_locked=True).first()
+        if post is not None:
+            break
+    if post is None:
+        db.rollback()
+        return 0
+
+    deleted_votes = db.execute(DELETE_VOTES, {"post_id": post.id,
+                               "batch_size": batch_size or settings.purge_batch_size}).all()
+    if deleted_votes:
+        deltas = stats.Deltas().add(post.users_id, likes_received=-len(deleted_votes))
+        for vote in deleted_votes:
+            deltas.add(vote.user_id, likes_given=-1)
+        deltas.apply(db)
+        removed = len(deleted_votes)
+    else:
+        # No votes left. The rest of the post (its hourly vote buckets and the metadata of its attachments) is small. Not removed by a cascade,
+        # as nothing references the partitioned "posts" by a foreign key (see app/models.py).
+        db.query(models.PostVoteBucket).filter(models.PostVoteBucket.post_id == post.id).delete(synchronize_session=False)
+        db.query(models.Attachment).filter(models.Attachment.post_id == post.id).delete(synchronize_session=False)
+        db.delete(post)
+        removed = 1
+
+    db.commit()
+    return removed
+
+
+def purge_once():
+    """Purges one batch on each shard. Returns the number of rows removed in all."""
+    return sum(sharding.router.for_each_shard(purge))
+
+
+class Purger:
+    """Background task purging deleted posts. Pauses for "purge_interval_ms" between batches, and polls when there's nothing to purge."""
+
+    def __init__(self):
+        self._task = None
+        self._stopping = None
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                removed = await run_in_threadpool(purge_once)
+            except Exception:
+                logger.exception("Purging deleted posts failed")
+                removed = 0
+
+            # Throttling, so purging doesn't compete with the requests for the DB - a short pause between batches, a longer one when idle.
+            pause = settings.purge_interval_ms if removed else settings.purge_poll_interval_ms
+            try:
+                await asyncio.wait_for(self._stopping.wait(), pause / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+
+purger = Purger()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        purger.start()
+        await purger._task
+
+    asyncio.run(main())
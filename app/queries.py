@@ -0,0 +1,137 @@
+# Module for the hot queries - the ones run on (nearly) every request. They're built once here, with bound parameters for the values,
+# rather than building a new "Query" for every call in the routers. Building a query in Python costs more than running a simple one in Postgres.
+# They're also marked with "prepare", so they're run as prepared statements (see app/prepared.py).
+#
+# Run them with the session, passing the values of the parameters: "db.execute(queries.user_by_id, {"id": id}).scalars().first()"
+
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from sqlalchemy import BigInteger, bindparam, cast, func, select
+from sqlalchemy.orm import aliased, selectinload
+
+from . import models
+
+# The number of characters of the content returned as "snippet" - truncated by Postgres, so the rest of the content is never sent from the DB.
+SNIPPET_LENGTH = 200
+
+# The columns which may be requested in the "fields" query parameter of the feed, of the posts or of the archived ones. "votes" and "owner" may be requested as well.
+def feed_fields(model):
+    return {
+        "id": model.id,
+        "title": model.title,
+        "content": model.content,
+        "snippet": func.left(model.content, SNIPPET_LENGTH),
+        "published": model.published,
+        "created_at": model.created_at,
+        "users_id": model.users_id,
+    }
+
+
+FEED_FIELDS = feed_fields(models.Post)
+
+
+# A parameter holding an id. The type of a parameter of a prepared statement is fixed when it's prepared - it would be "integer" for the id
+# columns, and ids out of its range (i.e. "/posts/89478956165") would fail, rather than not being found. Comparing with a bigint still uses the indexes.
+def id_parameter(name: str):
+    return cast(bindparam(name), BigInteger)
+
+
+# Deleted posts are hidden from every read until they're purged (see app/purger.py). All queries reading posts must filter with this.
+visible = models.Post.deleted_at.is_(None)
+
+
+# Counting the votes of a post in a correlated subquery (using the index "ix_votes_post_id"), so only the votes of the posts returned are counted.
+# Rather than joining the votes and grouping by post, which counts the votes of all posts before a limit is applied.
+def votes_of(model):
+    return select(func.count(models.Vote.post_id)).where(
+        models.Vote.post_id == model.id).scalar_subquery().label("votes")
+
+
+votes = votes_of(models.Post)
+
+# The archived posts (see app/partitions.py), only read when asked for ("archive=true"). Aliased as "Post", so their rows read like
+# the ones of "posts" (i.e. "row.Post.id"), and are validated by the same schemas.
+archived = aliased(models.ArchivedPost, name="Post")
+archived_visible = archived.deleted_at.is_(None)
+
+# The logged in user, on every authenticated request. Parameter: "id".
+user_by_id = select(models.User).where(
+    models.User.id == id_parameter("id")).execution_options(prepare=True)
+
+# The shard holding the posts of a user (see app/sharding.py). Parameter: "id".
+user_shard = select(models.User.shard).where(
+    models.User.id == id_parameter("id")).execution_options(prepare=True)
+
+# The metadata of the attachments of full posts, loaded for all the posts of a result with one more query (rather than one for each post).
+with_attachments = selectinload(models.Post.attachments)
+
+# A post with its vote count, and its attachments. Parameter: "id".
+post_with_votes = select(models.Post, votes).options(with_attachments).where(
+    models.Post.id == id_parameter("id"), visible).execution_options(prepare=True)
+
+# Only the version and vote count of a post, for its ETag. Parameter: "id".
+post_version = select(models.Post.version, votes).where(
+    models.Post.id == id_parameter("id"), visible).execution_options(prepare=True)
+
+# The same two for an archived post. Parameter: "id".
+archived_post_with_votes = select(archived, votes_of(archived)).options(selectinload(archived.attachments)).where(
+    archived.id == id_parameter("id"), archived_visible).execution_options(prepare=True)
+archived_post_version = select(archived.version, votes_of(archived)).where(
+    archived.id == id_parameter("id"), archived_visible).execution_options(prepare=True)
+
+# Whether a post exists (and isn't deleted), and its author (for the statistics), before voting on it. Parameter: "id".
+post_exists = select(models.Post.id, models.Post.users_id).where(
+    models.Post.id == id_parameter("id"), visible).execution_options(prepare=True)
+
+# The vote of a user on a post. Parameters: "post_id" and "user_id".
+vote_by_user_and_post = select(models.Vote).where(
+    models.Vote.post_id == id_parameter("post_id"), models.Vote.user_id == id_parameter("user_id")).execution_options(prepare=True)
+
+
+# The statistics of a user, for their profile. A user without statistics yet has none of anything. Parameter: "id".
+user_stats = select(models.User.id.label("users_id"),
+                    func.coalesce(models.UserStats.posts, 0).label("posts"),
+                    func.coalesce(models.UserStats.likes_received, 0).label("likes_received"),
+                    func.coalesce(models.UserStats.likes_given, 0).label("likes_given")).outerjoin(
+    models.UserStats, models.UserStats.users_id == models.User.id).where(models.User.id == id_parameter("id")).execution_options(prepare=True)
+
+
+def feed_page(fields: Optional[Tuple[str, ...]] = None, versions_only: bool = False, archive: bool = False):
+    """
+    A page of the feed, in the order the posts were created - by (created_at, id), as the ids group the posts by their author (see app/sharding.py).
+    The id breaks ties, so the same page always lists the same posts in the same order (needed for its ETag to mean anything).
+    Returns the full posts, or only the given fields (a tuple of names from "FEED_FIELDS", "votes" and "owner"), or only the (id, version, created_at, votes)
+    of the posts with "versions_only". Projections always select the id and version as well (as "etag_id" and "etag_version"), for the ETag,
+    and the creation time (as "order_created_at"), for merging the pages of the shards in the same order.
+    With "archive", the page is read from the archived posts instead - the feed with the archive is the merge of both pages.
+    Parameters: "limit", "skip" and "search" (matched anywhere in the title).
+
+    Built once for each combination of fields requested.
+    """
+    # Cached by the arguments as they're passed - passed the same way here, however they're passed by the caller.
+    return _feed_page(fields, versions_only, archive)
+
+
+@lru_cache(maxsize=256)
+def _feed_page(fields: Optional[Tuple[str, ...]], versions_only: bool, archive: bool):
+    post = archived if archive else models.Post
+    if versions_only:
+        columns = [post.id, post.version, post.created_at]
+    elif fields is None:
+        columns = [post]
+    else:
+        columns = [post.id.label("etag_id"), post.version.label("etag_version"), post.created_at.label("order_created_at")]
+        available = FEED_FIELDS if post is models.Post else feed_fields(post)
+        columns += [available[field].label(field) for field in fields if field in available]
+        if "owner" in fields:
+            columns += [models.User.id.label("owner_id"), models.User.email.label(
+                "owner_email"), models.User.created_at.label("owner_created_at")]
+
+    statement = select(*columns, votes_of(post))
+    if fields is None and not versions_only:
+        statement = statement.options(selectinload(post.attachments))
+    if fields is not None and "owner" in fields:
+        statement = statement.join(models.User, models.User.id == post.users_id)
+    return statement.where(post.deleted_at.is_(None), post.title.contains(bindparam("search"))).order_by(post.created_at, post.id).limit(
+        bindparam("limit")).offset(bindparam("skip")).execution_options(prepare=True)
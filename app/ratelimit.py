@@ -0,0 +1,293 @@
+# Module for rate limiting - rejecting clients sending too many requests with "429 Too Many Requests", before their requests cost anything.
+# "/login" runs bcrypt on every attempt, so without a limit a burst of guessed passwords (credential stuffing) is a CPU DoS as well.
+#
+# Each client has a token bucket for each route class (see app/admission.py): "burst" tokens, refilled at "per_minute" tokens a minute.
+# A request takes a token, and is rejected while the bucket is empty. Clients are told when to retry ("Retry-After").
+# Logged in clients are limited by their user (read from their token), others by their IP address. Login is always limited by IP address,
+# and by the account (the email) it's for - checked by the login route itself, before the password.
+# Behind a proxy, the IP address is the one of the proxy - run uvicorn with "--proxy-headers" (and "--forwarded-allow-ips") so it's the client's.
+#
+# The state of the buckets (a "backend"), chosen with "rate_limit_backend":
+# - "memory": in the process. With several uvicorn workers, a client gets the limits once for each worker.
+# - "shared": in a file mapped into memory by all the workers on the host ("rate_limit_shared_path", under /dev/shm by default), so the limits
+#   hold across workers. Unix only.
+# - "redis": in Redis (or any server speaking its protocol), so the limits hold across hosts. Needs the "redis" package ("pip install redis").
+#
+# Every check is O(1), and the state is bounded: "rate_limit_max_keys" buckets in memory (least recently used ones are dropped), a table
+# of a fixed size in the shared file, and keys expiring once their bucket would be full again in Redis. Dropping a bucket only forgets
+# a client's debt, it never rejects anyone.
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from jose import JWTError, jwt
+from starlette.responses import JSONResponse
+
+from .admission import classify
+from .config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows - the "shared" backend isn't available there.
+    fcntl = None
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:  # Optional - only needed for the "redis" backend.
+    redis = None
+
+# The outcome of taking a token. "retry_after" is the number of seconds until a token is available again, when not allowed.
+Decision = namedtuple("Decision", "allowed retry_after")
+
+# The settings holding the tokens a minute and the burst of each policy. Read on every check, so changed settings apply right away.
+POLICIES = {
+    "auth": ("rate_limit_auth_per_minute", "rate_limit_auth_burst"),
+    "write": ("rate_limit_write_per_minute", "rate_limit_write_burst"),
+    "read": ("rate_limit_read_per_minute", "rate_limit_read_burst"),
+    "login_account": ("rate_limit_login_account_per_minute", "rate_limit_login_account_burst"),
+}
+
+
+def refill(tokens: float, updated_at: float, now: float, rate: float, burst: int):
+    """Takes a token from a bucket. Returns the new number of tokens, and the seconds to wait for a token (0 if one was taken)."""
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend:
+    """The buckets in a dict of the process, in the order they were last used, so the least recently used ones are dropped first."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # Maps a key to [tokens, updated_at].
+        # Taken from the event loop (the middleware) and from the threadpool (the login route).
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: int) -> Decision:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            bucket[0], wait = refill(bucket[0], bucket[1], now, rate, burst)
+            bucket[1] = now
+        return Decision(wait == 0, wait)
+
+    async def take_async(self, key: str, rate: float, burst: int) -> Decision:
+        return self.take(key, rate, burst)
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedMemoryBackend:
+    """
+    The buckets in a file mapped into memory by every worker process, as a hash table of a fixed size. The table is split into sets of
+    "ways" slots, and a key may only be in the slots of its set (like a CPU cache) - so a check looks at 8 slots at most, and locks only its set
+    (a byte range lock of the file, plus a lock of the process, as byte range locks don't exclude the threads of a process from each other).
+    A new key takes an empty slot of its set, or the least recently used one.
+
+    A slot is the hash of the key (0 for an empty slot), the tokens left, and when it was last updated ("time.monotonic()" - the same clock
+    for all the processes of the host).
+    """
+
+    ways = 8
+    slot = struct.Struct("<Qdd")
+
+    def __init__(self, path: str, max_keys: int):
+        if fcntl is None:
+            raise RuntimeError("The shared rate limiting backend needs fcntl (Unix)")
+        self.sets = max(1, math.ceil(max_keys / self.ways))
+        size = self.sets * self.ways * self.slot.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # The first worker sizes the file. Growing a file fills it with zeros - empty slots.
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # Not "hash()", which differs from process to process.
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def take(self, key: str, rate: float, burst: int) -> Decision:
+        key_hash = self._hash(key)
+        start = (key_hash % self.sets) * self.ways * self.slot.size
+        length = self.ways * self.slot.size
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                now = time.monotonic()
+                found = victim = None
+                for offset in range(start, start + length, self.slot.size):
+                    slot_hash, tokens, updated_at = self.slot.unpack_from(self._map, offset)
+                    if slot_hash == key_hash:
+                        found = (offset, tokens, updated_at)
+                        break
+                    # Empty slots were never updated (0), so they're taken before any slot in use.
+                    if victim is None or updated_at < victim[1]:
+                        victim = (offset, updated_at)
+                if found is None:
+                    found = (victim[0], burst, now)
+                offset, tokens, updated_at = found
+                tokens, wait = refill(tokens, updated_at, now, rate, burst)
+                self.slot.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+        return Decision(wait == 0, wait)
+
+    async def take_async(self, key: str, rate: float, burst: int) -> Decision:
+        return self.take(key, rate, burst)
+
+    def reset(self):
+        with self._lock:
+            self._map[:] = bytes(len(self._map))
+
+
+class RedisBackend:
+    """
+    The buckets in Redis, as hashes of the tokens and the time of the last update, updated by a script (atomically, in one round trip).
+    The time is the one of the Redis server, so the clocks of the app servers don't matter. Keys expire once the bucket would be full again.
+    """
+
+    # KEYS[1]: the bucket. ARGV: the tokens a second, and the burst. Returns whether a token was taken, and the milliseconds to wait otherwise.
+    SCRIPT = """
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + (now - (tonumber(bucket[2]) or now)) * rate)
+        local allowed, wait = 0, math.ceil((1 - tokens) / rate * 1000)
+        if tokens >= 1 then
+            tokens, allowed, wait = tokens - 1, 1, 0
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+        return {allowed, wait}"""
+
+    prefix = "ratelimit:"
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise RuntimeError("The redis rate limiting backend needs the redis package: pip install redis")
+        # A client for the threadpool (the login route), and one for the event loop (the middleware).
+        self._script = redis.Redis.from_url(url).register_script(self.SCRIPT)
+        self._async_script = redis.asyncio.Redis.from_url(url).register_script(self.SCRIPT)
+
+    def take(self, key: str, rate: float, burst: int) -> Decision:
+        allowed, wait_ms = self._script(keys=[self.prefix + key], args=[rate, burst])
+        return Decision(bool(allowed), wait_ms / 1000)
+
+    async def take_async(self, key: str, rate: float, burst: int) -> Decision:
+        allowed, wait_ms = await self._async_script(keys=[self.prefix + key], args=[rate, burst])
+        return Decision(bool(allowed), wait_ms / 1000)
+
+    def reset(self):
+        client = self._script.registered_client
+        for key in client.scan_iter(self.prefix + "*"):
+            client.delete(key)
+
+
+class RateLimiter:
+    """The token buckets of the policies above, in the backend of the settings (created on first use)."""
+
+    def __init__(self):
+        self._backend = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    if settings.rate_limit_backend == "redis":
+                        self._backend = RedisBackend(settings.rate_limit_redis_url)
+                    elif settings.rate_limit_backend == "shared":
+                        self._backend = SharedMemoryBackend(settings.rate_limit_shared_path, settings.rate_limit_max_keys)
+                    else:
+                        self._backend = MemoryBackend(settings.rate_limit_max_keys)
+        return self._backend
+
+    @staticmethod
+    def _policy(name: str):
+        per_minute, burst = (getattr(settings, setting) for setting in POLICIES[name])
+        return per_minute / 60, burst
+
+    def take(self, policy: str, identity: str) -> Decision:
+        return self.backend.take(f"{policy}:{identity}", *self._policy(policy))
+
+    async def take_async(self, policy: str, identity: str) -> Decision:
+        return await self.backend.take_async(f"{policy}:{identity}", *self._policy(policy))
+
+    def reset(self):
+        if self._backend is not None:
+            self._backend.reset()
+
+
+limiter = RateLimiter()
+
+
+def too_many_requests(decision: Decision, detail: str = "Too many requests, please slow down"):
+    return JSONResponse({"detail": detail}, status_code=429, headers={"Retry-After": str(max(1, math.ceil(decision.retry_after)))})
+
+
+def identify(scope, route_class: str) -> str:
+    """Who a request is counted for: the user of a valid token (not for login), or else the IP address."""
+    if route_class != "auth":
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer":
+                    try:
+                        # Verified, or anyone could get fresh buckets by making up tokens.
+                        user_id = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm]).get("user_id")
+                    except JWTError:
+                        user_id = None
+                    if user_id is not None:
+                        return f"user:{user_id}"
+                break
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class RateLimitMiddleware:
+    """
+    Middleware rejecting requests with "429 Too Many Requests" and a "Retry-After" header once the bucket of the client is empty.
+    A plain ASGI middleware, like the admission control, so the requests being rejected cost as little as possible.
+    Only the route classes with a policy are limited - not the live streams, the probes or the admin endpoints.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.rate_limit_enabled:
+            await self.app(scope, receive, send)
+            return
+
+        route_class = classify(scope["method"], scope["path"])
+        if route_class in POLICIES:
+            decision = await limiter.take_async(route_class, identify(scope, route_class))
+            if not decision.allowed:
+                await too_many_requests(decision)(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,193 @@
+# Command for moving a user, with all their posts, to another shard (see app/sharding.py) - i.e. onto a shard added to spread the load,
+# or off a shard a popular user shares with many others. The posts are moved along with everything hanging off them (their votes,
+# their vote rollups, the metadata of their attachments and their outbox events waiting to be delivered), and their counts are moved from the statistics of one shard to the other.
+#
+# The posts stay readable during the move - from the old shard, until the user is switched to the new one. Writes wait for the move:
+# creating posts is answered with "503" and "Retry-After" once it's done, and votes waiting on it fail, and must be sent again.
+# Safe to run again after a crash: leftovers of an interrupted move (posts on a shard which isn't the one of the user) are removed.
+#
+# Run from the root of the project: "python -m app.rebalance move <users_id> <shard>"
+# Copying the users missing on the shards (i.e. on a new shard, before moving users to it): "python -m app.rebalance sync-users"
+
+import argparse
+import logging
+
+from sqlalchemy import BigInteger, cast, delete, func, insert, select, union_all, update
+from sqlalchemy.orm import Session
+
+from . import models, partitions, sharding, stats
+
+logger = logging.getLogger(__name__)
+
+# The post an outbox event is about. Events of posts, votes and rollups all name it "post_id".
+event_post_id = cast(models.OutboxEvent.payload["post_id"].astext, BigInteger)
+
+
+def add_counts(deltas: stats.Deltas, users_id: int, posts, votes, sign: int):
+    """Adds the statistics of posts (rows with "deleted_at") and their votes (rows with "user_id") to deltas, as "reconcile" counts them."""
+    deltas.add(users_id, posts=sign * sum(1 for post in posts if post["deleted_at"] is None), likes_received=sign * len(votes))
+    for vote in votes:
+        deltas.add(vote["user_id"], likes_given=sign)
+
+
+def remove_posts(db: Session, users_id: int):
+    """
+    Removes the posts of a user from a shard (archived ones as well), with their votes, rollups, attachments and outbox events,
+    and takes them off the statistics of the shard.
+    """
+    post_ids = [id for id, in db.execute(union_all(select(models.Post.id).where(models.Post.users_id == users_id),
+                                                   select(models.ArchivedPost.id).where(models.ArchivedPost.users_id == users_id)))]
+    if not post_ids:
+        return 0
+
+    # Plain statements - none of the rows are loaded into the session.
+    options = {"synchronize_session": False}
+    votes = db.execute(delete(models.Vote).where(models.Vote.post_id.in_(post_ids)).returning(
+        models.Vote.user_id), execution_options=options).mappings().all()
+    # Nothing references the partitioned posts by a foreign key (see app/models.py), so the rollups and the attachments are removed here.
+    for model in (models.PostVoteBucket, models.Attachment):
+        db.execute(delete(model).where(model.post_id.in_(post_ids)), execution_options=options)
+    posts = []
+    for model in (models.Post, models.ArchivedPost):
+        posts += db.execute(delete(model).where(model.id.in_(post_ids)).returning(
+            model.deleted_at), execution_options=options).mappings().all()
+    db.execute(delete(models.OutboxEvent).where(event_post_id.in_(post_ids)), execution_options=options)
+    deltas = stats.Deltas()
+    add_counts(deltas, users_id, posts, votes, -1)
+    deltas.apply(db)
+    return len(post_ids)
+
+
+def copy_rows(db: Session, table, rows, batch_size: int):
+    for start in range(0, len(rows), batch_size):
+        db.execute(insert(table), [dict(row) for row in rows[start:start + batch_size]])
+
+
+def move_user(router: sharding.ShardRouter, users_id: int, target: int, batch_size: int = 1000):
+    """
+    Moves a user and their posts to the target shard. Returns the number of posts moved.
+    Each step is a transaction on one shard, in this order: the copy on the target shard, the switch of the user on the main database,
+    and the removal from the old shard. The user is locked on the main database and on the old shard throughout, and their posts and votes
+    on the old shard, so nothing changes them in between.
+    """
+    if not 0 <= target < router.count:
+        raise ValueError(f"There's no shard {target}, there are {router.count} shards")
+
+    sessions = {}
+
+    def session(shard):
+        # The same session for the same shard, as two sessions would wait on each other's locks.
+        if shard not in sessions:
+            sessions[shard] = router.session(shard)
+        return sessions[shard]
+
+    def switch():
+        main.execute(update(models.User).where(models.User.id == users_id).values(shard=target))
+
+    main = session(0)
+    try:
+        source = main.execute(select(models.User.shard).where(models.User.id == users_id).with_for_update()).scalar()
+        if source is None:
+            raise ValueError(f"User {users_id} does not exist")
+
+        moved = 0
+        if source != target:
+            old, new = session(source), session(target)
+            # Waits for the posts being created on the old shard (they lock the user there as well), then locks the posts (which votes being
+            # added wait for) and the votes (which votes being removed wait for).
+            last_post_seq = old.execute(select(models.User.last_post_seq).where(models.User.id == users_id).with_for_update()).scalar()
+            posts = old.execute(select(models.Post.__table__).where(models.Post.users_id == users_id).order_by(
+                models.Post.id).with_for_update()).mappings().all()
+            # The archived posts are moved as well, into the partitions of their months on the new shard.
+            archived = old.execute(select(models.ArchivedPost.__table__).where(models.ArchivedPost.users_id == users_id).order_by(
+                models.ArchivedPost.id).with_for_update()).mappings().all()
+            post_ids = [post["id"] for post in posts + archived]
+            votes = old.execute(select(models.Vote.__table__).where(models.Vote.post_id.in_(post_ids)).with_for_update()).mappings().all()
+            buckets = old.execute(select(models.PostVoteBucket.__table__).where(
+                models.PostVoteBucket.post_id.in_(post_ids))).mappings().all()
+            # Only the metadata of the attachments - the files are shared by all shards.
+            attached = old.execute(select(models.Attachment.__table__).where(
+                models.Attachment.post_id.in_(post_ids))).mappings().all()
+            # Events being delivered are waited for. The ids of events are only unique on their shard, so they're numbered again on the new one.
+            events = old.execute(select(*[column for column in models.OutboxEvent.__table__.c if column.name != "id"]).where(
+                event_post_id.in_(post_ids)).with_for_update(of=models.OutboxEvent)).mappings().all()
+
+            # Copies left on the new shard by an interrupted move are replaced.
+            remove_posts(new, users_id)
+            copy_rows(new, models.Post.__table__, posts, batch_size)
+            partitions.copy_archived(new, archived, batch_size)
+            copy_rows(new, models.Vote.__table__, votes, batch_size)
+            copy_rows(new, models.PostVoteBucket.__table__, buckets, batch_size)
+            copy_rows(new, models.Attachment.__table__, attached, batch_size)
+            copy_rows(new, models.OutboxEvent.__table__, events, batch_size)
+            deltas = stats.Deltas()
+            add_counts(deltas, users_id, posts + archived, votes, 1)
+            deltas.apply(new)
+            # The user lives on the new shard from now on, and counts their posts there.
+            new.execute(update(models.User).where(models.User.id == users_id).values(
+                shard=target, last_post_seq=func.greatest(models.User.last_post_seq, last_post_seq)))
+            if target == 0:
+                switch()  # Along with the copy, on the main database.
+            new.commit()
+            moved = len(posts) + len(archived)
+
+            if source != 0 and target != 0:
+                switch()
+                main.commit()
+
+        # Removing the posts from the other shards - the old shard, and any left behind by an interrupted move. The copies of the user
+        # there no longer take posts, so posts waiting to be created there are answered with "503" and created on the new shard when retried.
+        for shard in range(router.count):
+            if shard != target:
+                db = session(shard)
+                removed = remove_posts(db, users_id)
+                if removed and shard != source:
+                    logger.warning("Removed %s posts of user %s left behind on shard %s", removed, users_id, shard)
+                db.execute(update(models.User).where(models.User.id == users_id).values(shard=target))
+                if shard == 0 and source == 0 and target != 0:
+                    switch()  # Along with the removal, on the main database.
+                db.commit()
+        main.commit()
+        return moved
+    finally:
+        for db in sessions.values():
+            db.close()
+
+
+def sync_users(router: sharding.ShardRouter, batch_size: int = 1000):
+    """Copies the users of the main database missing on the other shards. Returns the number of users read from the main database."""
+    db = router.session(0)
+    try:
+        last_id = 0
+        read = 0
+        while True:
+            users = db.execute(select(models.User).where(models.User.id > last_id).order_by(
+                models.User.id).limit(batch_size)).scalars().all()
+            if not users:
+                return read
+            router.replicate_users(users)
+            read += len(users)
+            last_id = users[-1].id
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Moves users between shards.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    move = commands.add_parser("move", help="Moves a user and their posts to another shard.")
+    move.add_argument("users_id", type=int)
+    move.add_argument("shard", type=int)
+    commands.add_parser("sync-users", help="Copies the users missing on the shards.")
+    args = parser.parse_args()
+
+    if args.command == "move":
+        moved = move_user(sharding.router, args.users_id, args.shard)
+        logger.info("Moved user %s and %s posts to shard %s", args.users_id, moved, args.shard)
+    else:
+        logger.info("Copied the users missing on the shards, of %s users", sync_users(sharding.router))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    main()
@@ -0,0 +1,329 @@
+# Module for the storage of users, posts and votes behind one interface (a "repository"), so routes using it don't depend on SQLAlchemy sessions.
+# Two backends with the same semantics, kept consistent by the contract tests (tests/test_repository.py):
+# - "SqlRepository", on a session of Postgres - the one used by the app (see "get_repository").
+# - "MemoryRepository", in the memory of the process, indexed like the tables are. For tests and benchmarks of the code around the storage,
+#   which then run without a database at all (i.e. overriding "get_repository" with it).
+#
+# Semantics both backends share:
+# - Emails of users are unique, and so is the vote of a user on a post. Breaking either raises "Conflict".
+#   Referring to a user or post which doesn't exist raises "NotFound".
+# - Deleting a user deletes their posts, their votes and the votes on their posts.
+# - Deleted posts ("delete_post" only marks them, see app/purger.py) are hidden from every read, and can't be voted on.
+# - Post ids hold their author, as made by app/sharding.py. The feed is in the order the posts were created, by (created_at, id), as on the shards.
+#
+# The routes of the users and of logging in run on the repository. The routes of posts and votes still run on the shards (see app/sharding.py),
+# as they depend on what only Postgres has - the scatter-gather over the shards, prepared statements, the outbox, the statistics deltas and
+# group commit. For them, the repository holds the same storage semantics, so code around the storage is tested and benchmarked in memory.
+#
+# The repository only stores. What goes along with a change (outbox events, statistics) is still up to the caller, in the same transaction.
+# Changes are committed with "commit" - until then, changes of the SQL backend are only visible to its own session.
+
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import Depends
+from sqlalchemy import delete, func, select, union, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import models, queries, sharding
+from .database import get_db
+
+# A post with its vote count - the shape of the rows of "queries.post_with_votes" and "queries.feed_page".
+PostVotes = namedtuple("PostVotes", ["Post", "votes"])
+
+
+class Conflict(Exception):
+    """Raised when a change breaks a unique constraint, i.e. an email already taken, or a post already voted on by the user."""
+
+
+class NotFound(Exception):
+    """Raised when a change refers to something which doesn't exist, i.e. a vote on a post which doesn't exist (or is deleted)."""
+
+
+class Repository(ABC):
+    """The operations on users, posts and votes, implemented by each backend. A backend missing any of them can't be created."""
+
+    @abstractmethod
+    def create_user(self, email: str, password: str, shard: int = 0) -> models.User:
+        ...
+
+    @abstractmethod
+    def get_user(self, id: int) -> Optional[models.User]:
+        ...
+
+    @abstractmethod
+    def get_user_by_email(self, email: str) -> Optional[models.User]:
+        ...
+
+    @abstractmethod
+    def delete_user(self, id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def create_post(self, users_id: int, title: str, content: str, published: bool = True) -> models.Post:
+        ...
+
+    @abstractmethod
+    def get_post(self, id: int) -> Optional[PostVotes]:
+        ...
+
+    @abstractmethod
+    def feed(self, limit: int = 25, skip: int = 0, search: str = "") -> List[PostVotes]:
+        ...
+
+    @abstractmethod
+    def update_post(self, id: int, title: str, content: str, published: bool = True) -> Optional[models.Post]:
+        ...
+
+    @abstractmethod
+    def delete_post(self, id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def add_vote(self, user_id: int, post_id: int):
+        ...
+
+    @abstractmethod
+    def remove_vote(self, user_id: int, post_id: int):
+        ...
+
+    @abstractmethod
+    def count_votes(self, post_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def commit(self):
+        ...
+
+
+class SqlRepository(Repository):
+    """
+    The repository on a session of Postgres (one shard - the main database by default). Uses the hot queries of app/queries.py.
+    Inserts run in a savepoint, so a conflict doesn't abort the rest of the transaction of the caller.
+    """
+
+    def __init__(self, db: Session, shard: int = 0):
+        self.db = db
+        self.shard = shard
+
+    def _insert(self, row):
+        try:
+            with self.db.begin_nested():
+                self.db.add(row)
+        except IntegrityError as error:
+            # "foreign_key_violation" - the row refers to a user or post which doesn't exist.
+            if error.orig.pgcode == "23503":
+                raise NotFound(str(error.orig)) from error
+            raise Conflict(str(error.orig)) from error
+        return row
+
+    def create_user(self, email: str, password: str, shard: int = 0) -> models.User:
+        return self._insert(models.User(email=email, password=password, shard=shard))
+
+    def get_user(self, id: int) -> Optional[models.User]:
+        return self.db.execute(queries.user_by_id, {"id": id}).scalars().first()
+
+    def get_user_by_email(self, email: str) -> Optional[models.User]:
+        return self.db.query(models.User).filter(models.User.email == email).first()
+
+    def delete_user(self, id: int) -> bool:
+        options = {"synchronize_session": False}
+        # The posts (archived or not) and the votes of the user go along with the user, as the foreign keys cascade. What hangs off their posts
+        # doesn't, as nothing references the partitioned posts by a foreign key (see app/models.py).
+        post_ids = union(select(models.Post.id).where(models.Post.users_id == id),
+                         select(models.ArchivedPost.id).where(models.ArchivedPost.users_id == id)).scalar_subquery()
+        for model in (models.Vote, models.PostVoteBucket, models.Attachment):
+            self.db.execute(delete(model).where(model.post_id.in_(post_ids)), execution_options=options)
+        return self.db.execute(delete(models.User).where(models.User.id == id), execution_options=options).rowcount > 0
+
+    def create_post(self, users_id: int, title: str, content: str, published: bool = True) -> models.Post:
+        post_id = sharding.next_post_id(self.db, users_id, self.shard)
+        if post_id is None:
+            raise NotFound(f"User {users_id} does not exist on shard {self.shard}")
+        return self._insert(models.Post(id=post_id, users_id=users_id, title=title, content=content, published=published))
+
+    def get_post(self, id: int) -> Optional[PostVotes]:
+        return self.db.execute(queries.post_with_votes, {"id": id}).first()
+
+    def feed(self, limit: int = 25, skip: int = 0, search: str = "") -> List[PostVotes]:
+        return self.db.execute(queries.feed_page(), {"limit": limit, "skip": skip, "search": search}).all()
+
+    def update_post(self, id: int, title: str, content: str, published: bool = True) -> Optional[models.Post]:
+        updated = self.db.execute(update(models.Post).where(models.Post.id == id, queries.visible).values(
+            title=title, content=content, published=published, version=models.Post.version + 1), execution_options={
+            "synchronize_session": False}).rowcount
+        if not updated:
+            return None
+        post = self.db.get(models.Post, id)
+        self.db.refresh(post)
+        return post
+
+    def delete_post(self, id: int) -> bool:
+        return self.db.execute(update(models.Post).where(models.Post.id == id, queries.visible).values(
+            deleted_at=func.now()), execution_options={"synchronize_session": False}).rowcount > 0
+
+    def add_vote(self, user_id: int, post_id: int):
+        if not self.db.execute(queries.post_exists, {"id": post_id}).first():
+            raise NotFound(f"Post {post_id} does not exist")
+        self._insert(models.Vote(user_id=user_id, post_id=post_id))
+
+    def remove_vote(self, user_id: int, post_id: int):
+        removed = self.db.execute(delete(models.Vote).where(models.Vote.user_id == user_id, models.Vote.post_id == post_id),
+                                  execution_options={"synchronize_session": False}).rowcount
+        if not removed:
+            raise NotFound(f"User {user_id} hasn't voted on post {post_id}")
+
+    def count_votes(self, post_id: int) -> int:
+        return self.db.query(func.count(models.Vote.post_id)).filter(models.Vote.post_id == post_id).scalar()
+
+    def commit(self):
+        self.db.commit()
+
+
+class MemoryRepository(Repository):
+    """
+    The repository in memory. Rows are the models (not attached to any session), indexed by everything they're looked up by,
+    as the tables are: users by id and email, posts by id, by (created_at, id) (kept in order, for the feed) and by author, votes by post and by user.
+    Changes are visible right away - "commit" does nothing. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_user_id = 0
+        self._users = {}  # Maps the id of a user to the user.
+        self._user_ids_by_email = {}
+        self._posts = {}  # Maps the id of a post to the post, deleted or not.
+        self._feed_keys = []  # The (created_at, id) of the posts, in order.
+        self._post_ids_by_user = {}  # Maps the id of a user to the set of the ids of their posts.
+        self._voters_by_post = {}  # Maps the id of a post to the set of the ids of the users who voted on it.
+        self._post_ids_by_voter = {}  # Maps the id of a user to the set of the ids of the posts they voted on.
+
+    def create_user(self, email: str, password: str, shard: int = 0) -> models.User:
+        with self._lock:
+            if email in self._user_ids_by_email:
+                raise Conflict(f"Key (email)=({email}) already exists")
+            self._last_user_id += 1
+            user = models.User(id=self._last_user_id, email=email, password=password, shard=shard,
+                               last_post_seq=0, created_at=datetime.now(timezone.utc))
+            self._users[user.id] = user
+            self._user_ids_by_email[email] = user.id
+            self._post_ids_by_user[user.id] = set()
+            self._post_ids_by_voter[user.id] = set()
+            return user
+
+    def get_user(self, id: int) -> Optional[models.User]:
+        return self._users.get(id)
+
+    def get_user_by_email(self, email: str) -> Optional[models.User]:
+        user_id = self._user_ids_by_email.get(email)
+        return None if user_id is None else self._users[user_id]
+
+    def delete_user(self, id: int) -> bool:
+        with self._lock:
+            user = self._users.pop(id, None)
+            if user is None:
+                return False
+            del self._user_ids_by_email[user.email]
+            # Cascading to the votes of the user, and to their posts (with the votes on them).
+            for post_id in self._post_ids_by_voter.pop(id):
+                self._voters_by_post[post_id].discard(id)
+            for post_id in self._post_ids_by_user.pop(id):
+                self._remove_post(post_id)
+            return True
+
+    def _remove_post(self, post_id: int):
+        post = self._posts.pop(post_id)
+        del self._feed_keys[bisect.bisect_left(self._feed_keys, (post.created_at, post_id))]
+        for user_id in self._voters_by_post.pop(post_id):
+            self._post_ids_by_voter[user_id].discard(post_id)
+
+    def _visible_post(self, id: int) -> Optional[models.Post]:
+        post = self._posts.get(id)
+        return post if post is not None and post.deleted_at is None else None
+
+    def create_post(self, users_id: int, title: str, content: str, published: bool = True) -> models.Post:
+        with self._lock:
+            user = self._users.get(users_id)
+            if user is None:
+                raise NotFound(f"User {users_id} does not exist")
+            user.last_post_seq += 1
+            post = models.Post(id=sharding.make_post_id(users_id, user.last_post_seq), users_id=users_id, title=title, content=content,
+                               published=published, created_at=datetime.now(timezone.utc), version=1, deleted_at=None)
+            post.owner = user
+            self._posts[post.id] = post
+            bisect.insort(self._feed_keys, (post.created_at, post.id))
+            self._post_ids_by_user[users_id].add(post.id)
+            self._voters_by_post[post.id] = set()
+            return post
+
+    def get_post(self, id: int) -> Optional[PostVotes]:
+        post = self._visible_post(id)
+        return None if post is None else PostVotes(post, len(self._voters_by_post[id]))
+
+    def feed(self, limit: int = 25, skip: int = 0, search: str = "") -> List[PostVotes]:
+        page = []
+        with self._lock:
+            for _, post_id in self._feed_keys:
+                post = self._posts[post_id]
+                if post.deleted_at is not None or search not in post.title:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                if len(page) == limit:
+                    break
+                page.append(PostVotes(post, len(self._voters_by_post[post_id])))
+        return page
+
+    def update_post(self, id: int, title: str, content: str, published: bool = True) -> Optional[models.Post]:
+        with self._lock:
+            post = self._visible_post(id)
+            if post is None:
+                return None
+            post.title, post.content, post.published = title, content, published
+            post.version += 1
+            return post
+
+    def delete_post(self, id: int) -> bool:
+        with self._lock:
+            post = self._visible_post(id)
+            if post is None:
+                return False
+            post.deleted_at = datetime.now(timezone.utc)
+            return True
+
+    def add_vote(self, user_id: int, post_id: int):
+        with self._lock:
+            if self._visible_post(post_id) is None:
+                raise NotFound(f"Post {post_id} does not exist")
+            if user_id not in self._users:
+                raise NotFound(f"User {user_id} does not exist")
+            voters = self._voters_by_post[post_id]
+            if user_id in voters:
+                raise Conflict(f"Key (user_id, post_id)=({user_id}, {post_id}) already exists")
+            voters.add(user_id)
+            self._post_ids_by_voter[user_id].add(post_id)
+
+    def remove_vote(self, user_id: int, post_id: int):
+        with self._lock:
+            voters = self._voters_by_post.get(post_id, set())
+            if user_id not in voters:
+                raise NotFound(f"User {user_id} hasn't voted on post {post_id}")
+            voters.remove(user_id)
+            self._post_ids_by_voter[user_id].discard(post_id)
+
+    def count_votes(self, post_id: int) -> int:
+        return len(self._voters_by_post.get(post_id, ()))
+
+    def commit(self):
+        pass
+
+
+# Dependency for the routes using the repository. Overridden with a "MemoryRepository" to run them without a database.
+def get_repository(db: Session = Depends(get_db)) -> Repository:
+    return SqlRepository(db)
@@ -0,0 +1,159 @@
+# Module for revoking access tokens before they expire (i.e. on logout). Every token has an id (the "jti" claim), and the ids of the revoked
+# tokens are stored in the "revoked_tokens" table - the denylist. Looking a token up there on every request would cost a query per request,
+# so each worker keeps the denylist in memory, as a set of the ids, and a token is checked with a lookup in that set.
+#
+# Each worker refreshes its copy every "revocation_refresh_ms", reading only the entries revoked since the last refresh (plus a margin, for
+# transactions committed late). A token revoked on one worker is refused by that worker right away, and by the others after their next refresh.
+# Entries are dropped from the copies once their token expires - an expired token is refused anyway - so the set only holds the tokens revoked
+# within the lifetime of a token. The expired rows of the table are removed periodically (i.e. from cron) with: "python -m app.revocation purge".
+#
+# Revoking all the tokens of a user ("/logout/all") doesn't go through the denylist, as the ids of the tokens aren't stored when issued.
+# Instead, "users.tokens_valid_after" is set, and tokens issued before it are refused - checked on the user loaded by every request anyway.
+
+import asyncio
+import heapq
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import models, sharding
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Denylist:
+    """
+    The ids of the revoked tokens which haven't expired yet, in memory. Reading is a lookup in a dict, without a lock (safe with the GIL).
+    A heap of the expiry times finds the entries to drop without looking at the others.
+    """
+
+    def __init__(self):
+        self._expires = {}  # Maps the id of a token to its expiry, in seconds since the epoch.
+        self._expiring = []  # (expiry, id), the soonest first.
+        self._lock = threading.Lock()
+        # The revocation time of the newest entry read from the DB. None until the denylist is first loaded.
+        self.synced_until = None
+
+    def __len__(self):
+        return len(self._expires)
+
+    def is_revoked(self, jti: str) -> bool:
+        return jti in self._expires
+
+    def add(self, jti: str, expires: float):
+        with self._lock:
+            if jti not in self._expires:
+                self._expires[jti] = expires
+                heapq.heappush(self._expiring, (expires, jti))
+
+    def expire(self, now: float = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._expiring and self._expiring[0][0] <= now:
+                _, jti = heapq.heappop(self._expiring)
+                del self._expires[jti]
+
+    def refresh(self, db: Session):
+        """Reads the entries revoked since the last refresh (all the entries which haven't expired, the first time), and drops the expired ones."""
+        entries = db.query(models.RevokedToken.jti, models.RevokedToken.expires_at, models.RevokedToken.revoked_at).filter(
+            models.RevokedToken.expires_at > func.now())
+        if self.synced_until is not None:
+            # Revocations are stamped with the start of their transaction, so one committed late may be older than the newest entry read.
+            entries = entries.filter(models.RevokedToken.revoked_at >= self.synced_until -
+                                     timedelta(seconds=settings.revocation_lookback_seconds))
+        for entry in entries:
+            self.add(entry.jti, entry.expires_at.timestamp())
+            if self.synced_until is None or entry.revoked_at > self.synced_until:
+                self.synced_until = entry.revoked_at
+        if self.synced_until is None:
+            # Nothing revoked yet. Later refreshes only read what's revoked from now on.
+            self.synced_until = db.query(func.now()).scalar()
+        self.expire()
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+            self._expiring.clear()
+            self.synced_until = None
+
+
+denylist = Denylist()
+
+
+def revoke(db: Session, jti: str, expires: float):
+    """Adds a token to the denylist. Takes effect on this worker once committed (the caller commits), and on the others after their next refresh."""
+    db.execute(insert(models.RevokedToken).values(jti=jti, expires_at=datetime.fromtimestamp(expires, timezone.utc)).on_conflict_do_nothing())
+
+
+def revoke_all(db: Session, users_id: int) -> bool:
+    """Revokes all the tokens of a user issued so far. Returns False if there's no such user. The caller commits."""
+    return bool(db.query(models.User).filter(models.User.id == users_id).update(
+        {"tokens_valid_after": datetime.now(timezone.utc)}, synchronize_session=False))
+
+
+def refresh_once():
+    # The denylist is on the main database.
+    db = sharding.router.session(0)
+    try:
+        denylist.refresh(db)
+    finally:
+        db.close()
+
+
+class Refresher:
+    """Background task refreshing the denylist of this worker every "revocation_refresh_ms"."""
+
+    def __init__(self):
+        self._task = None
+        self._stopping = None
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                await run_in_threadpool(refresh_once)
+            except Exception:
+                logger.exception("Refreshing the denylist of revoked tokens failed")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), settings.revocation_refresh_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+
+refresher = Refresher()
+
+
+def purge(db: Session):
+    """Removes the entries of the tokens which have expired. Returns the number of entries removed."""
+    removed = db.query(models.RevokedToken).filter(models.RevokedToken.expires_at <= func.now()).delete(synchronize_session=False)
+    db.commit()
+    return removed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if sys.argv[1:] != ["purge"]:
+        sys.exit("Usage: python -m app.revocation purge")
+    main = sharding.router.session(0)
+    try:
+        logger.info("Removed %s entries of expired tokens from the denylist", purge(main))
+    finally:
+        main.close()
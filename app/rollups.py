@@ -0,0 +1,124 @@
+# Module for the rollups of votes in buckets of time (the "post_vote_buckets" table), read by the analytics endpoints.
+# Each post has a bucket for every hour with votes, counting the likes given and taken back within it. The buckets are updated by the outbox worker,
+# from the "vote.created" and "vote.deleted" events - so the vote itself doesn't wait on (or contend for) the bucket of a popular post.
+#
+# Hourly buckets older than "rollup_hourly_retention_days" are compacted into daily buckets, keeping the table small.
+# Run the compaction periodically (i.e. from cron) with: "python -m app.rollups compact".
+# Buckets for votes given before the rollups existed are filled in once with: "python -m app.rollups backfill".
+# The buckets of a post are on the shard of the post (see app/sharding.py). Both jobs run on every shard.
+
+import logging
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from . import models, outbox
+from .config import settings
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+# Adding to the bucket of the hour a vote was given or taken back in (in UTC). Votes on posts deleted in the meantime are dropped.
+# Events written before the time was part of their payload are counted at the time they're delivered.
+ADD_TO_BUCKET = text("""
+    INSERT INTO post_vote_buckets (post_id, resolution, bucket_start, likes, unlikes)
+    SELECT id, 'hour', date_trunc('hour', coalesce(CAST(:at AS timestamptz), now()), 'UTC'), :likes, :unlikes
+    FROM posts WHERE id = :post_id
+    ON CONFLICT (post_id, resolution, bucket_start) DO UPDATE SET
+        likes = post_vote_buckets.likes + excluded.likes,
+        unlikes = post_vote_buckets.unlikes + excluded.unlikes""")
+
+# Moving a batch of hourly buckets older than ":before" into the daily buckets of their days. Returns a row per daily bucket written.
+COMPACT = text("""
+    WITH moved AS (
+        DELETE FROM post_vote_buckets WHERE (post_id, resolution, bucket_start) IN (
+            SELECT post_id, resolution, bucket_start FROM post_vote_buckets
+            WHERE resolution = 'hour' AND bucket_start < :before LIMIT :batch_size)
+        RETURNING post_id, bucket_start, likes, unlikes
+    )
+    INSERT INTO post_vote_buckets (post_id, resolution, bucket_start, likes, unlikes)
+    SELECT post_id, 'day', date_trunc('day', bucket_start, 'UTC'), sum(likes), sum(unlikes) FROM moved
+    GROUP BY post_id, date_trunc('day', bucket_start, 'UTC')
+    ON CONFLICT (post_id, resolution, bucket_start) DO UPDATE SET
+        likes = post_vote_buckets.likes + excluded.likes,
+        unlikes = post_vote_buckets.unlikes + excluded.unlikes
+    RETURNING post_id""")
+
+# Counting the votes given before the rollups existed (up to ":until") of a batch of posts into hourly buckets, by the time they were given.
+# Added to the buckets already counted from the events - a post voted on in the hour of the migration has a bucket for it already.
+# Votes taken back before the rollups existed aren't known anymore, so they're not counted at all.
+BACKFILL = text("""
+    INSERT INTO post_vote_buckets (post_id, resolution, bucket_start, likes)
+    SELECT post_id, 'hour', date_trunc('hour', created_at, 'UTC'), count(*) FROM votes
+    WHERE post_id = ANY(:post_ids) AND created_at <= :until
+    GROUP BY post_id, date_trunc('hour', created_at, 'UTC')
+    ON CONFLICT (post_id, resolution, bucket_start) DO UPDATE SET
+        likes = post_vote_buckets.likes + excluded.likes""")
+
+
+def now():
+    """The time of a vote, for the payload of its event."""
+    return datetime.now(timezone.utc).isoformat()
+
+
+@outbox.handler("vote.created")
+def count_like(db: Session, payload):
+    db.execute(ADD_TO_BUCKET, {"post_id": payload["post_id"], "at": payload.get("at"), "likes": 1, "unlikes": 0})
+
+
+@outbox.handler("vote.deleted")
+def count_unlike(db: Session, payload):
+    db.execute(ADD_TO_BUCKET, {"post_id": payload["post_id"], "at": payload.get("at"), "likes": 0, "unlikes": 1})
+
+
+def compact(db: Session, batch_size: int = 10000):
+    """
+    Compacts the hourly buckets of the days older than "rollup_hourly_retention_days" into daily buckets, a batch at a time
+    (each batch in a transaction of its own). Returns the number of daily buckets written.
+    """
+    before = db.execute(text("SELECT date_trunc('day', now() - make_interval(days => :days), 'UTC')"),
+                        {"days": settings.rollup_hourly_retention_days}).scalar()
+    written = 0
+    while True:
+        rows = db.execute(COMPACT, {"before": before, "batch_size": batch_size}).all()
+        db.commit()
+        if not rows:
+            return written
+        written += len(rows)
+
+
+def backfill(db: Session, batch_size: int = 1000):
+    """
+    Fills in the hourly buckets for the votes given before the rollups existed (see "RollupBackfill"), a batch of posts at a time.
+    Each batch is committed along with the last post counted, so the backfill can be stopped and run again - posts are never counted twice.
+    Returns the number of posts whose votes were counted.
+    """
+    state = db.query(models.RollupBackfill).with_for_update().first()
+    if state is None:  # A database created along with the rollups - there's nothing to backfill.
+        db.rollback()
+        return 0
+    posts = 0
+    while True:
+        # The posts with votes, archived ones as well.
+        post_ids = [id for id, in db.query(models.Vote.post_id).filter(
+            models.Vote.post_id > state.last_post_id, models.Vote.created_at <= state.votes_until).distinct().order_by(
+            models.Vote.post_id).limit(batch_size)]
+        if not post_ids:
+            db.commit()
+            return posts
+        db.execute(BACKFILL, {"post_ids": post_ids, "until": state.votes_until})
+        state.last_post_id = post_ids[-1]
+        db.commit()
+        posts += len(post_ids)
+        state = db.query(models.RollupBackfill).with_for_update().first()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    jobs = {"compact": compact, "backfill": backfill}
+    if len(sys.argv) != 2 or sys.argv[1] not in jobs:
+        sys.exit("Usage: python -m app.rollups compact|backfill")
+
+    logger.info("%s: %s", sys.argv[1], sharding.router.for_each_shard(jobs[sys.argv[1]]))
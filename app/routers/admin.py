@@ -0,0 +1,62 @@
+# Admin endpoints, for the users listed in the "admin_user_ids" setting.
+# "GET /admin/profile" profiles the worker handling the request (see app/profiler.py) - with several workers, repeat it to reach the one burning CPU.
+# The response names the worker by its process id.
+# "POST /admin/users/{id}/logout" revokes all the tokens of a user (i.e. an account taken over), see app/revocation.py.
+import asyncio
+import os
+import time
+from typing import Literal
+
+from fastapi import status, HTTPException, Depends, APIRouter, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+from sqlalchemy.orm import Session
+
+from .. import oauth2, profiler, revocation
+from ..database import get_db
+from ..config import settings
+
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["Admin"]
+)
+
+
+# Async, so it doesn't hold a thread of the threadpool while sampling. The profile covers the event loop and the threadpool alike.
+# The session the admin was read with is closed before sampling, so the DB connection is given back rather than held for the whole profile.
+@router.get("/profile")
+async def profile(request: Request, db: Session = Depends(get_db), current_user=Depends(oauth2.get_current_admin),
+                  seconds: float = Query(10, gt=0, le=settings.profiler_max_seconds),
+                  interval_ms: float = Query(settings.profiler_interval_ms, ge=1, le=1000),
+                  format: Literal["speedscope", "collapsed"] = "speedscope", idle: bool = False):
+    await run_in_threadpool(db.close)
+
+    sampler = profiler.Sampler(interval_ms, routes=profiler.route_labels(request.app), idle=idle)
+    try:
+        sampler.start()
+    except profiler.Busy:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="A profile is already being taken on this worker")
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+
+    name = f"worker-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}"
+    headers = {"X-Worker-Pid": str(os.getpid())}
+    if format == "collapsed":
+        headers["Content-Disposition"] = f'attachment; filename="{name}.collapsed.txt"'
+        return PlainTextResponse(profiler.collapsed(sampler.samples), headers=headers)
+    headers["Content-Disposition"] = f'attachment; filename="{name}.speedscope.json"'
+    return JSONResponse(profiler.speedscope(sampler.samples, name), headers=headers)
+
+
+@router.post("/users/{id}/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout_user(id: int, current_user=Depends(oauth2.get_current_admin), db: Session = Depends(get_db)):
+    if not revocation.revoke_all(db, id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"User with id: {id} does not exist")
+    db.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
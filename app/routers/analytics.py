@@ -0,0 +1,63 @@
+# Analytics of the votes, read from the rollups of app/rollups.py rather than from the raw votes. The counts are up to date with the
+# outbox - usually within a second of the vote. Periods reaching back further than the compacted hourly buckets are counted in whole days.
+import heapq
+from datetime import timedelta
+from typing import List, Literal
+
+from fastapi import status, HTTPException, Depends, APIRouter, Query
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .. import models, schemas, oauth2, queries
+from ..sharding import ShardSessions, get_shards
+from ..encoding import NegotiatedRoute
+
+
+router = APIRouter(
+    # Routes read the format of request bodies and responses (JSON or MessagePack) from the headers.
+    route_class=NegotiatedRoute,
+    prefix="/analytics",
+    tags=["Analytics"]
+)
+
+
+# The start of a period of the last given hours, including the current (incomplete) hour.
+def period_start(hours: int):
+    return func.date_trunc("hour", func.now(), "UTC") - timedelta(hours=hours - 1)
+
+
+# The likes given and taken back on a post, per hour (or per day) of the last given hours. Buckets without votes are left out.
+@router.get("/posts/{id}/votes", response_model=List[schemas.VoteBucket])
+def get_post_votes(id: int, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user),
+                   hours: int = Query(24, ge=1, le=24 * 90), resolution: Literal["hour", "day"] = "hour"):
+    # The buckets of a post are on its shard, along with the post.
+    db = shards.for_post(id)
+    if db is None or not db.execute(queries.post_exists, {"id": id}).first():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"post with id {id} does not exist")
+
+    # Hourly buckets are summed up into days for "day". Daily buckets (compacted) are returned as days for "hour" as well.
+    bucket = func.date_trunc(resolution, models.PostVoteBucket.bucket_start, "UTC")
+    return db.query(bucket.label("bucket_start"), func.sum(models.PostVoteBucket.likes).label("likes"),
+                    func.sum(models.PostVoteBucket.unlikes).label("unlikes")).filter(
+        models.PostVoteBucket.post_id == id, models.PostVoteBucket.bucket_start >= period_start(hours)).group_by(
+        bucket).order_by(bucket).all()
+
+
+# The posts with the most likes given within the last given hours. Only the buckets of the period are read, not the votes.
+# With several shards, the top posts of each shard are read, and merged - the top posts overall are among them.
+@router.get("/top-posts", response_model=List[schemas.TopPost])
+def get_top_posts(shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user),
+                  hours: int = Query(24, ge=1, le=24 * 90), limit: int = Query(10, ge=1, le=100)):
+    def top_posts(db: Session):
+        likes = func.sum(models.PostVoteBucket.likes)
+        return db.query(models.PostVoteBucket.post_id, likes.label("likes"),
+                        func.sum(models.PostVoteBucket.unlikes).label("unlikes")).join(
+            models.Post, models.Post.id == models.PostVoteBucket.post_id).filter(
+            models.PostVoteBucket.bucket_start >= period_start(hours), queries.visible).group_by(
+            models.PostVoteBucket.post_id).order_by(likes.desc(), models.PostVoteBucket.post_id).limit(limit).all()
+
+    results = shards.scatter(top_posts)
+    if len(results) == 1:
+        return results[0]
+    return heapq.nsmallest(limit, (row for rows in results for row in rows), key=lambda row: (-row.likes, row.post_id))
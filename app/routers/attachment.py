@@ -0,0 +1,113 @@
+# Files attached to posts (i.e. images), see app/attachments.py. Uploaded as the raw body of the request, with the type of the file
+# as "Content-Type" (i.e. "curl --data-binary @photo.jpg -H 'Content-Type: image/jpeg' .../posts/1/attachments?filename=photo.jpg"),
+# and downloaded by the SHA-256 of their content, which the posts list in "attachments".
+from typing import Optional
+
+from fastapi import status, HTTPException, Depends, APIRouter, Header, Path, Request
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from .. import models, schemas, oauth2, queries, attachments
+from ..config import settings
+from ..encoding import NegotiatedRoute
+from ..sharding import ShardSessions, get_shards
+
+router = APIRouter(
+    # Routes read the format of request bodies and responses (JSON or MessagePack) from the headers.
+    route_class=NegotiatedRoute,
+    prefix="/posts",
+    tags=["Attachments"]
+)
+
+# The SHA-256 of a file, as 64 hexadecimal characters. Nothing else is ever turned into a path of the storage.
+SHA256 = Path(..., regex="^[0-9a-f]{64}$")
+
+
+# The session of the shard of a post owned by the user. Only the author of a post may attach files to it.
+def owned_post(shards: ShardSessions, id: int, users_id: int) -> Session:
+    db = shards.for_post(id)
+    post = db.execute(queries.post_exists, {"id": id}).first() if db is not None else None
+    if not post:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"post with id {id} does not exist")
+    if post.users_id != users_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"You are NOT allowed to perform this action")
+    # Not holding a DB connection while the file is uploaded - it may take a while.
+    for session in {shards.db, db}:
+        session.rollback()
+    return db
+
+
+def save_attachment(db: Session, post_id: int, sha256: str, content_type: str, size: int, filename: Optional[str]):
+    # Attaching the same file to the same post again changes nothing.
+    inserted = db.execute(insert(models.Attachment).values(post_id=post_id, sha256=sha256, content_type=content_type, size=size,
+                                                           filename=filename).on_conflict_do_nothing().returning(models.Attachment.sha256)).first()
+    if inserted:
+        # The post lists its attachments, so its ETag changes along with them.
+        db.query(models.Post).filter(models.Post.id == post_id).update({"version": models.Post.version + 1}, synchronize_session=False)
+    db.commit()
+    attachment = db.get(models.Attachment, (post_id, sha256))
+    # Loaded here, in the threadpool, so returning it doesn't run a query on the event loop.
+    db.refresh(attachment)
+    if inserted:
+        attachments.submit_thumbnail(post_id, sha256, content_type)
+    return attachment
+
+
+# Async, so the body is streamed to disk as it arrives, rather than read whole before the path operation runs. The DB is used in the threadpool.
+@router.post("/{id}/attachments", status_code=status.HTTP_201_CREATED, response_model=schemas.Attachment)
+async def upload_attachment(id: int, request: Request, filename: Optional[str] = None, content_type: Optional[str] = Header(None),
+                            content_length: Optional[int] = Header(None), shards: ShardSessions = Depends(get_shards),
+                            current_user: int = Depends(oauth2.get_current_user)):
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type not in settings.attachment_content_types:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail=f"Files of type {media_type or 'unknown'} can't be attached. Allowed types are: {', '.join(settings.attachment_content_types)}")
+    too_large = HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                              detail=f"Attachments may be {settings.attachment_max_bytes} bytes at most")
+    # Refused before reading any of it, when the size is known up front.
+    if content_length is not None and content_length > settings.attachment_max_bytes:
+        raise too_large
+
+    db = await run_in_threadpool(owned_post, shards, id, current_user.id)
+    try:
+        sha256, size = await attachments.store_stream(request.stream())
+    except attachments.TooLarge:
+        raise too_large
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+
+    return await run_in_threadpool(save_attachment, db, id, sha256, media_type, size, filename)
+
+
+def find_attachment(shards: ShardSessions, id: int, sha256: str) -> models.Attachment:
+    db = shards.for_post(id)
+    attachment = db.query(models.Attachment).join(models.Post, models.Post.id == models.Attachment.post_id).filter(
+        models.Attachment.post_id == id, models.Attachment.sha256 == sha256, queries.visible).first() if db is not None else None
+    if attachment is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"post with id {id} has no attachment {sha256}")
+    return attachment
+
+
+# Downloading an attachment, or a part of it ("Range"). Cached by clients for good - the content of a hash never changes.
+@router.api_route("/{id}/attachments/{sha256}", methods=["GET", "HEAD"])
+def get_attachment(id: int, request: Request, sha256: str = SHA256, range: Optional[str] = Header(None),
+                   if_none_match: Optional[str] = Header(None), shards: ShardSessions = Depends(get_shards),
+                   current_user: int = Depends(oauth2.get_current_user)):
+    attachment = find_attachment(shards, id, sha256)
+    return attachments.file_response(attachment.sha256, attachment.content_type, range, if_none_match, request.method)
+
+
+# The thumbnail of an image attachment, as JPEG. "404" until it's made, and for files which aren't images.
+@router.api_route("/{id}/attachments/{sha256}/thumbnail", methods=["GET", "HEAD"])
+def get_attachment_thumbnail(id: int, request: Request, sha256: str = SHA256, range: Optional[str] = Header(None),
+                             if_none_match: Optional[str] = Header(None), shards: ShardSessions = Depends(get_shards),
+                             current_user: int = Depends(oauth2.get_current_user)):
+    attachment = find_attachment(shards, id, sha256)
+    if attachment.thumbnail_sha256 is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"attachment {sha256} has no thumbnail")
+    return attachments.file_response(attachment.thumbnail_sha256, "image/jpeg", range, if_none_match, request.method)
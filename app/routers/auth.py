@@ -1,19 +1,30 @@
 from fastapi import APIRouter, Depends, status, HTTPException, Response
+from sqlalchemy.orm import Session
 # For creating dependency for user credentials, rather than binding it to the custom made UserLogin schema.
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 
-from sqlalchemy.orm import Session
+from ..encoding import NegotiatedRoute
+from ..config import settings
+from ..repository import Repository, get_repository
+from .. import models, schemas, utils, oauth2, ratelimit, revocation
 from ..database import get_db
-from .. import schemas, models, utils, oauth2
 
 router = APIRouter(
+    # Routes read the format of request bodies and responses (JSON or MessagePack) from the headers.
+    route_class=NegotiatedRoute,
     tags=["Authentication"])
 
 
 @router.post("/login", response_model=schemas.Token)
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(
-        models.User.email == user_credentials.username).first()  # Oauth stores login as "username", so "email" field must be compared to "username" from Oauth2.
+def login(user_credentials: OAuth2PasswordRequestForm = Depends(), repository: Repository = Depends(get_repository)):
+    # Attempts on the same account are limited as well, before the password is checked (which runs bcrypt), whatever IP address they come from.
+    if settings.rate_limit_enabled:
+        decision = ratelimit.limiter.take("login_account", user_credentials.username.lower())
+        if not decision.allowed:
+            return ratelimit.too_many_requests(decision, "Too many login attempts for this account, please try again later")
+
+    # Oauth stores login as "username", so "email" field must be compared to "username" from Oauth2.
+    user = repository.get_user_by_email(user_credentials.username)
 
     if not user:
         raise HTTPException(
@@ -28,3 +39,24 @@ def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session =
     access_token = oauth2.create_access_token(data={"user_id": user.id})
 
     return {"access_token": access_token, "token_type": "bearer"}
+
+
+# Revokes the token of the request. Refused right away by this worker, and by the others once they've refreshed their denylist (see app/revocation.py).
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(token: schemas.TokenData = Depends(oauth2.get_current_token), current_user: models.User = Depends(oauth2.get_current_user),
+           db: Session = Depends(get_db)):
+    if token.jti is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="This token can't be revoked, log out everywhere instead")
+    revocation.revoke(db, token.jti, token.exp)
+    db.commit()
+    revocation.denylist.add(token.jti, token.exp)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+# Revokes all the tokens of the user issued so far, i.e. after a device was lost. Takes effect on every worker right away.
+@router.post("/logout/all", status_code=status.HTTP_204_NO_CONTENT)
+def logout_everywhere(current_user: models.User = Depends(oauth2.get_current_user), db: Session = Depends(get_db)):
+    revocation.revoke_all(db, current_user.id)
+    db.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,27 @@
+# Probes for the orchestrator (i.e. Kubernetes) and load balancers.
+# "/healthz" (liveness): the process is up and serving requests. Never touches the DB - a DB outage must not get every instance restarted.
+# "/readyz" (readiness): the app is warmed up (see app/warmup.py), and the DB can be reached through the pool without waiting.
+from fastapi import APIRouter, Depends, Response, status
+from sqlalchemy.orm import Session
+
+from ..database import get_db
+from ..warmup import readiness, is_database_ready
+
+
+router = APIRouter(tags=["Health"])
+
+
+@router.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+def readyz(response: Response, db: Session = Depends(get_db)):
+    if not readiness.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "warming up"}
+    if not is_database_ready(db):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "database unavailable"}
+    return {"status": "ready", "warmup_ms": round(readiness.warmup_ms)}
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from typing import List
+
+from .. import models, oauth2
+from ..database import get_db
+from ..live import hub, load_vote_counts
+
+router = APIRouter(
+    prefix="/live",
+    tags=["Live"]
+)
+
+# A comment line is sent when nothing else was sent for this long, so proxies don't close the idle connection.
+KEEP_ALIVE_SECONDS = 15
+
+
+# Server-Sent Events stream of vote counts, replacing polling "GET /posts/{id}". Each event holds the new counts of the posts changed since the last one.
+# The user is read once when the stream opens, so tokens revoked by logging out everywhere are refused as on any other route. The connection is given
+# back right after - the stream doesn't hold on to a DB connection.
+@router.get("/votes")
+async def vote_updates(request: Request, post_ids: List[int] = Query(..., max_items=100), db: Session = Depends(get_db),
+                       current_user: models.User = Depends(oauth2.get_current_user)):
+    await run_in_threadpool(db.close)
+
+    subscription = hub.subscribe(post_ids)
+
+    async def events():
+        try:
+            # Starting with the current counts, so the client is in sync before the first change arrives.
+            subscription.push(await run_in_threadpool(load_vote_counts, list(subscription.post_ids)))
+            while not await request.is_disconnected():
+                try:
+                    await asyncio.wait_for(subscription.ready.wait(), KEEP_ALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                counts = [{"post_id": post_id, "votes": votes}
+                          for post_id, votes in subscription.take().items()]
+                yield f"event: votes\ndata: {json.dumps(counts)}\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
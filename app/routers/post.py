@@ -1,21 +1,39 @@
 # For using HTTP statuscodes. Raising HTTP exceptions. For creating a response, Using Depends to bind Session to the DB object. APIRouter to route the API instance.
-from fastapi import status, HTTPException, APIRouter, Response, Depends
+from fastapi import status, HTTPException, APIRouter, Response, Depends, Header, Query
 
 # From 2 directories up, import models and schemas module from the respective directories and all of their content.
-from .. import models, schemas, oauth2
-from ..database import get_db  # For opening/closing connection to DB.
+from .. import models, schemas, oauth2, outbox, etags, queries, stats, sharding, group_commit
+# For the sessions of the shards holding the posts (see app/sharding.py). The main database session of the request is the first shard.
+from ..sharding import ShardSessions, get_shards
+from ..config import settings
+from ..encoding import NegotiatedRoute, NegotiatedResponse
+from ..queries import FEED_FIELDS  # The columns which may be requested in the "fields" query parameter of the feed.
+from ..singleflight import SingleFlight  # For sharing one query between identical concurrent requests for the feed.
 # For creating dependency with a user when creating a post. A user must be logged in before creating a post.
 from ..oauth2 import get_current_user
 
 from sqlalchemy.orm import Session  # For establishing a connectivity session.
-from sqlalchemy import func  # Enables function "count" for GROUP BY clause.
+from sqlalchemy import func  # For "now()", the time a post is deleted at.
+
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 
 # For use of optional fields. For use in returning all posts, in a list, as one post.
-from typing import Optional, List
+from typing import Optional, List, Literal
+
+
+# The fields of the compact "view=summary" projection, for list views.
+SUMMARY_FIELDS = ["id", "title", "snippet", "votes", "created_at", "users_id"]
+
+# The deepest offset of the feed. With several shards (and for the archive), each shard reads "skip + limit" rows to merge the page from,
+# so the offset is bounded along with the limit. Pages deeper than this are read with the cursors of "GET /users/{id}/posts".
+MAX_SKIP = 1000
 
 
 # Routing from this, using the APIRouter. These routes will be referenced in the main file.
 router = APIRouter(
+    # Routes read the format of request bodies and responses (JSON or MessagePack) from the headers.
+    route_class=NegotiatedRoute,
     # The prefix wanted to be included in all of the paths. This prefix allows it to be removed from each path function.
     prefix="/posts",
     tags=["Posts"]  # This will add a group named "Posts" in swaggerUI.
@@ -27,8 +45,10 @@ router = APIRouter(
 @router.get("/", response_model=List[schemas.PostVotes])  # Posts + votes
 # First accessing the "db" object, that creates a session to the DB via "get_db".
 # Anytime ORM queries to the DB is being made, the dependency must be passed in the path operation function to create a dependency.
-def get_posts(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
-              limit: int = 25, skip: int = 0, search: Optional[str] = ""):
+# Async, so requests waiting for the same page (see "feed_flight") wait on the event loop, rather than each holding a thread of the threadpool.
+async def get_posts(shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user),
+                    limit: int = Query(25, ge=1, le=100), skip: int = Query(0, ge=0, le=MAX_SKIP), search: Optional[str] = "", if_none_match: Optional[str] = Header(None),
+                    fields: Optional[str] = None, view: Literal["full", "summary"] = "full", archive: bool = False):
     '''
     Using SQL statements to make queries to the DB with the database drive:
     # Using the instance "cursor" to execute SQL statement.
@@ -41,18 +61,97 @@ def get_posts(db: Session = Depends(get_db), current_user: int = Depends(oauth2.
     # posts = db.query(models.Post).filter(
     #     models.Post.title.contains(search)).limit(limit).offset(skip).all()  # Also providing Limit and Offset as query parameters.
 
-    # Returning the data which is stored in the DB. FastAPI automatically converts it into JSON.
-    # Specifying the table to join, and then the column to do the join on. SQLAlchemy default join is LEFT INNER JOIN, so outer param must be specified.
-    # Using Count function, to count the post_id column as "votes", in the GROUP BY clause. LEFT OUTER joining on post id.
-    posts = db.query(models.Post, func.count(models.Vote.post_id).label("votes")).join(
-        models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).filter(
-        models.Post.title.contains(search)).limit(limit).offset(skip).all()
-    return posts
+    # A projection of the posts was requested, rather than the full posts. Only the requested columns are read and returned.
+    requested = None
+    if fields or view == "summary":
+        requested = fields.split(",") if fields else SUMMARY_FIELDS
+        unknown = set(requested) - set(FEED_FIELDS) - {"votes", "owner"}
+        if unknown:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Unknown fields: {', '.join(sorted(unknown))}. Allowed fields are: {', '.join(sorted(FEED_FIELDS))}, votes, owner")
+
+    # Identical requests get the same page, and share one query. The key holds everything the page depends on, normalized
+    # (so "search=" and no search are the same). Every logged in user sees all posts, so the scope of what's visible is the same for all.
+    # Only the recent posts are read by default - the archived ones (see app/partitions.py) are read along with them with "archive=true".
+    key = (limit, skip, search or "", tuple(requested) if requested else None, "all", archive)
+
+    # The client already has a copy of this page. Checking whether it's still current by reading only the versions and vote counts of the
+    # posts - not the content of the posts or their owners - and answering "304 Not Modified" without a body if it is.
+    # The connection the user was read with is given back first. Requests waiting for the same page wait on the event loop without holding
+    # a connection - only the request running the query checks one out again.
+    if if_none_match:
+        await run_in_threadpool(shards.release)
+        versions = await feed_flight.do(("versions",) + key, feed_versions, shards, limit, skip, search, archive)
+        etag = etags.feed_etag(versions)
+        if etags.matches(if_none_match, etag):
+            return etags.not_modified(etag)
+
+    # Returning the data which is stored in the DB, converted to JSON compatible data - shared as is by all requests for this page.
+    # The format (JSON or MessagePack) and the ETag depend on the request, so they're made for each of them.
+    await run_in_threadpool(shards.release)
+    items, versions = await feed_flight.do(key, load_feed, shards, limit, skip, search, requested, archive)
+    return NegotiatedResponse(items, headers={"ETag": etags.feed_etag(versions)})
+
+
+# Coalesces identical concurrent requests for the feed. See "feed_coalesce_ttl_ms" for keeping results for a moment after.
+feed_flight = SingleFlight(ttl_ms=settings.feed_coalesce_ttl_ms)
+
+
+# Reads the rows of a page of the feed. With several shards, each shard reads its first "skip + limit" posts (ordered by creation, see
+# "queries.feed_page"), and the page is cut from the merge of them (scatter-gather) - deep pages cost more there, as every shard reads all
+# the posts before the page. With the archive, the posts and the archived posts are read and merged the same way, on each shard.
+# "order_of" returns the (created_at, id) of a row - the order of the statements, which the rows are merged on.
+def feed_rows(shards: ShardSessions, statements, limit: int, skip: int, search: str, order_of):
+    if shards.count == 1 and len(statements) == 1:
+        return shards.db.execute(statements[0], {"limit": limit, "skip": skip, "search": search}).all()
+
+    def read(db: Session):
+        return sharding.merge([db.execute(statement, {"limit": skip + limit, "skip": 0, "search": search}).all()
+                               for statement in statements], key=order_of)
+    return sharding.merge(shards.scatter(read), key=order_of)[skip:skip + limit]
+
+
+# The statements reading a page of the feed - of the posts, and of the archived posts with "archive".
+def feed_statements(archive: bool, fields: Optional[List[str]] = None, versions_only: bool = False):
+    fields = tuple(fields) if fields else None
+    return [queries.feed_page(fields, versions_only, from_archive) for from_archive in ((False, True) if archive else (False,))]
+
+
+# The (id, version, votes) rows of the posts of a page of the feed - all that's needed for its ETag.
+def feed_versions(shards: ShardSessions, limit: int, skip: int, search: str, archive: bool = False):
+    rows = feed_rows(shards, feed_statements(archive, versions_only=True), limit, skip, search, lambda row: (row.created_at, row.id))
+    return [(row.id, row.version, row.votes) for row in rows]
+
+
+# Loads a page of the feed, as the full posts or as a projection of them with the requested fields.
+# Returns the items as JSON compatible data, and the (id, version, votes) rows of the posts for the ETag. Neither refers to the DB session.
+def load_feed(shards: ShardSessions, limit: int, skip: int, search: str, requested: Optional[List[str]], archive: bool = False):
+    if requested:
+        rows = feed_rows(shards, feed_statements(archive, requested), limit, skip, search, lambda row: (row.order_created_at, row.etag_id))
+        items = [project(row, requested) for row in rows]
+        return jsonable_encoder(items), [(row.etag_id, row.etag_version, row.votes) for row in rows]
+
+    posts = feed_rows(shards, feed_statements(archive), limit, skip, search, lambda row: (row.Post.created_at, row.Post.id))
+    # Validated with the response model here, as FastAPI would, since the items are returned in a response directly.
+    items = [schemas.PostVotes.from_orm(post) for post in posts]
+    return jsonable_encoder(items), [(post.Post.id, post.Post.version, post.votes) for post in posts]
+
+
+# Builds one item of a projection of the feed from a row, with the requested fields only. The owner is nested, as in the full posts.
+def project(row, fields: List[str]):
+    item = {}
+    for field in fields:
+        if field == "owner":
+            item["owner"] = {"id": row.owner_id, "email": row.owner_email,
+                             "created_at": row.owner_created_at}
+        else:
+            item[field] = getattr(row, field)
+    return item
 
 
 # 2nd param overriding the default statuscode of 200 with 201. Within the decorator the response model must be specified like below.
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.Post)
-def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def create_posts(post: schemas.PostCreate, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user)):
     '''
     # Inserting the values as parameters. "%s" represents a variable, and should function as placeholders for the values wanting to be entered.
     # The columns wanting to be inserted must then be provided as second parameter, each column specified. Columns are grabbed from the body of "post".
@@ -67,17 +166,53 @@ def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db), curren
     in case the table has like 50 fields that each needs to be specified individually like below in title=post.title, content=post.content etc."""
     # Since **post.dict just spreads out the schema from the body, and users_id is NOT a field that needs(or wants) to be provided in the schema,
     # users id must be retrieved from the current_user fuctions id field. As users_id is not a field in the schema, it must be specified here.
-    new_post = models.Post(users_id=current_user.id, **post.dict())
+    # The post is written to the shard of the user, with an id made from the id of the user (see app/sharding.py).
+    if settings.post_group_commit_enabled:
+        # Written and committed along with the posts created at the same time (see app/group_commit.py).
+        # The connection of the request (held since the user was read) is given back first, as the group is written on a connection of its own -
+        # otherwise each request waiting in a group holds one, and the pool can run out before the group gets its connection.
+        # The user is detached before, so its columns stay loaded for the response.
+        shards.db.expunge(current_user)
+        shards.db.close()
+        try:
+            created = group_commit.posts.create_post(current_user.shard, current_user.id, post.dict())
+        except group_commit.Timeout:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Your post could not be saved in time, check your posts before trying again", headers={"Retry-After": "1"})
+        if created is None:
+            posts_moving(current_user)
+        return {**created, "owner": current_user}
+
+    db = shards[current_user.shard]
+    post_id = sharding.next_post_id(db, current_user.id, current_user.shard)
+    if post_id is None:
+        db.rollback()
+        posts_moving(current_user)
+
+    new_post = models.Post(id=post_id, users_id=current_user.id, **post.dict())
     db.add(new_post)  # Must be specified to add changes to DB.
+    db.flush()  # Sends the INSERT without committing.
+    # Committed in the same transaction as the post. Side effects are run by the outbox worker, not on the request path.
+    outbox.enqueue(db, "post.created", post_id=new_post.id,
+                   users_id=new_post.users_id)
+    stats.update(db, current_user.id, posts=1)  # Counted in the statistics of the user, in the same transaction.
     db.commit()  # Must be specified to commit changes to DB.
     db.refresh(new_post)  # Works like SQL "RETURNING" statement.
     return new_post
 
 
+# The user is being moved to another shard, or wasn't copied to their shard yet. Their new posts are created once they're moved.
+def posts_moving(current_user: models.User):
+    sharding.router.replicate_users([current_user])
+    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail="Your posts are being moved, please try again", headers={"Retry-After": "1"})
+
+
 # Retreiving one particular post.
 @router.get("/{id}", response_model=schemas.PostVotes)
 # Performing a validation to ensure data entigrity.
-def get_post(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def get_post(id: int, response: Response, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user),
+             if_none_match: Optional[str] = Header(None), archive: bool = False):
     '''
     cursor.execute("""SELECT * FROM posts WHERE id = %s """, (str(id))
                    )  # To avoid any attacks, a placeholder is entered - placeholder may be modified using i.e. Postman. Must be converted back as a str, to show content, or it won't be able to be indexed.
@@ -88,26 +223,55 @@ def get_post(id: int, db: Session = Depends(get_db), current_user: int = Depends
 
     # post = db.query(models.Post).filter(models.Post.id == id).first()
 
-    post = db.query(models.Post, func.count(models.Vote.post_id).label("votes")).join(
-        models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).filter(models.Post.id == id).first()
+    # The session of the shard holding the post.
+    db = shards.for_post(id)
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"post with id {id} does not exist")
+
+    # Answering "304 Not Modified" if the client's copy is still current - only the version and vote count are needed to find out.
+    # Archived posts (see app/partitions.py) are only looked up with "archive=true", once the post isn't found among the recent ones.
+    if if_none_match:
+        version = db.execute(queries.post_version, {"id": id}).first()
+        if not version and archive:
+            version = db.execute(queries.archived_post_version, {"id": id}).first()
+        if version:
+            etag = etags.post_etag(id, version.version, version.votes)
+            if etags.matches(if_none_match, etag):
+                return etags.not_modified(etag)
+
+    # The post with its vote count, built once in app/queries.py.
+    post = db.execute(queries.post_with_votes, {"id": id}).first()
+    if not post and archive:
+        post = db.execute(queries.archived_post_with_votes, {"id": id}).first()
 
     if not post:  # If no post was found.
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,  # Referencing only, not creating an object.
                             detail=f"post with id {id} does not exist")  # 2nd param is the message. Raising an exception.
+
+    response.headers["ETag"] = etags.post_etag(
+        post.Post.id, post.Post.version, post.votes)
     return post
 
 
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_post(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def delete_post(id: int, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user)):
     '''
     cursor.execute(
         """DELETE FROM posts WHERE id = %s RETURNING * """, (str(id)))
     deleted_post = cursor.fetchone()  # To get the deleted post.
     conn.commit()  # Commiting the changes to the DB.
     '''
-    # First defining the query to search for the post to be deleted.
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    post = post_query.first()  # Then finding the actual post.
+    db = shards.for_post(id)
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"the post with id: {id} does not exist")
+
+    # First defining the query to search for the post to be deleted. Posts already deleted aren't found again.
+    post_query = db.query(models.Post).filter(
+        models.Post.id == id, queries.visible)
+    # Then finding the actual post. Locked, so a concurrent delete of the same post waits, and then doesn't find it anymore.
+    post = post_query.with_for_update().first()
 
     # Checking if post doesn't exists.
     if post == None:
@@ -119,8 +283,12 @@ def delete_post(id: int, db: Session = Depends(get_db), current_user: int = Depe
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail=f"You are NOT allowed to perform this action")
 
-    # Grabbing the ORIGINAL query for the post. Deleting the post.
-    post_query.delete(synchronize_session=False)  # This is default.
+    # Grabbing the ORIGINAL query for the post. Only marking the post as deleted, which hides it from all reads right away.
+    # The post and its votes (any number of them) are removed later in small batches by the purger (app/purger.py),
+    # so deleting a post takes the same time, however many votes it has. Its likes are taken off the statistics by the purger as well.
+    post_query.update({"deleted_at": func.now()}, synchronize_session=False)
+    stats.update(db, post.users_id, posts=-1)
+    outbox.enqueue(db, "post.deleted", post_id=id, users_id=post.users_id)
     db.commit()  # Committing changes to the DB.
 
     # This ensures the proper response, since no data should be sent back when returning status code 204.
@@ -128,14 +296,20 @@ def delete_post(id: int, db: Session = Depends(get_db), current_user: int = Depe
 
 
 @router.put("/{id}", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.Post)
-def update_post(id: int, updated_post: schemas.PostCreate, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def update_post(id: int, updated_post: schemas.PostCreate, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user)):
     '''
     cursor.execute("""UPDATE posts SET title = %s, content = %s WHERE id = %s RETURNING *""",
                    (post.title, post.content, str(id)))
     updated_post = cursor.fetchone()
     conn.commit()'''
+    db = shards.for_post(id)
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"the post with id: {id} does not exist")
+
     # Not running the query, just saving the query to variable.
-    post_query = db.query(models.Post).filter(models.Post.id == id)
+    post_query = db.query(models.Post).filter(
+        models.Post.id == id, queries.visible)
     post = post_query.first()  # Grabbing first post, if it exist.
 
     # Sending a meaningful error message, rather than "Internal Server Error".
@@ -150,7 +324,10 @@ def update_post(id: int, updated_post: schemas.PostCreate, db: Session = Depends
 
     # Chaining update method to the query run at first instance. Using the post schema, and return it as a dict, so that entries and columns doesn't get hardcoded here.
     # This will allow any desired value to be updated from i.e. Postman, without having to specify the value and entry here as hardcode.
-    post_query.update(updated_post.dict(), synchronize_session=False)
+    # Bumping the version, so the ETag of the post changes along with its content.
+    post_query.update({**updated_post.dict(), "version": models.Post.version + 1},
+                      synchronize_session=False)
+    outbox.enqueue(db, "post.updated", post_id=id, users_id=post.users_id)
     db.commit()
     # Running a query from the exact post_query object, and grabbing the first entry to modify.
     return post_query.first()
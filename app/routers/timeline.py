@@ -0,0 +1,52 @@
+# Following users, and the home timeline - the posts of the users followed, newest first (see app/timelines.py).
+from fastapi import status, HTTPException, Depends, APIRouter, Query, Response
+
+from .. import models, schemas, oauth2, timelines
+from ..sharding import ShardSessions, get_shards
+from ..encoding import NegotiatedRoute
+
+from typing import Optional
+
+
+router = APIRouter(
+    # Routes read the format of request bodies and responses (JSON or MessagePack) from the headers.
+    route_class=NegotiatedRoute,
+    tags=["Timeline"]
+)
+
+
+# The follows are on the main database, the session of the request.
+@router.post("/users/{id}/follow", status_code=status.HTTP_201_CREATED)
+def follow_user(id: int, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user)):
+    if id == current_user.id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="You can't follow yourself")
+    if not shards.db.query(models.User.id).filter(models.User.id == id).first():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"User with id: {id} does not exist")
+    if not timelines.follow(shards.db, current_user.id, id):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"User {current_user.email} already follows user {id}")
+    shards.db.commit()
+    return {"message": f"You are now following user {id}"}
+
+
+@router.delete("/users/{id}/follow", status_code=status.HTTP_204_NO_CONTENT)
+def unfollow_user(id: int, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user)):
+    if not timelines.unfollow(shards.db, current_user.id, id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"You don't follow user {id}")
+    shards.db.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+# The home timeline of the logged in user, paginated with a cursor like the posts of a user. Reads one range of the precomputed timeline,
+# plus the latest posts of the celebrities followed - never all the posts of everyone followed.
+@router.get("/timeline", response_model=schemas.PostVotesPage)
+def get_timeline(shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user),
+                 limit: int = Query(25, ge=1, le=100), cursor: Optional[str] = None):
+    try:
+        posts, next_cursor = timelines.home_page(shards, current_user.id, limit, cursor)
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    return {"data": posts, "next_cursor": next_cursor}
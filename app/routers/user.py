@@ -1,15 +1,22 @@
 # For using HTTP statuscodes. Raising HTTP exceptions. Using Depends to bind Session to the DB object. APIRouter to route the API instance.
-from fastapi import status, HTTPException, Depends, APIRouter
+from fastapi import status, HTTPException, Depends, APIRouter, Query
 
 # From 2 directories up, import models and schemas module from the respective directories and all of their content.
-from .. import models, schemas, utils
-from ..database import get_db  # For opening/closing connection to DB.
+from .. import models, schemas, utils, oauth2, queries, sharding
+from ..repository import Repository, Conflict, get_repository  # The storage of the users (see app/repository.py).
+from ..sharding import ShardSessions, get_shards
+from ..encoding import NegotiatedRoute
 
-from sqlalchemy.orm import Session  # For establishing a connectivity session.
+# "tuple_" is used for comparing (created_at, id) as one row value against the cursor.
+from sqlalchemy import func, select, tuple_
+
+from typing import Optional
 
 
 # Routing from this, using the APIRouter. These routes will be referenced in the main file.
 router = APIRouter(
+    # Routes read the format of request bodies and responses (JSON or MessagePack) from the headers.
+    route_class=NegotiatedRoute,
     # Prefix will add path to each route, and allow to remove that specified path in each function related to the route.
     prefix="/users",
     tags=["Users"]  # Grouping these operations together in SwaggerUI.
@@ -18,17 +25,21 @@ router = APIRouter(
 
 # Using the custom defined response model to specify which fields to return as response, when a request is made to User. This avoids returning the user password.
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+def create_user(user: schemas.UserCreate, repository: Repository = Depends(get_repository)):
 
     # First calling the custom defined hash function, which performs a hash. Pass in the column to be hashed, which is "password" in user schema.
     hashed_password = utils.hash(user.password)
     user.password = hashed_password  # Setting the column to hashed_password.
 
-    # Unpacking all fields from "user.dict".
-    new_user = models.User(**user.dict())
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    # The user is placed on a shard, which will hold their posts (see app/sharding.py).
+    try:
+        new_user = repository.create_user(user.email, user.password, shard=sharding.router.place(user.email))
+    except Conflict:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"User with email: {user.email} already exists")
+    repository.commit()
+    # Copied to the other shards, for the foreign keys and joins of the posts and votes there.
+    sharding.router.replicate_users([new_user])
 
     return new_user
 
@@ -36,12 +47,75 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 
 @router.get("/{id}", response_model=schemas.UserOut)
-def get_user(id: int, db: Session = Depends(get_db)):
-    # Querying User table and filtering to look for the user ID.
-    user = db.query(models.User).filter(models.User.id == id).first()
+def get_user(id: int, repository: Repository = Depends(get_repository)):
+    # Looking for the user ID.
+    user = repository.get_user(id)
 
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"User with id: {id} does not exist")
 
     return user
+
+
+# The statistics of a user, for their profile. Read from one row of "user_stats", which is kept up to date along with the posts and votes (see app/stats.py).
+# With several shards, each shard has a row counting what's on that shard, and they're summed up.
+@router.get("/{id}/stats", response_model=schemas.UserStats)
+def get_user_stats(id: int, shards: ShardSessions = Depends(get_shards)):
+    rows = shards.scatter(lambda db: db.execute(queries.user_stats, {"id": id}).first())
+
+    # Users are on every shard, so the main database is enough to tell whether the user exists.
+    if not rows[0]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"User with id: {id} does not exist")
+
+    if len(rows) == 1:
+        return rows[0]
+    return {"users_id": id, **{field: sum(getattr(row, field) for row in rows if row)
+                               for field in ("posts", "likes_received", "likes_given")}}
+
+
+# Listing the posts of one particular user, newest first. Uses keyset (cursor) pagination instead of "skip", so the DB never has to read and throw away
+# the rows of all previous pages - every page costs the same, no matter how deep the client has scrolled. Backed by the index "ix_posts_users_id_created_at_id".
+@router.get("/{id}/posts", response_model=schemas.PostVotesPage)
+def get_user_posts(id: int, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user),
+                   limit: int = Query(25, ge=1, le=100), cursor: Optional[str] = None):
+    # All the posts of the user are on their shard.
+    db = shards.for_user(id)
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"User with id: {id} does not exist")
+
+    # Counting the votes of each post in a correlated subquery. Only the posts of the requested page are counted, rather than grouping all posts of the user.
+    votes = select(func.count(models.Vote.post_id)).where(
+        models.Vote.post_id == models.Post.id).scalar_subquery().label("votes")
+
+    posts_query = db.query(models.Post, votes).options(queries.with_attachments).filter(
+        models.Post.users_id == id, queries.visible)
+
+    if cursor:
+        try:
+            created_at, post_id = utils.decode_cursor(cursor)
+        except ValueError as error:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+        # Only the posts older than the last post of the previous page.
+        posts_query = posts_query.filter(
+            tuple_(models.Post.created_at, models.Post.id) < tuple_(created_at, post_id))
+
+    # Fetching one extra post, to find out whether there's a next page without running a separate count query.
+    posts = posts_query.order_by(models.Post.created_at.desc(),
+                                 models.Post.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last_post = posts[-1].Post
+        next_cursor = utils.encode_cursor(last_post.created_at, last_post.id)
+
+    # An empty first page might mean the user doesn't exist at all. Only checking then, to avoid the extra query on every page.
+    if not posts and not cursor and not shards.db.query(models.User.id).filter(models.User.id == id).first():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"User with id: {id} does not exist")
+
+    return {"data": posts, "next_cursor": next_cursor}
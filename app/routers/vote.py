@@ -1,26 +1,46 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
+from fastapi import Response, status, HTTPException, Depends, APIRouter
 
 # From 2 directories above, import modules.
-from .. import models, schemas, oauth2
-from ..database import get_db
-from sqlalchemy.orm import Session
+from .. import models, schemas, oauth2, outbox, live, queries, stats, rollups
+from ..config import settings
+from ..sharding import ShardSessions, get_shards
+from ..encoding import NegotiatedRoute
+from ..vote_buffer import buffer, BufferFull
 
 router = APIRouter(
+    # Routes read the format of request bodies and responses (JSON or MessagePack) from the headers.
+    route_class=NegotiatedRoute,
     prefix="/votes",
     tags=["Votes"]
 )
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-def vote(vote: schemas.Vote, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def vote(vote: schemas.Vote, response: Response, shards: ShardSessions = Depends(get_shards), current_user: int = Depends(oauth2.get_current_user)):
+
+    # The votes of a post are stored along with it, on its shard (see app/sharding.py).
+    db = shards.for_post(vote.post_id)
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"The post with no. {vote.post_id} does not exist")
 
     # Querying for the post based on Post id and compare with the votes post_id to ensure the post exists, before being able to upvote/downvote it.
-    post = db.query(models.Post).filter(models.Post.id == vote.post_id).first()
+    post = db.execute(queries.post_exists, {"id": vote.post_id}).first()
 
     if not post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"The post with no. {vote.post_id} does not exist")
 
+    # Buffered mode. The vote is written later along with other votes, so it's only accepted here - see app/vote_buffer.py for what that guarantees.
+    if settings.vote_buffer_enabled:
+        try:
+            buffer.add(current_user.id, vote.post_id, vote.dir)
+        except BufferFull:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many votes waiting to be saved", headers={"Retry-After": "1"})
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Your vote has been accepted, and will be saved shortly", "acknowledged": "buffered"}
+
     # Building up the query, and not actually performing it here.
     # Querying to see if the vote/like already exists or not - if the user has or has not already voted to avoid multiple upvotes on same post.
     # Taking "Vote" table, and filtering the tables' "post_id" column to compare the id of the post_id entered.
@@ -28,7 +48,8 @@ def vote(vote: schemas.Vote, db: Session = Depends(get_db), current_user: int =
     vote_query = db.query(models.Vote).filter(
         models.Vote.post_id == vote.post_id, models.Vote.user_id == current_user.id)
 
-    found_vote = vote_query.first()
+    found_vote = db.execute(queries.vote_by_user_and_post, {
+                            "post_id": vote.post_id, "user_id": current_user.id}).first()
     # If the user wants to like a post, but the upvote already exists, the user won't be permitted to upvote again.
     if (vote.dir == 1):
         if found_vote:
@@ -39,6 +60,12 @@ def vote(vote: schemas.Vote, db: Session = Depends(get_db), current_user: int =
         # Then grabbing the user_id field and setting the id to the currently authenticated and logged in users id.
         new_vote = models.Vote(post_id=vote.post_id, user_id=current_user.id)
         db.add(new_vote)  # Adding the vote to the db.
+        # The time is part of the event, for counting the vote in the bucket of the right hour (see app/rollups.py).
+        outbox.enqueue(db, "vote.created", post_id=vote.post_id,
+                       user_id=current_user.id, at=rollups.now())
+        # A like given by the user, and received by the author of the post.
+        stats.Deltas().add(current_user.id, likes_given=1).add(post.users_id, likes_received=1).apply(db)
+        live.publish_vote_change(db, vote.post_id)  # Sent to the subscribers of the post once committed.
         db.commit()
         return {"message": "<3 You have liked this post <3"}
     else:
@@ -46,7 +73,14 @@ def vote(vote: schemas.Vote, db: Session = Depends(get_db), current_user: int =
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="You haven't upvoted this post yet")
 
-        # If the vote/like was found, delete it.
-        vote_query.delete(synchronize_session=False)
+        # If the vote/like was found, delete it. Only counted if this request deleted it - a concurrent unlike may have deleted it since it was found.
+        if vote_query.delete(synchronize_session=False) != 1:
+            db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="You haven't upvoted this post yet")
+        outbox.enqueue(db, "vote.deleted", post_id=vote.post_id,
+                       user_id=current_user.id, at=rollups.now())
+        stats.Deltas().add(current_user.id, likes_given=-1).add(post.users_id, likes_received=-1).apply(db)
+        live.publish_vote_change(db, vote.post_id)
         db.commit()
         return {"message": "</3 You no longer like this post </3"}
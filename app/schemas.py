@@ -3,7 +3,7 @@ from pydantic.types import conint
 from datetime import datetime  # For use in field of created_at
 
 # For providing optional ID field in the Token Data payload.
-from typing import Optional
+from typing import Optional, List
 
 # Extending from Pydantic, Basemodel. Used for defining the construction of a post when receiving POST request from the frontend.
 # A Pydantic schema defines the structure of a request and response. This ensures that when a post is created, the request will only go through if the defined fields are included.
@@ -45,6 +45,60 @@ class UserOut(BaseModel):
         orm_mode = True
 
 
+class UserStats(BaseModel):
+    """
+    This is the response with the statistics of a user, shown in their profile.
+    """
+    users_id: int
+    posts: int
+    likes_received: int
+    likes_given: int
+
+    class Config:
+        orm_mode = True
+
+
+class VoteBucket(BaseModel):
+    """
+    This is a class for one bucket of time of the votes of a post - the likes given and taken back within it.
+    """
+    bucket_start: datetime
+    likes: int
+    unlikes: int
+
+    class Config:
+        orm_mode = True
+
+
+class TopPost(BaseModel):
+    """
+    This is a class for one of the posts with the most likes within a period of time.
+    """
+    post_id: int
+    likes: int
+    unlikes: int
+
+    class Config:
+        orm_mode = True
+
+
+class Attachment(BaseModel):
+    """
+    This is a class for the metadata of a file attached to a post. The file is downloaded from "/posts/{post_id}/attachments/{sha256}",
+    and its thumbnail (once "thumbnail_sha256" is set) from ".../thumbnail".
+    """
+    post_id: int
+    sha256: str
+    content_type: str
+    size: int
+    filename: Optional[str]
+    thumbnail_sha256: Optional[str]
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
 class Post(PostBase):
     """
     This is a class for handling data when data is sent to the user. A response.
@@ -55,6 +109,8 @@ class Post(PostBase):
     users_id: int
     # Returned as a dict. Sending UserOut also, since the name/username/owner of the post is wanted attached for each post, and not just their user id.
     owner: UserOut  # Owner is defined as a property in the "Post" schema.
+    # The metadata of the files attached to the post. The files themselves are downloaded separately.
+    attachments: List[Attachment] = []
 
     # This must be specified in this response class, much like metadata, since the data is NOT a dict.
     # Pydantic needs this config and is forced to read it as it is, as Pydantic only reads dicts - because ORMs are not dicts.
@@ -77,6 +133,15 @@ class PostVotes(BaseModel):
         orm_mode = True
 
 
+class PostVotesPage(BaseModel):
+    """
+    This is a class for returning one page of posts with their upvotes, when paginating with a cursor.
+    "next_cursor" must be passed back as the "cursor" query parameter to get the next page. It is None on the last page.
+    """
+    data: List[PostVotes]
+    next_cursor: Optional[str] = None
+
+
 class UserCreate(BaseModel):
     """
     This is a schema for when creating a new user. The user must provide specified fields, when creating a user.
@@ -107,6 +172,10 @@ class TokenData(BaseModel):
     This is a schema for the token data. Making sure the embedded into the access token.
     """
     id: Optional[str] = None  # Is optional.
+    # The id of the token, when it was issued, and when it expires (as seconds since the epoch). Tokens issued before these claims were added have no id or time of issue.
+    jti: Optional[str] = None
+    iat: Optional[float] = None
+    exp: Optional[float] = None
 
 
 class Vote(BaseModel):
@@ -0,0 +1,223 @@
+# Module for sharding the posts and votes across several Postgres databases ("shards"), once a single database is the ceiling.
+# Every shard is a complete database of the app, migrated by alembic along with the main database (see alembic/env.py).
+# Shard 0 is the main database (the "database_*" settings), the others are listed in "shard_database_urls". With none listed (the default)
+# everything is on the main database, and nothing below costs an extra query.
+#
+# What lives where:
+# - The posts of a user live on the shard of the user ("users.shard" on the main database, chosen when the user is created).
+#   Everything hanging off a post lives along with it - its votes, its vote rollups and its outbox events - so voting is still one local transaction.
+# - Users live on the main database, which is the only one used for logging in. They're copied to every other shard as well (a "reference table"),
+#   so the posts and votes of a shard keep their foreign keys, and the owners of the posts are still joined on the shard.
+# - The statistics of a user (app/stats.py) are kept on each shard, counting what's on that shard, and are summed up when read.
+#
+# Ids: the id of a post holds the id of its author, so the shard of a post is found from its id alone (through the shard of its author):
+# 2^52 + users_id * 2^21 + n, for the n-th post of the user. Unique across all shards, and below 2^53, so JavaScript clients still read
+# the ids exactly. A user may create up to 2^21 - 1 posts. "n" is counted by "users.last_post_seq" on the shard of the user, in the same
+# transaction as the post - the copy of the user on that shard also knows it's the shard of the user ("users.shard"), so a post is never
+# created on a shard the user has just been moved away from.
+# Posts created before the ids were made this way (numbered by "posts_id_seq", below 2^52) are looked up on every shard.
+#
+# Moving a user and their posts to another shard: "python -m app.rebalance", see there.
+
+import heapq
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import List, Optional
+
+from fastapi import Depends
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import models, prepared, queries
+from .admission import TimedQueuePool, apply_statement_timeout
+from .config import settings
+from .database import SessionLocal, get_db, get_engine
+
+POST_ID_BASE = 1 << 52
+POST_SEQ_BITS = 21
+
+# Counting the post of a user on their shard, for the id of the post. Nothing is returned if the user isn't on this shard (anymore).
+# Locks the row of the user until the transaction ends, which is what the rebalancing waits for (and the other way around).
+NEXT_POST_SEQ = text("UPDATE users SET last_post_seq = last_post_seq + 1 WHERE id = :id AND shard = :shard RETURNING last_post_seq")
+
+
+def make_post_id(users_id: int, seq: int):
+    if not 0 < seq < 1 << POST_SEQ_BITS:
+        raise ValueError(f"User {users_id} has created too many posts")
+    return POST_ID_BASE + (users_id << POST_SEQ_BITS) + seq
+
+
+def next_post_id(db: Session, users_id: int, shard: int) -> Optional[int]:
+    """The id of the next post of a user, counted on the session of their shard. None if the user isn't (or no longer) on that shard."""
+    seq = db.execute(NEXT_POST_SEQ, {"id": users_id, "shard": shard}).scalar()
+    return None if seq is None else make_post_id(users_id, seq)
+
+
+def post_owner(post_id: int) -> Optional[int]:
+    """The id of the author of a post, read from its id. None for the posts numbered by the sequence, before the ids held their author."""
+    if post_id < POST_ID_BASE:
+        return None
+    return (post_id - POST_ID_BASE) >> POST_SEQ_BITS
+
+
+def merge(results, key, reverse: bool = False):
+    """Merges lists of rows sorted by a unique key (i.e. the pages of the feed of each shard) into one sorted list, in one pass (a k-way merge).
+    A row found on two shards (left behind by an interrupted rebalancing) is only kept once. "reverse" for lists sorted in descending order."""
+    merged = []
+    for row in heapq.merge(*results, key=key, reverse=reverse):
+        if not merged or key(merged[-1]) != key(row):
+            merged.append(row)
+    return merged
+
+
+class ShardRouter:
+    """
+    The engines of the shards, created on first use like the engine of the main database. Each has a pool of its own,
+    with the same settings, running the hot queries as prepared statements and with the statement timeouts of the route classes.
+    """
+
+    def __init__(self, urls: List[str] = None, main_engine=None):
+        self.urls = list(settings.shard_database_urls if urls is None else urls)
+        self._main_engine = main_engine
+        self._engines = {}
+        self._sessionmakers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return 1 + len(self.urls)
+
+    def place(self, email: str):
+        """The shard of a new user. Spread by a hash of the email, as the id isn't known before the user is inserted."""
+        return zlib.crc32(email.encode()) % self.count
+
+    def engine(self, shard: int):
+        if shard == 0:
+            return self._main_engine or get_engine()
+        if shard not in self._engines:
+            with self._lock:
+                if shard not in self._engines:
+                    engine = create_engine(self.urls[shard - 1], poolclass=TimedQueuePool,
+                                           pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow)
+                    prepared.install(engine)
+                    self._engines[shard] = engine
+        return self._engines[shard]
+
+    def session(self, shard: int) -> Session:
+        if shard == 0 and self._main_engine is None:
+            return SessionLocal()
+        if shard not in self._sessionmakers:
+            maker = sessionmaker(autocommit=False, autoflush=False, bind=self.engine(shard))
+            event.listen(maker, "after_begin", apply_statement_timeout)
+            self._sessionmakers[shard] = maker
+        return self._sessionmakers[shard]()
+
+    def for_each_shard(self, function):
+        """Runs a function with a session on each shard in turn (i.e. a background job). Returns the list of the results."""
+        results = []
+        for shard in range(self.count):
+            db = self.session(shard)
+            try:
+                results.append(function(db))
+            finally:
+                db.close()
+        return results
+
+    def replicate_users(self, users):
+        """Copies users (rows or models of the main database) to the other shards. Users copied before are left as they are."""
+        rows = [{"id": user.id, "email": user.email, "password": user.password, "created_at": user.created_at,
+                 "shard": user.shard} for user in users]
+        if not rows:
+            return
+
+        for shard in range(1, self.count):
+            db = self.session(shard)
+            try:
+                db.execute(insert(models.User).values(rows).on_conflict_do_nothing(index_elements=["id"]))
+                db.commit()
+            finally:
+                db.close()
+
+
+router = ShardRouter()
+
+# Runs the queries of a scatter-gather on all shards concurrently.
+_executor = ThreadPoolExecutor(thread_name_prefix="shards")
+
+
+class ShardSessions:
+    """
+    The sessions of a request on the shards, opened when first needed. The session of the main database is the one of the request (from "get_db"),
+    so with a single shard, a request still runs in one session and one transaction, as before sharding.
+    """
+
+    def __init__(self, db: Session, router: ShardRouter):
+        self.db = db
+        self.router = router
+        self._sessions = {0: db}
+
+    @property
+    def count(self):
+        return self.router.count
+
+    def __getitem__(self, shard: int) -> Session:
+        if shard not in self._sessions:
+            self._sessions[shard] = self.router.session(shard)
+        return self._sessions[shard]
+
+    def all(self):
+        return [self[shard] for shard in range(self.count)]
+
+    def shard_of_user(self, users_id: int) -> Optional[int]:
+        """The shard of a user, or None if the user doesn't exist. Read from the main database - unless there's only one shard."""
+        if self.count == 1:
+            return 0
+        return self.db.execute(queries.user_shard, {"id": users_id}).scalar()
+
+    def for_user(self, users_id: int) -> Optional[Session]:
+        shard = self.shard_of_user(users_id)
+        return None if shard is None else self[shard]
+
+    def for_post(self, post_id: int) -> Optional[Session]:
+        """The session of the shard of a post, or None if it can't be found."""
+        if self.count == 1:
+            return self.db
+        owner = post_owner(post_id)
+        if owner is not None:
+            return self.for_user(owner)
+        # Posts from before the ids held their author are looked for on every shard.
+        for db in self.all():
+            if db.execute(queries.post_exists, {"id": post_id}).first():
+                return db
+        return None
+
+    def scatter(self, function, *args):
+        """Runs "function(session, *args)" on every shard concurrently, and returns the list of the results (in the order of the shards)."""
+        if self.count == 1:
+            return [function(self.db, *args)]
+        # Opened here, rather than in the threads of the executor. The context is copied, for the route class (i.e. its statement timeout).
+        futures = [_executor.submit(copy_context().run, function, db, *args) for db in self.all()]
+        return [future.result() for future in futures]
+
+    def release(self):
+        """Gives back the connections of the sessions used so far, ending their transactions (i.e. before waiting on a shared query).
+        Each session checks a connection out again when it's next used."""
+        for db in self._sessions.values():
+            db.rollback()
+
+    def close(self):
+        for shard, db in self._sessions.items():
+            if shard != 0:
+                db.close()
+
+
+# Dependency for the routes reading or writing posts and votes. Uses the router of the module at the time of the request.
+def get_shards(db: Session = Depends(get_db)):
+    shards = ShardSessions(db, router)
+    try:
+        yield shards
+    finally:
+        shards.close()
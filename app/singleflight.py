@@ -0,0 +1,75 @@
+# Module for coalescing identical concurrent requests ("single-flight"). When many clients ask for the same thing at the same moment
+# (i.e. the first page of the feed, right after a push notification went out), only the first request runs the query.
+# The others wait for it and share its result, rather than each running the same query.
+
+import asyncio
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+
+class SingleFlight:
+    """
+    Runs a function once for all concurrent calls with the same key. The result may be kept for "ttl_ms" after the call finished
+    (a micro-cache), so requests arriving right after it share it as well - at the cost of returning results up to "ttl_ms" old.
+
+    Used from async path operations. The function is run in the threadpool, while the waiting requests only wait on the event loop,
+    so they don't hold on to threads. The result is shared between requests, so it must not be changed by them, nor depend on their DB session.
+    """
+
+    def __init__(self, ttl_ms: int = 0, max_entries: int = 1024):
+        self.ttl_seconds = ttl_ms / 1000
+        self.max_entries = max_entries
+        self._in_flight = {}  # Maps a key to the future of the call running for it.
+        self._results = {}  # Maps a key to the time its result expires, and the result.
+
+    async def do(self, key, function, *args):
+        cached = self._results.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            # Shielded, so a follower being cancelled (its client disconnected) doesn't cancel the call for everyone else.
+            return await asyncio.shield(task)
+
+        # Run in a task of its own, rather than in the request of the leader - so the leader being cancelled doesn't cancel the call
+        # (or fail it with the cancellation) for the followers waiting for it.
+        task = asyncio.ensure_future(run_in_threadpool(function, *args))
+        self._in_flight[key] = task
+        task.add_done_callback(lambda task: self._done(key, task))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # The call still uses the arguments of the leader (i.e. the DB session of its request), which are only given back once it's done.
+            await _finish(task)
+            raise
+
+    def _done(self, key, task):
+        del self._in_flight[key]
+        if task.cancelled():
+            return
+        if task.exception() is None:  # Also marks the exception as retrieved, in case there were no followers to retrieve it.
+            if self.ttl_seconds > 0:
+                self._remember(key, task.result())
+
+    def _remember(self, key, result):
+        now = time.monotonic()
+        # Dropping expired results, so keys used once (i.e. searches) don't pile up.
+        if len(self._results) >= self.max_entries:
+            self._results = {key: cached for key, cached in self._results.items()
+                             if cached[0] > now}
+        if len(self._results) < self.max_entries:
+            self._results[key] = (now + self.ttl_seconds, result)
+
+    def forget(self):
+        self._results.clear()
+
+
+# Waits for a task to be done, however many times the waiting is cancelled.
+async def _finish(task):
+    while not task.done():
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            pass
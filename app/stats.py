@@ -0,0 +1,119 @@
+# Module for the statistics of each user (the "user_stats" table) - the number of posts, the likes received and the likes given.
+# Changes are applied as deltas (i.e. "+1 like given"), in the same transaction as the change of the posts or votes itself,
+# so a profile is read from one row, rather than counting the posts and votes of the user on every request.
+#
+# The counts may still drift (i.e. rows changed by hand, or a user deleted along with their votes). "reconcile" counts them again and
+# fixes the rows which are off, in batches. Run it periodically (i.e. from cron) with: "python -m app.stats".
+#
+# With several shards (see app/sharding.py), each shard keeps the statistics of what's on that shard - the deltas are applied on the shard
+# of the change, and reconciling counts each shard on its own. The statistics of a user are the sum of their rows on all shards.
+
+import logging
+from collections import defaultdict
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from . import models
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+# The statement applying the deltas of many users at once. The counts of a user without a row yet are inserted as they are.
+APPLY_DELTAS = text("""
+    INSERT INTO user_stats (users_id, posts, likes_received, likes_given)
+    SELECT * FROM unnest(CAST(:users_ids AS integer[]), CAST(:posts AS integer[]),
+                         CAST(:likes_received AS integer[]), CAST(:likes_given AS integer[]))
+    ON CONFLICT (users_id) DO UPDATE SET
+        posts = user_stats.posts + excluded.posts,
+        likes_received = user_stats.likes_received + excluded.likes_received,
+        likes_given = user_stats.likes_given + excluded.likes_given,
+        updated_at = now()""")
+
+# The statement counting the statistics of a batch of users again, and writing the ones which are off. Archived posts (see app/partitions.py) count as well.
+# The rows must be locked before counting, see "reconcile".
+RECONCILE = text("""
+    WITH actual AS (
+        SELECT users.id AS users_id,
+               (SELECT count(*) FROM posts WHERE posts.users_id = users.id AND posts.deleted_at IS NULL) +
+               (SELECT count(*) FROM posts_archive WHERE posts_archive.users_id = users.id AND posts_archive.deleted_at IS NULL) AS posts,
+               (SELECT count(*) FROM votes JOIN posts ON posts.id = votes.post_id WHERE posts.users_id = users.id) +
+               (SELECT count(*) FROM votes JOIN posts_archive ON posts_archive.id = votes.post_id
+                WHERE posts_archive.users_id = users.id) AS likes_received,
+               (SELECT count(*) FROM votes WHERE votes.user_id = users.id) AS likes_given
+        FROM users WHERE users.id = ANY(:users_ids)
+    )
+    INSERT INTO user_stats (users_id, posts, likes_received, likes_given)
+    SELECT * FROM actual
+    WHERE NOT EXISTS (SELECT 1 FROM user_stats
+                      WHERE user_stats.users_id = actual.users_id AND user_stats.posts = actual.posts
+                      AND user_stats.likes_received = actual.likes_received AND user_stats.likes_given = actual.likes_given)
+    ON CONFLICT (users_id) DO UPDATE SET
+        posts = excluded.posts,
+        likes_received = excluded.likes_received,
+        likes_given = excluded.likes_given,
+        updated_at = now()
+    RETURNING users_id""")
+
+
+class Deltas:
+    """The changes of the statistics of one or more users, collected during a transaction, and applied with one statement."""
+
+    def __init__(self):
+        self._counts = defaultdict(lambda: [0, 0, 0])
+
+    def add(self, users_id: int, posts: int = 0, likes_received: int = 0, likes_given: int = 0):
+        counts = self._counts[users_id]
+        counts[0] += posts
+        counts[1] += likes_received
+        counts[2] += likes_given
+        return self
+
+    def apply(self, db: Session):
+        # Sorted, so concurrent transactions lock the rows of the same users in the same order, and never deadlock on each other.
+        users_ids = sorted(id for id, counts in self._counts.items() if any(counts))
+        if not users_ids:
+            return
+        db.execute(APPLY_DELTAS, {"users_ids": users_ids,
+                                  "posts": [self._counts[id][0] for id in users_ids],
+                                  "likes_received": [self._counts[id][1] for id in users_ids],
+                                  "likes_given": [self._counts[id][2] for id in users_ids]})
+
+
+def update(db: Session, users_id: int, posts: int = 0, likes_received: int = 0, likes_given: int = 0):
+    """Applies the changes of the statistics of one user."""
+    Deltas().add(users_id, posts, likes_received, likes_given).apply(db)
+
+
+def reconcile(db: Session, batch_size: int = 1000):
+    """
+    Counts the statistics of all users again, a batch of users at a time (each batch in a transaction of its own), and fixes the rows which are off.
+    Returns the ids of the users whose statistics were fixed.
+
+    The rows of a batch are locked before counting, so changes committed during the count can't be lost - a transaction changing
+    the posts or votes of a user also applies a delta to their row, and so waits for the batch to be committed, then applies it to the fixed row.
+    """
+    fixed = []
+    last_id = 0
+    while True:
+        users_ids = [id for id, in db.query(models.User.id).filter(
+            models.User.id > last_id).order_by(models.User.id).limit(batch_size)]
+        if not users_ids:
+            return fixed
+
+        db.query(models.UserStats.users_id).filter(models.UserStats.users_id.in_(users_ids)).order_by(
+            models.UserStats.users_id).with_for_update().all()
+        fixed += [row.users_id for row in db.execute(RECONCILE, {"users_ids": users_ids})]
+        db.commit()
+        last_id = users_ids[-1]
+
+
+def reconcile_once():
+    """Reconciles the statistics on each shard. Returns the ids of the users whose statistics were fixed on any shard."""
+    return sorted({id for fixed in sharding.router.for_each_shard(reconcile) for id in fixed})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fixed = reconcile_once()
+    logger.info("Fixed the statistics of %s users: %s", len(fixed), fixed)
@@ -0,0 +1,221 @@
+# Module for the home timelines - the posts of the users a user follows, newest first. Rather than joining the posts against the follows and
+# sorting them on every read (which reads the posts of every author followed, across all shards), each user has a precomputed timeline
+# ("timeline_entries", on the main database), and the home feed reads one range of it.
+#
+# Fan-out on write: once a post is created, the outbox worker (app/outbox.py) adds it to the timeline of every follower of its author, with
+# one statement. A new follower gets the latest posts of the author copied into their timeline, and loses them again when they unfollow.
+#
+# Authors with at least "timeline_celebrity_followers" followers are the exception: fanning out each of their posts would write that many rows.
+# Their posts aren't written to any timeline. Instead, the home feed reads the latest posts of the celebrities a user follows from their
+# shards, and merges them with the timeline when it's read. Posts fanned out before an author became a celebrity stay in the timelines.
+#
+# Timelines only keep their newest "timeline_max_entries" entries. Older ones are trimmed periodically (i.e. from cron) with:
+# "python -m app.timelines trim". Entries of deleted posts are removed by the outbox worker, and are skipped when read until then.
+
+import logging
+import sys
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import List, Optional
+
+from sqlalchemy import delete, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from . import models, outbox, queries, sharding, utils
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Adding a post to the timelines of all the followers of its author. Delivered at least once, so adding it again changes nothing.
+FAN_OUT = text("""
+    INSERT INTO timeline_entries (users_id, created_at, post_id, author_id)
+    SELECT follower_id, :created_at, :post_id, :author_id FROM follows WHERE followee_id = :author_id
+    ON CONFLICT DO NOTHING""")
+
+# Removing the entries of a batch of users beyond the newest ":max_entries" of their timelines.
+TRIM = text("""
+    DELETE FROM timeline_entries USING (
+        SELECT users_id, created_at, post_id FROM (
+            SELECT users_id, created_at, post_id,
+                   row_number() OVER (PARTITION BY users_id ORDER BY created_at DESC, post_id DESC) AS position
+            FROM timeline_entries WHERE users_id = ANY(:users_ids)) ranked
+        WHERE position > :max_entries) old
+    WHERE (timeline_entries.users_id, timeline_entries.created_at, timeline_entries.post_id) = (old.users_id, old.created_at, old.post_id)""")
+
+
+def is_celebrity(followers: int) -> bool:
+    return followers >= settings.timeline_celebrity_followers
+
+
+@contextmanager
+def shard_session(db: Session, shard: int):
+    """
+    The session of a shard, for a handler of the outbox running with the session of another one. With a single shard, that's the session of
+    the handler itself, so the change is committed along with the delivery of the event. Otherwise it's committed on its own.
+    """
+    if sharding.router.count == 1:
+        yield db
+        return
+    other = sharding.router.session(shard)
+    try:
+        yield other
+        other.commit()
+    finally:
+        other.close()
+
+
+# Runs on the shard of the post. The timelines are on the main database.
+@outbox.handler("post.created")
+def fan_out(db: Session, payload):
+    created_at = db.query(models.Post.created_at).filter(models.Post.id == payload["post_id"], queries.visible).scalar()
+    if created_at is None:  # Deleted in the meantime.
+        return
+    with shard_session(db, 0) as main:
+        followers = main.query(models.User.followers).filter(models.User.id == payload["users_id"]).scalar()
+        if followers is None or is_celebrity(followers):
+            return
+        main.execute(FAN_OUT, {"created_at": created_at, "post_id": payload["post_id"], "author_id": payload["users_id"]})
+
+
+@outbox.handler("post.deleted")
+def remove_deleted(db: Session, payload):
+    created_at = db.query(models.Post.created_at).filter(models.Post.id == payload["post_id"]).scalar()
+    followers = select(models.Follow.follower_id).where(models.Follow.followee_id == payload["users_id"])
+    statement = delete(models.TimelineEntry).where(models.TimelineEntry.users_id.in_(followers),
+                                                   models.TimelineEntry.post_id == payload["post_id"])
+    # Looked up by the whole PK when the time of the post is still known (it's not, once the post is purged).
+    if created_at is not None:
+        statement = statement.where(models.TimelineEntry.created_at == created_at)
+    with shard_session(db, 0) as main:
+        main.execute(statement, execution_options={"synchronize_session": False})
+
+
+# Runs on the main database, where the follows are. The posts of the author are on their shard.
+@outbox.handler("follow.created")
+def backfill(db: Session, payload):
+    followee = db.query(models.User.shard, models.User.followers).filter(models.User.id == payload["followee_id"]).first()
+    followed = db.query(models.Follow).filter(models.Follow.follower_id == payload["follower_id"],
+                                              models.Follow.followee_id == payload["followee_id"]).first()
+    # Unfollowed in the meantime, or a celebrity, whose posts are merged in when read.
+    if followee is None or followed is None or is_celebrity(followee.followers):
+        return
+    with shard_session(db, followee.shard) as posts_db:
+        posts = posts_db.query(models.Post.id, models.Post.created_at).filter(
+            models.Post.users_id == payload["followee_id"], queries.visible).order_by(
+            models.Post.created_at.desc(), models.Post.id.desc()).limit(settings.timeline_backfill_posts).all()
+    if posts:
+        db.execute(insert(models.TimelineEntry).values([
+            {"users_id": payload["follower_id"], "created_at": post.created_at, "post_id": post.id,
+             "author_id": payload["followee_id"]} for post in posts]).on_conflict_do_nothing())
+
+
+def follow(db: Session, follower_id: int, followee_id: int) -> bool:
+    """Adds a follow, on the main database. Returns False if the user was followed already. The caller commits."""
+    inserted = db.execute(insert(models.Follow).values(follower_id=follower_id, followee_id=followee_id).on_conflict_do_nothing().returning(
+        models.Follow.followee_id)).first()
+    if not inserted:
+        return False
+    db.query(models.User).filter(models.User.id == followee_id).update(
+        {"followers": models.User.followers + 1}, synchronize_session=False)
+    # The latest posts of the author are copied into the timeline afterwards - they may be on another shard.
+    outbox.enqueue(db, "follow.created", follower_id=follower_id, followee_id=followee_id)
+    return True
+
+
+def unfollow(db: Session, follower_id: int, followee_id: int) -> bool:
+    """Removes a follow, and the posts of the author from the timeline of the follower. Returns False if there was none. The caller commits."""
+    deleted = db.query(models.Follow).filter(models.Follow.follower_id == follower_id,
+                                             models.Follow.followee_id == followee_id).delete(synchronize_session=False)
+    if not deleted:
+        return False
+    db.query(models.User).filter(models.User.id == followee_id).update(
+        {"followers": models.User.followers - 1}, synchronize_session=False)
+    # At most "timeline_max_entries" entries to look through, as the timeline is trimmed.
+    db.query(models.TimelineEntry).filter(models.TimelineEntry.users_id == follower_id,
+                                          models.TimelineEntry.author_id == followee_id).delete(synchronize_session=False)
+    return True
+
+
+def home_page(shards: sharding.ShardSessions, users_id: int, limit: int, cursor: Optional[str] = None):
+    """
+    A page of the home timeline of a user, newest first: the entries of their timeline, merged with the latest posts of the celebrities
+    they follow. Returns the (post, votes) rows of the page, and the cursor of the next page (None on the last page).
+    Raises ValueError for an invalid cursor. Deleted posts not yet removed from the timeline are left out, so a page may be short.
+    """
+    after = utils.decode_cursor(cursor) if cursor else None
+    # One extra, to find out whether there's a next page.
+    size = limit + 1
+
+    entries = select(models.TimelineEntry.created_at, models.TimelineEntry.post_id.label("id"),
+                     models.TimelineEntry.author_id).where(models.TimelineEntry.users_id == users_id)
+    if after:
+        entries = entries.where(tuple_(models.TimelineEntry.created_at, models.TimelineEntry.post_id) < tuple_(*after))
+    sources = [shards.db.execute(entries.order_by(models.TimelineEntry.created_at.desc(),
+                                                  models.TimelineEntry.post_id.desc()).limit(size)).all()]
+
+    # The celebrities followed, by shard. Their posts are read from the index "ix_posts_users_id_created_at_id".
+    celebrities = defaultdict(list)
+    for user in shards.db.query(models.User.id, models.User.shard).join(models.Follow, models.Follow.followee_id == models.User.id).filter(
+            models.Follow.follower_id == users_id, models.User.followers >= settings.timeline_celebrity_followers):
+        celebrities[user.shard if shards.count > 1 else 0].append(user.id)
+    for shard, authors in celebrities.items():
+        posts = select(models.Post.created_at, models.Post.id, models.Post.users_id.label("author_id")).where(
+            models.Post.users_id.in_(authors), queries.visible)
+        if after:
+            posts = posts.where(tuple_(models.Post.created_at, models.Post.id) < tuple_(*after))
+        sources.append(shards[shard].execute(posts.order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(size)).all())
+
+    page = sharding.merge(sources, key=lambda row: (row.created_at, row.id), reverse=True)[:size]
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = utils.encode_cursor(page[-1].created_at, page[-1].id)
+    return load_posts(shards, page), next_cursor
+
+
+def load_posts(shards: sharding.ShardSessions, entries) -> List:
+    """The (post, votes) rows of the posts of timeline entries, in the order of the entries. Read with one query on each shard involved."""
+    ids_by_shard = defaultdict(list)
+    if shards.count == 1:
+        ids_by_shard[0] = [entry.id for entry in entries]
+    else:
+        authors = {entry.author_id for entry in entries}
+        shard_of = dict(shards.db.query(models.User.id, models.User.shard).filter(models.User.id.in_(authors)).all()) if authors else {}
+        for entry in entries:
+            if entry.author_id in shard_of:
+                ids_by_shard[shard_of[entry.author_id]].append(entry.id)
+
+    posts = {}
+    for shard, ids in ids_by_shard.items():
+        if ids:
+            for row in shards[shard].execute(select(models.Post, queries.votes).options(queries.with_attachments).where(
+                    models.Post.id.in_(ids), queries.visible)):
+                posts[row.Post.id] = row
+    return [posts[entry.id] for entry in entries if entry.id in posts]
+
+
+def trim(db: Session, batch_size: int = 1000):
+    """Trims the timelines of all users to their newest "timeline_max_entries" entries, a batch of users per transaction. Returns the entries removed."""
+    removed = 0
+    last_id = 0
+    while True:
+        users_ids = db.query(models.User.id).filter(models.User.id > last_id).order_by(models.User.id).limit(batch_size).all()
+        if not users_ids:
+            return removed
+        users_ids = [user.id for user in users_ids]
+        removed += db.execute(TRIM, {"users_ids": users_ids, "max_entries": settings.timeline_max_entries}).rowcount
+        db.commit()
+        last_id = users_ids[-1]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if sys.argv[1:] != ["trim"]:
+        sys.exit("Usage: python -m app.timelines trim")
+    # The timelines are on the main database.
+    main = sharding.router.session(0)
+    try:
+        logger.info("Removed %s entries beyond the newest %s of each timeline", trim(main), settings.timeline_max_entries)
+    finally:
+        main.close()
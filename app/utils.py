@@ -3,6 +3,11 @@
 # Used for hashing and verifying passwords, encrypting them when storing them to DB so they won't appear as plain text.
 from passlib.context import CryptContext
 
+# For building and reading opaque pagination cursors.
+import base64
+import binascii
+from datetime import datetime
+
 # This setting tells passlib the default hashing algorithm to use (bcrypt).
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -15,3 +20,20 @@ def hash(password: str):
 def verify(plain_password, hashed_password):
     # The "verify" method will do the comparison logic.
     return pwd_context.verify(plain_password, hashed_password)
+
+
+# Functions for encoding and decoding keyset pagination cursors. The cursor is the position of the last row of a page,
+# and the next page is everything strictly "older" than that position. Base64 keeps the cursor opaque and URL safe for the client.
+def encode_cursor(created_at: datetime, id: int):
+    raw = f"{created_at.isoformat()}|{id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+# Raises ValueError if the cursor was not created by "encode_cursor" (i.e. tampered with or truncated by the client).
+def decode_cursor(cursor: str):
+    try:
+        created_at, id = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor}")
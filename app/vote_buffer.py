@@ -0,0 +1,179 @@
+# Module for write-behind vote buffering (optional, enabled with "vote_buffer_enabled").
+# Rather than an INSERT and a commit per vote, votes are collected in memory and written in batches - one statement for all new votes,
+# and one for all removed votes - every "vote_buffer_flush_ms", or as soon as "vote_buffer_max_votes" votes are waiting.
+#
+# Acknowledgement semantics: a buffered vote is answered with "202 Accepted" before it's written to the DB.
+# - It's applied within "vote_buffer_flush_ms" (plus the time the flush takes), so it's not yet visible in the vote counts when the response arrives.
+# - It's held in the memory of this worker process until then. It's lost if the process crashes before flushing (not on a graceful shutdown).
+# - Votes of the same user on the same post are deduplicated, and the last one wins. Voting is idempotent - liking twice is not a conflict,
+#   and removing a vote that doesn't exist is not an error. Votes on posts deleted before the flush are dropped.
+# - A vote is kept with the time it was given, which it's written (and counted in the rollups, see app/rollups.py) with - not the time of the flush.
+#
+# With several shards (see app/sharding.py), a batch is written to every shard, in a transaction on each - the statements only insert
+# the votes on the posts of that shard (and only delete votes which are there), so no shard needs to be looked up for each vote.
+# Writing a batch is idempotent, so a batch failing on one shard is simply written again to all of them.
+
+import asyncio
+import logging
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import outbox, live, models, stats, rollups
+from .config import settings
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFull(Exception):
+    """Raised when the buffer can't take more votes, because flushing doesn't keep up (i.e. the DB is down)."""
+
+
+class VoteBuffer:
+
+    def __init__(self):
+        # Votes can be added from any thread of the threadpool running the path operations.
+        self._lock = threading.Lock()
+        self._votes = {}  # Maps (user_id, post_id) to the direction and time of the latest vote.
+        self._loop = None
+        self._flush_now = None
+        self._stopping = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._votes)
+
+    def add(self, user_id: int, post_id: int, dir: int):
+        # Any direction but a like removes the vote, as it does when votes aren't buffered.
+        vote = (1 if dir == 1 else 0, rollups.now())
+        with self._lock:
+            key = (user_id, post_id)
+            # Limiting the memory used, if the votes can't be written. The buffer may hold 10 batches at most.
+            if key not in self._votes and len(self._votes) >= settings.vote_buffer_max_votes * 10:
+                raise BufferFull()
+            self._votes[key] = vote
+            full = len(self._votes) >= settings.vote_buffer_max_votes
+
+        # Flushing right away rather than waiting for the next interval, when a full batch is waiting.
+        if full and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._flush_now.set)
+
+    def take(self):
+        with self._lock:
+            votes, self._votes = self._votes, {}
+        return votes
+
+    def restore(self, votes):
+        """Puts back votes that failed to be written. Votes added in the meantime are newer, and are kept."""
+        with self._lock:
+            for key, vote in votes.items():
+                self._votes.setdefault(key, vote)
+
+    def flush(self, *sessions: Session):
+        """Writes all buffered votes, in one transaction on each of the sessions (of the shards). Returns the number of votes taken from the buffer."""
+        votes = self.take()
+        if not votes:
+            return 0
+        try:
+            for db in sessions:
+                write_votes(db, votes)
+        except Exception:
+            for db in sessions:
+                db.rollback()
+            self.restore(votes)
+            raise
+        return len(votes)
+
+    def flush_once(self):
+        sessions = [sharding.router.session(shard) for shard in range(sharding.router.count)]
+        try:
+            return self.flush(*sessions)
+        finally:
+            for db in sessions:
+                db.close()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._flush_now = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stops flushing periodically, and writes the votes still waiting in the buffer."""
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._flush_now.set()
+        await self._task
+        self._task = None
+        self._loop = None
+        await run_in_threadpool(self.flush_once)
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), settings.vote_buffer_flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await run_in_threadpool(self.flush_once)
+            except Exception:
+                logger.exception("Flushing the vote buffer failed")
+
+
+def write_votes(db: Session, votes):
+    """
+    Writes a batch of votes, given as a dict of (user_id, post_id) to (direction, time), with one multi-row statement for each direction.
+    The rows actually inserted or deleted are returned by the statements, so side effects are only produced for real changes.
+    """
+    likes = [key for key, (dir, _) in votes.items() if dir == 1]
+    unlikes = [key for key, (dir, _) in votes.items() if dir == 0]
+    created, deleted = [], []
+
+    if likes:
+        # Votes already existing are skipped, and the join drops votes on posts that no longer exist (or are deleted).
+        created = db.execute(text("""
+            INSERT INTO votes (user_id, post_id, created_at)
+            SELECT v.user_id, v.post_id, v.created_at
+            FROM unnest(CAST(:user_ids AS bigint[]), CAST(:post_ids AS bigint[]), CAST(:created_ats AS timestamptz[])) AS v(user_id, post_id, created_at)
+            JOIN posts ON posts.id = v.post_id AND posts.deleted_at IS NULL
+            ON CONFLICT DO NOTHING
+            RETURNING user_id, post_id"""),
+            {"user_ids": [user_id for user_id, _ in likes], "post_ids": [post_id for _, post_id in likes],
+             "created_ats": [votes[key][1] for key in likes]}).all()
+
+    if unlikes:
+        deleted = db.execute(text("""
+            DELETE FROM votes
+            USING unnest(CAST(:user_ids AS bigint[]), CAST(:post_ids AS bigint[])) AS v(user_id, post_id)
+            WHERE votes.user_id = v.user_id AND votes.post_id = v.post_id
+            RETURNING votes.user_id, votes.post_id"""),
+            {"user_ids": [user_id for user_id, _ in unlikes], "post_ids": [post_id for _, post_id in unlikes]}).all()
+
+    # The statistics of the voters and of the authors of the posts, for all the votes of the batch in one statement.
+    changed = [(row, 1) for row in created] + [(row, -1) for row in deleted]
+    if changed:
+        authors = dict(db.query(models.Post.id, models.Post.users_id).filter(
+            models.Post.id.in_({row.post_id for row, _ in changed})))
+        deltas = stats.Deltas()
+        for row, sign in changed:
+            deltas.add(row.user_id, likes_given=sign)
+            if row.post_id in authors:
+                deltas.add(authors[row.post_id], likes_received=sign)
+        deltas.apply(db)
+
+    # Counted in the bucket of the hour each vote was given in.
+    events = [("vote.created", row) for row in created] + [("vote.deleted", row) for row in deleted]
+    outbox.enqueue_many(db, [(topic, {"post_id": row.post_id, "user_id": row.user_id, "at": votes[(row.user_id, row.post_id)][1]})
+                             for topic, row in events])
+    # One notification per changed post, however many of its votes changed.
+    for post_id in {row.post_id for row in created + deleted}:
+        live.publish_vote_change(db, post_id)
+    db.commit()
+
+
+buffer = VoteBuffer()
@@ -0,0 +1,107 @@
+# Module for warming up the app at startup, before it's reported as ready ("/readyz"). Otherwise the first requests after a deploy pay for
+# opening the DB connections, compiling and preparing the hot queries, loading the bcrypt backend and setting up JWT - a latency spike
+# on every rolling deploy. Run in the background by the startup of the app, so "/healthz" answers while warming up.
+
+import asyncio
+import logging
+import time
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from . import queries, oauth2, utils, sharding, revocation
+from .admission import controller
+from .config import settings
+from .database import get_engine
+from .routers.post import SUMMARY_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """Whether the warm-up has finished, and how long it took. Read by "/readyz"."""
+
+    def __init__(self):
+        self.ready = False
+        self.warmup_ms = None
+
+
+readiness = Readiness()
+
+
+def hot_queries():
+    """The hot queries of app/queries.py with parameters matching nothing, for compiling them and preparing them on a connection."""
+    feed = {"limit": 1, "skip": 0, "search": ""}
+    return [(queries.user_by_id, {"id": 0}), (queries.post_with_votes, {"id": 0}), (queries.post_version, {"id": 0}),
+            (queries.post_exists, {"id": 0}), (queries.vote_by_user_and_post, {"post_id": 0, "user_id": 0}),
+            (queries.user_stats, {"id": 0}), (queries.feed_page(), feed), (queries.feed_page(versions_only=True), feed),
+            (queries.feed_page(tuple(SUMMARY_FIELDS)), feed)]
+
+
+def warm_up(engine, connections: int = None):
+    """
+    Opens connections of the pool (held at once, so they're all new ones), and runs the hot queries on each of them.
+    Then loads the bcrypt backend and runs a JWT round trip. Returns the time each step took, in milliseconds.
+    """
+    timings = {}
+    started = time.perf_counter()
+    opened = []
+    try:
+        for _ in range(settings.db_pool_prewarm if connections is None else connections):
+            opened.append(engine.connect())
+        timings["pool"] = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        for connection in opened:
+            for statement, parameters in hot_queries():
+                connection.execute(statement, parameters)
+        timings["queries"] = (time.perf_counter() - started) * 1000
+    finally:
+        for connection in opened:
+            connection.close()
+
+    # Loading the backend runs the self tests of passlib, which hash a few passwords.
+    started = time.perf_counter()
+    utils.pwd_context.handler().get_backend()
+    timings["bcrypt"] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    oauth2.verify_access_token(oauth2.create_access_token({"user_id": 0}), Exception())
+    timings["jwt"] = (time.perf_counter() - started) * 1000
+    return timings
+
+
+async def run():
+    """Warms up until it succeeds (i.e. once the DB can be reached), then reports the app as ready."""
+    started = time.perf_counter()
+    while True:
+        try:
+            timings = await run_in_threadpool(warm_up, get_engine())
+            # The pools of the other shards (see app/sharding.py).
+            for shard in range(1, sharding.router.count):
+                await run_in_threadpool(warm_up, sharding.router.engine(shard))
+            # Loading the denylist of revoked tokens, so none of them is accepted once the app is ready.
+            started_denylist = time.perf_counter()
+            await run_in_threadpool(revocation.refresh_once)
+            timings["denylist"] = (time.perf_counter() - started_denylist) * 1000
+            break
+        except Exception:
+            logger.exception("Warming up failed, retrying")
+            await asyncio.sleep(1)
+
+    readiness.warmup_ms = (time.perf_counter() - started) * 1000
+    readiness.ready = True
+    logger.info("Warmed up in %.0f ms: %s", readiness.warmup_ms,
+                ", ".join(f"{step} {ms:.0f} ms" for step, ms in timings.items()))
+
+
+def is_database_ready(db):
+    """Whether a connection of the pool can run a query - without waiting, if the pool is saturated."""
+    if controller.rejection_reason("read"):
+        return False
+    try:
+        db.execute(text("SELECT 1"))
+    except Exception:
+        logger.exception("The DB isn't ready")
+        return False
+    return True
@@ -0,0 +1,43 @@
+# Benchmark comparing JSON and MessagePack for the responses of the feed ("List[schemas.PostVotes]") - payload size, and the time
+# taken to encode (on this API) and to decode (on the calling services). Doesn't need a DB.
+# Run from the root of the project: "python -m benchmarks.bench_encoding"
+
+import json
+import timeit
+from datetime import datetime, timezone
+
+import msgpack
+from fastapi.encoders import jsonable_encoder
+
+from app import schemas
+from app.encoding import render_json, render_msgpack
+
+
+# Builds a page of the feed, as it's passed to the response class by FastAPI.
+def feed_page(posts: int, content_length: int):
+    owner = {"id": 1, "email": "someone@example.com",
+             "created_at": datetime(2022, 4, 20, tzinfo=timezone.utc)}
+    page = [schemas.PostVotes(Post={"id": id, "title": f"Title of post {id}", "content": "x" * content_length, "published": True,
+                                    "created_at": datetime(2022, 4, 20, tzinfo=timezone.utc), "users_id": 1, "owner": owner}, votes=id * 7)
+            for id in range(posts)]
+    return jsonable_encoder(page)
+
+
+def measure(function, argument, number: int):
+    # The best of 5 runs, in microseconds per call.
+    return min(timeit.repeat(lambda: function(argument), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print(f"{'payload':<28}{'format':<10}{'bytes':>10}{'encode µs':>12}{'decode µs':>12}")
+    for posts, content_length in [(1, 200), (25, 200), (100, 200), (25, 5000)]:
+        page = feed_page(posts, content_length)
+        number = max(10, 20000 // posts)
+        for name, encode, decode in [("json", render_json, json.loads), ("msgpack", render_msgpack, msgpack.unpackb)]:
+            body = encode(page)
+            print(f"{f'{posts} posts x {content_length} chars':<28}{name:<10}{len(body):>10}"
+                  f"{measure(encode, page, number):>12.1f}{measure(decode, body, number):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Benchmark of group commit of new posts (app/group_commit.py) - the posts created per second by concurrent writers, and the latency
+# of creating a post, with a commit per post and with group commit for several windows. Group commit trades latency (up to the window)
+# for throughput: the more writers, the more posts share one commit, and one fsync.
+# Needs the DB of the settings, with the tables created (i.e. "alembic upgrade head"). Creates a user and posts, and deletes them after.
+# Run from the root of the project: "python -m benchmarks.bench_group_commit [--writers 32] [--seconds 3]"
+
+import argparse
+import statistics
+import threading
+import time
+
+from app import group_commit, models
+from app.config import settings
+from app.database import SessionLocal
+
+POST = {"title": "Benchmark", "content": "x" * 200, "published": True}
+
+
+def commit_per_post(users_id: int):
+    db = SessionLocal()
+    try:
+        return group_commit.write_posts(db, 0, [users_id], [POST])[0]
+    finally:
+        db.close()
+
+
+def grouped(users_id: int):
+    return group_commit.posts.create_post(0, users_id, POST)
+
+
+def measure(create, users_ids, seconds: float):
+    # Each writer creates posts of its own user one after the other, as a client waiting for each response would (the posts of one user
+    # are numbered one at a time). Returns posts per second and latencies in ms.
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    def write(users_id):
+        mine = []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            create(users_id)
+            mine.append((time.perf_counter() - start) * 1000)
+        latencies.extend(mine)
+
+    threads = [threading.Thread(target=write, args=(users_id,)) for users_id in users_ids]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of creating posts, with and without group commit.")
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+    # One connection for each writer, so writers don't wait for the pool rather than for their commits.
+    settings.db_pool_size = args.writers + 1
+
+    db = SessionLocal()
+    users = [models.User(email=f"bench_group_commit_{number}@example.com", password="not a hash") for number in range(args.writers)]
+    db.add_all(users)
+    db.commit()
+    users_ids = [user.id for user in users]
+
+    try:
+        print(f"{args.writers} writers, {args.seconds:g} seconds each")
+        print(f"{'variant':<24}{'posts/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        variants = [("commit per post", commit_per_post, None)] + [
+            (f"group commit, {window} ms", grouped, window) for window in (1, 2, 5, 10)]
+        for name, create, window in variants:
+            if window is not None:
+                settings.post_group_commit_window_ms = window
+            rate, p50, p99 = measure(create, users_ids, args.seconds)
+            print(f"{name:<24}{rate:>10.0f}{p50:>10.2f}{p99:>10.2f}")
+    finally:
+        # The posts go along with the users, by the cascade.
+        db.rollback()
+        db.query(models.OutboxEvent).filter(models.OutboxEvent.payload["users_id"].astext.in_(
+            [str(id) for id in users_ids])).delete(synchronize_session=False)
+        db.query(models.UserStats).filter(models.UserStats.users_id.in_(users_ids)).delete(synchronize_session=False)
+        db.query(models.User).filter(models.User.id.in_(users_ids)).delete(synchronize_session=False)
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Benchmark of the hot queries of app/queries.py - the CPU time spent in this process per query (building, compiling and running it, and
+# loading the result), and the wall time per query (including Postgres). Compares the queries built for every call with "db.query" as the
+# routers used to, with the queries built once, run unprepared and run as prepared statements.
+# Needs the DB of the settings, with the tables created (i.e. "alembic upgrade head"). Creates a user and a post, and deletes them after.
+# Run from the root of the project: "python -m benchmarks.bench_queries"
+
+import time
+
+from sqlalchemy import func, select
+
+from app import models, queries
+from app.config import settings
+from app.database import SessionLocal
+
+
+def legacy_user(db, id):
+    return db.query(models.User).filter(models.User.id == id).first()
+
+
+def cached_user(db, id):
+    return db.execute(queries.user_by_id, {"id": id}).scalars().first()
+
+
+def legacy_post(db, id):
+    return db.query(models.Post, func.count(models.Vote.post_id).label("votes")).join(
+        models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).filter(models.Post.id == id).first()
+
+
+def cached_post(db, id):
+    return db.execute(queries.post_with_votes, {"id": id}).first()
+
+
+def legacy_feed(db, id):
+    votes = select(func.count(models.Vote.post_id)).where(
+        models.Vote.post_id == models.Post.id).scalar_subquery().label("votes")
+    return db.query(models.Post, votes).filter(models.Post.title.contains("")).order_by(models.Post.id).limit(25).offset(0).all()
+
+
+def cached_feed(db, id):
+    return db.execute(queries.feed_page(), {"limit": 25, "skip": 0, "search": ""}).all()
+
+
+def measure(function, id, number: int):
+    # The best of 5 runs, in microseconds per call. The session is expired after each call, as it's closed after each request.
+    db = SessionLocal()
+    try:
+        best_cpu, best_wall = float("inf"), float("inf")
+        for _ in range(5):
+            cpu, wall = time.process_time(), time.perf_counter()
+            for _ in range(number):
+                function(db, id)
+                db.expire_all()
+            best_cpu = min(best_cpu, time.process_time() - cpu)
+            best_wall = min(best_wall, time.perf_counter() - wall)
+        db.rollback()
+    finally:
+        db.close()
+    return best_cpu / number * 1e6, best_wall / number * 1e6
+
+
+def main():
+    db = SessionLocal()
+    user = models.User(email="bench_queries@example.com", password="not a hash")
+    db.add(user)
+    db.flush()
+    post = models.Post(title="Benchmark", content="x" * 200, users_id=user.id)
+    db.add(post)
+    db.commit()
+    user_id, post_id = user.id, post.id
+
+    try:
+        print(f"{'query':<12}{'variant':<22}{'cpu µs':>10}{'wall µs':>10}")
+        for name, legacy, cached, number in [("user", legacy_user, cached_user, 2000), ("post", legacy_post, cached_post, 2000),
+                                             ("feed", legacy_feed, cached_feed, 500)]:
+            id = user_id if name == "user" else post_id
+            variants = [("db.query per call", legacy, False), ("built once", cached, False),
+                        ("built once, prepared", cached, True)]
+            for variant, function, prepare in variants:
+                settings.db_prepared_statements = prepare
+                cpu, wall = measure(function, id, number)
+                print(f"{name:<12}{variant:<22}{cpu:>10.1f}{wall:>10.1f}")
+    finally:
+        db.delete(post)
+        db.delete(user)
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
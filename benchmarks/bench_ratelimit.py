@@ -0,0 +1,38 @@
+# Benchmark of the rate limiting backends (app/ratelimit.py) - the time of one check, for a few hot clients and for many distinct ones
+# (more than the backend keeps, so buckets are dropped all along). Doesn't need a DB, nor Redis.
+# Run from the root of the project: "python -m benchmarks.bench_ratelimit [--keys 1000000]"
+
+import argparse
+import os
+import tempfile
+import time
+
+from app.ratelimit import MemoryBackend, SharedMemoryBackend
+
+
+def measure(backend, keys: int, checks: int):
+    # Microseconds per check.
+    names = [f"ip:10.0.{index // 256 % 256}.{index % 256}:{index}" for index in range(keys)]
+    start = time.perf_counter()
+    for index in range(checks):
+        backend.take(names[index % keys], rate=10, burst=20)
+    return (time.perf_counter() - start) / checks * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time of one rate limiting check, for each backend.")
+    parser.add_argument("--keys", type=int, default=1000000, help="Distinct clients in the second run.")
+    parser.add_argument("--max-keys", type=int, default=100000, help="Buckets kept by the backends.")
+    parser.add_argument("--checks", type=int, default=500000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = {"memory": lambda: MemoryBackend(args.max_keys),
+                    "shared": lambda: SharedMemoryBackend(os.path.join(directory, "buckets"), args.max_keys)}
+        print(f"{'backend':<10}{'10 keys µs':>14}{f'{args.keys} keys µs':>20}")
+        for name, make in backends.items():
+            print(f"{name:<10}{measure(make(), 10, args.checks):>14.2f}{measure(make(), args.keys, args.checks):>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
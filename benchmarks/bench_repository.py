@@ -0,0 +1,59 @@
+# Benchmark of the repository backends (app/repository.py) - the time per operation of the same workload on Postgres and in memory:
+# creating users, creating posts, voting, reading single posts and reading pages of the feed.
+# The in-memory backend needs no database ("--memory-only"). On Postgres, the workload runs in one transaction, rolled back at the end,
+# so nothing is left behind - it needs the DB of the settings, with the tables created (i.e. "alembic upgrade head").
+# Run from the root of the project: "python -m benchmarks.bench_repository [--users 100] [--posts 10] [--memory-only]"
+
+import argparse
+import time
+
+from app.repository import MemoryRepository, SqlRepository
+
+
+def workload(repository, users: int, posts: int):
+    # Returns the time of each step, in microseconds per operation.
+    timings = {}
+
+    def step(name, operations, function):
+        start = time.perf_counter()
+        results = [function(index) for index in range(operations)]
+        timings[name] = (time.perf_counter() - start) / operations * 1e6
+        return results
+
+    user_ids = [user.id for user in step("create user", users, lambda index: repository.create_user(
+        f"bench_repository_{index}@example.com", "not a hash"))]
+    post_ids = [post.id for post in step("create post", users * posts, lambda index: repository.create_post(
+        user_ids[index % users], f"post {index}", "x" * 200))]
+    step("vote", len(post_ids), lambda index: repository.add_vote(user_ids[(index + 1) % users], post_ids[index]))
+    step("get post", len(post_ids), lambda index: repository.get_post(post_ids[index]))
+    step("feed page", 200, lambda index: repository.feed(limit=25, skip=index * 25 % len(post_ids)))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time per operation of the repository backends.")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=10, help="Posts per user.")
+    parser.add_argument("--memory-only", action="store_true")
+    args = parser.parse_args()
+
+    results = {"memory": workload(MemoryRepository(), args.users, args.posts)}
+    if not args.memory_only:
+        from app.database import SessionLocal
+        db = SessionLocal()
+        try:
+            results["postgres"] = workload(SqlRepository(db), args.users, args.posts)
+        finally:
+            db.rollback()
+            db.close()
+
+    print(f"{'operation':<14}" + "".join(f"{backend + ' µs':>14}" for backend in results) + (f"{'speedup':>10}" if len(results) > 1 else ""))
+    for operation in results["memory"]:
+        line = f"{operation:<14}" + "".join(f"{timings[operation]:>14.1f}" for timings in results.values())
+        if "postgres" in results:
+            line += f"{results['postgres'][operation] / results['memory'][operation]:>9.0f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Benchmark of the startup of the app, with a budget check - exits with status 1 if the app takes longer than the budget to be ready
+# (importing it, and warming it up). Each run is measured in a fresh interpreter, as a new process of a deploy would be.
+# Also measures what the warm-up saves the first requests: the hot queries, bcrypt and JWT on a cold process, the first time and the second time.
+# Needs the DB of the settings, with the tables created (i.e. "alembic upgrade head").
+# Run from the root of the project: "python -m benchmarks.bench_startup [--budget-ms 5000] [--runs 3]"
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+def child():
+    """Runs in the fresh interpreter. Prints the timings in milliseconds as JSON."""
+    started = time.perf_counter()
+    import app.main  # noqa: F401
+    from app import warmup
+    from app.database import get_engine
+    import_ms = (time.perf_counter() - started) * 1000
+
+    engine = get_engine()
+    started = time.perf_counter()
+    steps = warmup.warm_up(engine)
+    warmup_ms = (time.perf_counter() - started) * 1000
+
+    # A second pass on the warmed up process, for the cost of the same work once it's warm.
+    warm_steps = warmup.warm_up(engine)
+    print(json.dumps({"import": import_ms, "warmup": warmup_ms, "steps": steps, "warm_steps": warm_steps}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=5000,
+                        help="The longest time the app may take to be ready (import and warm-up).")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_startup", "--child"],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    # The median run.
+    result = sorted(results, key=lambda result: result["import"] + result["warmup"])[len(results) // 2]
+    ready_ms = result["import"] + result["warmup"]
+    print(f"{'step':<12}{'cold ms':>10}{'warm ms':>10}")
+    print(f"{'import':<12}{result['import']:>10.1f}")
+    for step, ms in result["steps"].items():
+        print(f"{step:<12}{ms:>10.1f}{result['warm_steps'][step]:>10.1f}")
+    print(f"Ready after {ready_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+
+    if ready_ms > args.budget_ms:
+        print("Over the startup budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        child()
+    else:
+        main()
@@ -1,14 +1,25 @@
 # File for defining fixtures. Usage for Pytest.
+#
+# The tables are created once per run (per worker, with pytest-xdist: "pytest -n auto" - each worker has a database of its own), and every
+# test runs in a transaction which is rolled back at its end, so tests never see each other's rows. The session of a test works in a SAVEPOINT
+# of that transaction - commits and rollbacks of the app end the SAVEPOINT, and a new one is started right away.
+# Tests whose rows must be seen by other connections (other threads, other shards, LISTEN/NOTIFY) are marked "committed": they commit for real,
+# and the tables are emptied after them instead.
+import functools
+import os
+
 import pytest
+from fastapi.encoders import jsonable_encoder
 from fastapi.testclient import TestClient
+from passlib.hash import bcrypt
 
 from app.main import app  # The main FastAPI instance, app.
 
 from app.config import settings
 from app.database import get_db, Base
 from app.oauth2 import create_access_token
-from app import models
-from sqlalchemy import create_engine
+from app import models, prepared, ratelimit, schemas, sharding
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 
 
@@ -17,10 +28,15 @@ from sqlalchemy.orm import sessionmaker
 
 
 # First, type of database. Second, username (default is "postgres"). Third, password. Fourth, IP address. Fifth, port number. Sixth, database name.
-SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.database_username}:{settings.database_password}@\
-{settings.database_hostname}:{settings.database_port}/{settings.database_name}_tests"
+# With pytest-xdist, the name of the worker is appended ("fastapi_tests_gw0"), and so it is to the names of the databases of the shards.
+SERVER_URL = f"postgresql://{settings.database_username}:{settings.database_password}@\
+{settings.database_hostname}:{settings.database_port}"
+DATABASE_NAME = f"{settings.database_name}_tests" + (f"_{os.environ['PYTEST_XDIST_WORKER']}" if "PYTEST_XDIST_WORKER" in os.environ else "")
+SQLALCHEMY_DATABASE_URL = f"{SERVER_URL}/{DATABASE_NAME}"
 
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Running the hot queries as prepared statements, as the engine of the app does.
+prepared.install(engine)
 
 # Overriding the SessionLocal to a test session for test environment purposes. From the FastAPI documentation.
 TestingSessionLocal = sessionmaker(
@@ -31,24 +47,80 @@ TestingSessionLocal = sessionmaker(
 # client = TestClient(app) # This may also be set as a fixtures, to then be returned instead.
 
 
+def pytest_configure(config):
+    config.addinivalue_line("markers", "committed: the test commits for real, for other connections to see its rows")
+
+
+def create_database(url: str):
+    """Creates the database of a URL on the server of the tests, when missing."""
+    name = url.rsplit("/", 1)[1]
+    server = create_engine(f"{SERVER_URL}/postgres", isolation_level="AUTOCOMMIT")
+    try:
+        with server.connect() as connection:
+            if not connection.execute(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": name}).first():
+                connection.execute(text(f'CREATE DATABASE "{name}"'))
+    finally:
+        server.dispose()
+
+
+def create_tables(bind):
+    # From scratch, so the tables always match the models - whatever was left by a run of an older version of them.
+    with bind.begin() as connection:
+        connection.execute(text("DROP SCHEMA public CASCADE"))
+        connection.execute(text("CREATE SCHEMA public"))
+    Base.metadata.create_all(bind=bind)
+
+
+def empty_tables(bind):
+    """Empties all the tables (numbering the rows from 1 again), and drops the partitions of the posts made by the tests. Rather than
+    dropping and creating the tables, which takes longer."""
+    with bind.begin() as connection:
+        for name, in connection.execute(text("SELECT relname FROM pg_class WHERE relname ~ '^posts_[0-9]{4}_[0-9]{2}$' AND relkind = 'r'")):
+            connection.execute(text(f"DROP TABLE {name}"))
+        connection.execute(text(f"TRUNCATE {', '.join(table.name for table in Base.metadata.sorted_tables)} RESTART IDENTITY CASCADE"))
+
+
+# The tables are created once, before the first test.
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    create_database(SQLALCHEMY_DATABASE_URL)
+    create_tables(engine)
+    yield
+    engine.dispose()
+
+
 # Fixture for yielding the Database object. Used to create dependencies across fixtures.
 # This still allows for data to be manipulated, by passing "session" in the request.
 # Scope will run once per whatever level chosen - once per function will run fixture before each test function is run.
 @pytest.fixture(scope="function")
-def session():
-    # The tables are dropped FIRST before anything else. This avoids redundancies of entering unique values for each test.
-    Base.metadata.drop_all(bind=engine)
+def session(request):
+    if request.node.get_closest_marker("committed"):
+        db = TestingSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+            empty_tables(engine)
+        return
 
-    # This is enough to create all the tables defined in app.models. When pytest runs first time, this ensures all schemas are created.
-    # This allows to create clean new tables to be populated, since the tables were first dropped, AFTER returning the TestClient.
-    Base.metadata.create_all(bind=engine)
+    # The transaction of the test, never committed. The session runs in a SAVEPOINT of it, started again whenever the app ends it.
+    connection = engine.connect()
+    transaction = connection.begin()
+    db = TestingSessionLocal(bind=connection)
+    savepoint = [connection.begin_nested()]
+
+    @event.listens_for(db, "after_transaction_end")
+    def restart_savepoint(db, ended):
+        if not savepoint[0].is_active:
+            savepoint[0] = connection.begin_nested()
 
     # This returns the DB object and allows to make queries to it.
-    db = TestingSessionLocal()
     try:
         yield db
     finally:
         db.close()
+        transaction.rollback()
+        connection.close()
 
 
 # Fixture. A function that runs before the actual tests. This allows to use values in multiple places.
@@ -66,40 +138,40 @@ def client(session):  # Dependency to session.
 
     # Overrides the dependencies of get_db instance with the test db. From FastAPI documentation. Basically swaps the dependencies out.
     app.dependency_overrides[get_db] = override_get_db
+    # Every test starts with full token buckets - the client of every test has the same IP address, and the users the same ids.
+    ratelimit.limiter.reset()
     # Runs the tests and populates clean tables, which allows for unique entries to be repeated.
     yield TestClient(app)
 
 
-# Fixture for creating a test user for testing purposes.
-@pytest.fixture
-def test_user(client):  # Making request to client to access session.
-    user_data = {"email": "1@1.com", "password": "1"}
+# The passwords of the test users, hashed once per run - and with the fewest rounds bcrypt allows, rather than the default of the app,
+# so logging in (which verifies the hash) is quick as well.
+@functools.lru_cache()
+def hashed(password: str) -> str:
+    return bcrypt.using(rounds=4).hash(password)
 
-    # Sending request to users api endpoint. Data for new user.
-    res = client.post("/users/", json=user_data)
-    assert res.status_code == 201  # Created.
-    new_user = res.json()  # Getting the dictionary.
-    # Taking password from user_data and setting it to new_user password to match credentials.
-    new_user["password"] = user_data["password"]
 
-    # This allows to pass in required fields into other tests dependent of this fixture, even if test user credentials are changed here.
-    return new_user
+# Creates a user as "POST /users/" does (placed on a shard, and copied to the others), without hashing the password on every test.
+# Returns the user as "POST /users/" answers, along with the password.
+def create_user(session, email: str, password: str):
+    user = models.User(email=email, password=hashed(password), shard=sharding.router.place(email))
+    session.add(user)
+    session.commit()
+    sharding.router.replicate_users([user])
+    return {**jsonable_encoder(schemas.UserOut.from_orm(user)), "password": password}
 
 
 # Fixture for creating a test user for testing purposes.
 @pytest.fixture
-def test_user_two(client):  # Making request to client to access session.
-    user_data = {"email": "2@2.com", "password": "2"}
+def test_user(client, session):
+    # This allows to pass in required fields into other tests dependent of this fixture, even if test user credentials are changed here.
+    return create_user(session, "1@1.com", "1")
 
-    # Sending request to users api endpoint. Data for new user.
-    res = client.post("/users/", json=user_data)
-    assert res.status_code == 201  # Created.
-    new_user = res.json()  # Getting the dictionary.
-    # Taking password from user_data and setting it to new_user password to match credentials.
-    new_user["password"] = user_data["password"]
 
-    # This allows to pass in required fields into other tests dependent of this fixture, even if test user credentials are changed here.
-    return new_user
+# Fixture for creating a test user for testing purposes.
+@pytest.fixture
+def test_user_two(client, session):
+    return create_user(session, "2@2.com", "2")
 
 
 @pytest.fixture
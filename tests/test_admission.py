@@ -0,0 +1,56 @@
+import pytest
+
+from app import admission
+
+
+@pytest.mark.parametrize("method, path, route_class", [
+    ("GET", "/posts/", "read"),
+    ("GET", "/posts/1", "read"),
+    ("POST", "/posts/", "write"),
+    ("DELETE", "/posts/1", "write"),
+    ("POST", "/votes/", "write"),
+    ("POST", "/login", "auth"),
+    ("GET", "/live/votes", "stream"),
+])
+def test_classify(method, path, route_class):
+    assert admission.classify(method, path) == route_class
+
+
+# Fixture for temporarily lowering a limit of the admission controller, and restoring it after the test.
+@pytest.fixture
+def max_in_flight():
+    limits = dict(admission.controller.max_in_flight)
+    yield admission.controller.max_in_flight
+    admission.controller.max_in_flight.update(limits)
+
+
+# With no capacity left for reads, requests are shed with "503" and a "Retry-After" header, without reaching the DB.
+def test_read_shed_when_in_flight_limit_reached(authorized_client, max_in_flight):
+    max_in_flight["read"] = 0
+    res = authorized_client.get("/posts/")
+    assert res.status_code == 503  # Service Unavailable.
+    assert res.headers["Retry-After"] == str(
+        admission.controller.retry_after_seconds)
+
+
+# Writes being shed must not affect reads.
+def test_read_admitted_when_writes_shed(authorized_client, test_posts, max_in_flight):
+    max_in_flight["write"] = 0
+    res = authorized_client.post(
+        "/posts/", json={"title": "title", "content": "content"})
+    assert res.status_code == 503  # Service Unavailable.
+
+    res = authorized_client.get("/posts/")
+    assert res.status_code == 200  # OK.
+
+
+# The average pool wait decays, so requests aren't shed forever after the pool was slow for a moment.
+def test_pool_wait_decays(monkeypatch):
+    stats = admission.PoolStats()
+    stats.begin_wait("read")
+    stats.end_wait("read", 1000)
+    assert stats.wait_ms("read") == pytest.approx(200, rel=0.01)
+
+    clock = admission.time.monotonic() + 10 * stats.half_life_seconds
+    monkeypatch.setattr(admission.time, "monotonic", lambda: clock)
+    assert stats.wait_ms("read") < 1
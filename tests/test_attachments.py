@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import os
+import time
+from io import BytesIO
+
+import pytest
+
+from app import attachments, sharding
+from app.config import settings
+from .conftest import engine
+
+IMAGE = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "attachments_dir", str(tmp_path))
+    return tmp_path
+
+
+def upload(client, post_id, content=IMAGE, content_type="image/png", filename="image.png", headers=None):
+    return client.post(f"/posts/{post_id}/attachments?filename={filename}", data=content,
+                       headers={"Content-Type": content_type, **(headers or {})})
+
+
+def test_upload_attachment(storage, authorized_client, test_posts):
+    post_id, other_post_id = test_posts[0].id, test_posts[1].id
+    etag = authorized_client.get(f"/posts/{post_id}").headers["etag"]
+    res = upload(authorized_client, post_id)
+    assert res.status_code == 201
+    attachment = res.json()
+    sha256 = hashlib.sha256(IMAGE).hexdigest()
+    assert (attachment["sha256"], attachment["size"], attachment["content_type"], attachment["filename"]) == (
+        sha256, len(IMAGE), "image/png", "image.png")
+    with open(attachments.path(sha256), "rb") as file:
+        assert file.read() == IMAGE
+
+    # Posts carry the metadata of their attachments, and their ETag changes along with them.
+    res = authorized_client.get(f"/posts/{post_id}")
+    assert [item["sha256"] for item in res.json()["Post"]["attachments"]] == [sha256]
+    assert res.headers["etag"] != etag
+    feed = authorized_client.get("/posts/").json()
+    assert {post["Post"]["id"]: len(post["Post"]["attachments"]) for post in feed}[post_id] == 1
+
+    # The same file is stored once, and attached once.
+    assert upload(authorized_client, post_id).status_code == 201
+    assert upload(authorized_client, other_post_id).status_code == 201
+    assert len(authorized_client.get(f"/posts/{post_id}").json()["Post"]["attachments"]) == 1
+    assert sum(len(files) for _, _, files in os.walk(storage)) == 1
+
+
+def test_upload_refused(storage, authorized_client, test_posts, monkeypatch):
+    post_id, other_users_post_id = test_posts[0].id, test_posts[3].id
+    assert upload(authorized_client, post_id, content_type="text/html").status_code == 415
+    assert upload(authorized_client, post_id, content=b"").status_code == 400
+    assert upload(authorized_client, 12345678).status_code == 404
+    assert upload(authorized_client, other_users_post_id).status_code == 403
+
+    monkeypatch.setattr(settings, "attachment_max_bytes", 100)
+    assert upload(authorized_client, post_id).status_code == 413
+
+    # Streamed uploads (without a length up front) are stopped once they're too large, and nothing is left behind.
+    def chunks():
+        for _ in range(10):
+            yield IMAGE[:50]
+    assert upload(authorized_client, post_id, content=chunks()).status_code == 413
+    assert sum(len(files) for _, _, files in os.walk(storage)) == 0
+
+
+def test_download_attachment(storage, authorized_client, test_posts):
+    post_id, other_post_id = test_posts[0].id, test_posts[1].id
+    sha256 = upload(authorized_client, post_id).json()["sha256"]
+    url = f"/posts/{post_id}/attachments/{sha256}"
+
+    res = authorized_client.get(url)
+    assert res.status_code == 200
+    assert res.content == IMAGE
+    assert res.headers["content-type"] == "image/png"
+    assert res.headers["etag"] == f'"{sha256}"'
+    assert res.headers["accept-ranges"] == "bytes"
+    assert "immutable" in res.headers["cache-control"]
+
+    res = authorized_client.get(url, headers={"Range": "bytes=10-19"})
+    assert res.status_code == 206
+    assert res.content == IMAGE[10:20]
+    assert res.headers["content-range"] == f"bytes 10-19/{len(IMAGE)}"
+    assert authorized_client.get(url, headers={"Range": "bytes=-5"}).content == IMAGE[-5:]
+    assert authorized_client.get(url, headers={"Range": "bytes=1000-"}).content == IMAGE[1000:]
+    res = authorized_client.get(url, headers={"Range": f"bytes={len(IMAGE)}-"})
+    assert res.status_code == 416
+    assert res.headers["content-range"] == f"bytes */{len(IMAGE)}"
+
+    assert authorized_client.get(url, headers={"If-None-Match": f'"{sha256}"'}).status_code == 304
+    assert authorized_client.head(url, stream=True).headers["content-length"] == str(len(IMAGE))
+    assert authorized_client.get(f"/posts/{other_post_id}/attachments/{sha256}").status_code == 404
+    assert authorized_client.get(f"/posts/{post_id}/attachments/..%2F..%2Fetc").status_code in (404, 422)
+    # Not readable once the post is deleted.
+    assert authorized_client.delete(f"/posts/{post_id}").status_code == 204
+    assert authorized_client.get(url).status_code == 404
+
+
+# Servers supporting the "http.response.zerocopy" extension are handed the file, to send it with sendfile.
+def test_zerocopy_response(storage):
+    sha256 = attachments.store_bytes(IMAGE)
+    response = attachments.FileRangeResponse(attachments.path(sha256), 100, 199, 206, {})
+    messages = []
+
+    async def send(message):
+        if message["type"] == "http.response.zerocopy":
+            message["content"] = os.pread(message["file"].fileno(), message["count"], message["offset"])
+        messages.append(message)
+
+    asyncio.run(response({"type": "http", "extensions": {"http.response.zerocopy": {}}}, None, send))
+    assert messages[0]["status"] == 206
+    assert (b"content-length", b"100") in messages[0]["headers"]
+    assert messages[1]["type"] == "http.response.zerocopy"
+    assert messages[1]["content"] == IMAGE[100:200]
+
+
+# Thumbnails are made in the background, and recorded on the shard of the post (with connections of their own, so the test commits).
+@pytest.mark.committed
+def test_thumbnail(storage, authorized_client, test_posts, monkeypatch):
+    monkeypatch.setattr(sharding, "router", sharding.ShardRouter([], main_engine=engine))
+    monkeypatch.setattr(attachments, "make_thumbnail", lambda path: b"small")
+    post_id = test_posts[0].id
+    sha256 = upload(authorized_client, post_id).json()["sha256"]
+    url = f"/posts/{post_id}/attachments/{sha256}/thumbnail"
+    assert authorized_client.get(url).status_code == 404
+
+    thumbnail_sha256 = attachments.thumbnail(post_id, sha256)
+    assert thumbnail_sha256 == hashlib.sha256(b"small").hexdigest()
+    res = authorized_client.get(url)
+    assert res.status_code == 200
+    assert (res.content, res.headers["content-type"]) == (b"small", "image/jpeg")
+    assert authorized_client.get(f"/posts/{post_id}").json()["Post"]["attachments"][0]["thumbnail_sha256"] == thumbnail_sha256
+
+
+# Thumbnails are made with Pillow, no larger than "thumbnail_size" on either side.
+def test_make_thumbnail(storage):
+    Image = pytest.importorskip("PIL.Image")
+    content = BytesIO()
+    Image.new("RGBA", (600, 300), (255, 0, 0, 128)).save(content, "PNG")
+    sha256 = attachments.store_bytes(content.getvalue())
+
+    with Image.open(BytesIO(attachments.make_thumbnail(attachments.path(sha256)))) as thumbnail:
+        assert (thumbnail.format, thumbnail.size) == ("JPEG", (settings.thumbnail_size, settings.thumbnail_size // 2))
+
+
+# Storing a file again marks it as new, so a file orphaned before and uploaded again isn't removed before its metadata is committed.
+def test_storing_again_renews_the_grace_period(storage):
+    async def chunks():
+        yield b"orphaned"
+
+    sha256 = attachments.store_bytes(b"orphaned")
+    for store in (lambda: attachments.store_bytes(b"orphaned"), lambda: asyncio.run(attachments.store_stream(chunks()))):
+        os.utime(attachments.path(sha256), (0, 0))
+        store()
+        assert os.path.getmtime(attachments.path(sha256)) > time.time() - 60
+    # Only the stored file is left - not the temporary one of the upload.
+    assert [name for _, _, names in os.walk(storage) for name in names] == [sha256]
+
+
+# Files no longer attached to any post are removed, once they're older than the grace period.
+@pytest.mark.committed
+def test_gc(storage, authorized_client, test_posts, monkeypatch):
+    monkeypatch.setattr(sharding, "router", sharding.ShardRouter([], main_engine=engine))
+    kept = upload(authorized_client, test_posts[0].id).json()["sha256"]
+    removed = attachments.store_bytes(b"not attached")
+
+    assert attachments.gc(grace_seconds=3600) == 0
+    assert attachments.gc(grace_seconds=0) == 1
+    assert attachments.exists(kept) and not attachments.exists(removed)
@@ -0,0 +1,62 @@
+import msgpack
+import pytest
+
+from app import schemas
+from app.encoding import accepts_msgpack
+
+MSGPACK = "application/msgpack"
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, False),
+    ("application/json", False),
+    ("application/msgpack", True),
+    ("application/x-msgpack", True),
+    ("application/msgpack, */*", True),
+    ("application/json, application/msgpack;q=0.5", False),
+    ("application/json;q=0.5, application/msgpack", True),
+    ("application/msgpack;q=0", False),
+])
+def test_accepts_msgpack(accept, expected):
+    assert accepts_msgpack(accept) == expected
+
+
+def test_get_all_posts_msgpack(authorized_client, test_posts):
+    res = authorized_client.get("/posts/", headers={"Accept": MSGPACK})
+    assert res.status_code == 200  # OK.
+    assert res.headers["content-type"] == MSGPACK
+    assert "Accept" in res.headers["Vary"]
+    posts = [schemas.PostVotes(**post) for post in msgpack.unpackb(res.content)]
+    assert len(posts) == len(test_posts)
+
+
+# The JSON and MessagePack bodies of the same post are different representations, with different ETags.
+def test_get_one_post_etag_per_format(authorized_client, test_posts):
+    post_id = test_posts[0].id
+    json_etag = authorized_client.get(f"/posts/{post_id}").headers["ETag"]
+    res = authorized_client.get(f"/posts/{post_id}", headers={
+                                "Accept": MSGPACK, "If-None-Match": json_etag})
+    assert res.status_code == 200  # OK.
+    assert res.headers["ETag"] != json_etag
+
+
+# Request bodies may be sent as MessagePack.
+def test_create_post_msgpack(authorized_client, test_user):
+    res = authorized_client.post("/posts/", data=msgpack.packb({"title": "packed", "content": "packed content"}),
+                                 headers={"Content-Type": MSGPACK, "Accept": MSGPACK})
+    assert res.status_code == 201  # Created.
+    created_post = schemas.Post(**msgpack.unpackb(res.content))
+    assert created_post.title == "packed"
+    assert created_post.users_id == test_user["id"]
+
+
+def test_vote_msgpack(authorized_client, test_posts):
+    res = authorized_client.post("/votes/", data=msgpack.packb({"post_id": test_posts[0].id, "dir": 1}),
+                                 headers={"Content-Type": MSGPACK})
+    assert res.status_code == 201  # Created.
+
+
+def test_invalid_msgpack_body(authorized_client, test_user):
+    res = authorized_client.post("/posts/", data=msgpack.packb({"title": "no content"}),
+                                 headers={"Content-Type": MSGPACK})
+    assert res.status_code == 422  # Unprocessable Entity.
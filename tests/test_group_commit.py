@@ -0,0 +1,158 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import group_commit, models, sharding
+from app.config import settings
+from app.database import get_db
+from app.main import app
+from .conftest import engine, SQLALCHEMY_DATABASE_URL
+
+# The rows of these tests are read by other connections, so they're committed (see tests/conftest.py).
+pytestmark = pytest.mark.committed
+
+
+@pytest.fixture
+def groups(session, monkeypatch):
+    # Posts are written on the test database, in groups collected for up to half a second.
+    monkeypatch.setattr(sharding, "router", sharding.ShardRouter([], main_engine=engine))
+    monkeypatch.setattr(settings, "post_group_commit_enabled", True)
+    monkeypatch.setattr(settings, "post_group_commit_window_ms", 500)
+    # The sizes of the groups written.
+    sizes = []
+    write_posts = group_commit.write_posts
+
+    def counting_write_posts(db, shard, users_ids, posts):
+        sizes.append(len(posts))
+        return write_posts(db, shard, users_ids, posts)
+    monkeypatch.setattr(group_commit, "write_posts", counting_write_posts)
+    return sizes
+
+
+# Creates posts from concurrent threads. Returns the results (or errors) in the order of the posts.
+def create_concurrently(users_ids, posts):
+    results = [None] * len(posts)
+
+    def create(index):
+        try:
+            results[index] = group_commit.posts.create_post(0, users_ids[index], posts[index])
+        except Exception as error:
+            results[index] = error
+
+    threads = [threading.Thread(target=create, args=(index,)) for index in range(len(posts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_create_post_group_commit(groups, authorized_client, test_user, session):
+    res = authorized_client.post("/posts/", json={"title": "grouped", "content": "content"})
+    assert res.status_code == 201
+    post = res.json()
+    assert post["title"] == "grouped" and post["published"] is True
+    assert post["owner"]["id"] == post["users_id"] == test_user["id"]
+    assert sharding.post_owner(post["id"]) == test_user["id"]
+    assert groups == [1]
+
+    assert session.query(models.OutboxEvent).filter(models.OutboxEvent.topic == "post.created").count() == 1
+    assert authorized_client.get(f"/users/{test_user['id']}/stats").json()["posts"] == 1
+
+
+# Posts created within the window are written with one INSERT and one commit. Each request gets its own post, numbered in order.
+def test_concurrent_posts_share_one_commit(groups, test_user, test_user_two, session, monkeypatch):
+    monkeypatch.setattr(settings, "post_group_commit_max_posts", 4)
+    users_ids = [test_user["id"]] * 3 + [test_user_two["id"]] * 3
+    posts = [{"title": f"post {number}", "content": "content", "published": True} for number in range(6)]
+    results = create_concurrently(users_ids, posts)
+
+    # A full group is written right away, and the rest forms the next one.
+    assert sorted(groups) == [2, 4]
+    assert [result["title"] for result in results] == [post["title"] for post in posts]
+    for users_id in (test_user["id"], test_user_two["id"]):
+        ids = sorted(result["id"] for result in results if result["users_id"] == users_id)
+        assert ids == [sharding.make_post_id(users_id, seq) for seq in (1, 2, 3)]
+    assert session.query(models.Post).count() == 6
+
+
+# A post Postgres doesn't take fails on its own - the other posts of its group are still created.
+def test_errors_stay_with_their_request(groups, test_user, test_user_two, session):
+    posts = [{"title": "fine", "content": "content", "published": True},
+             {"title": "not \x00 fine", "content": "content", "published": True},
+             {"title": "also fine", "content": "content", "published": True}]
+    results = create_concurrently([test_user["id"], test_user_two["id"], test_user["id"]], posts)
+
+    assert isinstance(results[1], Exception)
+    assert results[0]["title"] == "fine" and results[2]["title"] == "also fine"
+    assert groups[0] == 3 and sorted(groups[1:]) == [1, 1, 1]
+    assert session.query(models.Post).count() == 2
+    assert session.query(models.UserStats).filter(models.UserStats.users_id == test_user_two["id"]).count() == 0
+
+
+# Users who aren't on the shard (i.e. being moved) get no post, and their request is answered with "503".
+def test_user_not_on_the_shard(groups, test_user, session):
+    session.query(models.User).update({"shard": 1})
+    session.commit()
+    assert group_commit.posts.create_post(0, test_user["id"], {"title": "t", "content": "c", "published": True}) is None
+    assert session.query(models.Post).count() == 0
+
+
+# Requests waiting in groups hold threads, so no more than the maximum wait across all shards - a post past it is written right away.
+def test_posts_past_the_maximum_do_not_wait(groups, test_user, session, monkeypatch):
+    monkeypatch.setattr(settings, "post_group_commit_max_posts", 1)
+    # A request waiting in the group of another shard.
+    monkeypatch.setattr(group_commit.posts, "_groups", {1: group_commit.Group()})
+    monkeypatch.setattr(group_commit.posts, "_waiting", 1)
+
+    start = time.monotonic()
+    created = group_commit.posts.create_post(0, test_user["id"], {"title": "t", "content": "c", "published": True})
+    assert time.monotonic() - start < settings.post_group_commit_window_ms / 1000
+    assert created["title"] == "t"
+    assert groups == [1]
+    assert group_commit.posts._waiting == 1
+
+
+# A group which is never written doesn't keep its requests waiting forever.
+def test_requests_give_up_on_groups_not_written(groups, test_user, monkeypatch):
+    monkeypatch.setattr(settings, "post_group_commit_timeout_ms", 100)
+    monkeypatch.setattr(group_commit.GroupCommit, "write", lambda self, shard, group: None)
+    with pytest.raises(group_commit.Timeout):
+        group_commit.posts.create_post(0, test_user["id"], {"title": "t", "content": "c", "published": True})
+    assert group_commit.posts._waiting == 0
+
+
+# Requests waiting in a group don't hold a connection - the group gets one even when the pool has none to spare for each request.
+def test_requests_in_a_group_share_a_small_pool(groups, client, token, test_user, monkeypatch):
+    small_engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_size=2, max_overflow=0, pool_timeout=5)
+    SmallSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=small_engine)
+
+    def small_get_db():
+        db = SmallSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+    monkeypatch.setitem(app.dependency_overrides, get_db, small_get_db)
+    monkeypatch.setattr(sharding, "router", sharding.ShardRouter([], main_engine=small_engine))
+    monkeypatch.setattr(settings, "post_group_commit_max_posts", 2)
+
+    responses = [None] * 2
+
+    def create(index):
+        responses[index] = client.post("/posts/", json={"title": f"post {index}", "content": "content"},
+                                       headers={"Authorization": f"Bearer {token}"})
+
+    threads = [threading.Thread(target=create, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    small_engine.dispose()
+
+    assert [res.status_code for res in responses] == [201, 201]
+    assert all(res.json()["owner"]["id"] == test_user["id"] for res in responses)
+    assert groups == [2]
@@ -0,0 +1,45 @@
+import pytest
+
+from app import warmup
+from app.admission import classify, controller
+from .conftest import engine
+
+
+def test_healthz(client):
+    res = client.get("/healthz")
+    assert res.status_code == 200
+    assert res.json() == {"status": "ok"}
+
+
+# Not ready until warmed up, and not while the pool is saturated.
+def test_readyz(client, monkeypatch):
+    monkeypatch.setattr(warmup.readiness, "ready", False)
+    assert client.get("/readyz").status_code == 503
+
+    monkeypatch.setattr(warmup.readiness, "ready", True)
+    monkeypatch.setattr(warmup.readiness, "warmup_ms", 12.3)
+    res = client.get("/readyz")
+    assert res.status_code == 200
+    assert res.json() == {"status": "ready", "warmup_ms": 12}
+
+    monkeypatch.setattr(controller, "rejection_reason",
+                        lambda route_class: "Too many requests" if route_class == "read" else None)
+    assert client.get("/readyz").json() == {"status": "database unavailable"}
+
+
+# The probes are never shed by the admission control.
+@pytest.mark.parametrize("path", ["/healthz", "/readyz"])
+def test_probes_are_not_shed(path):
+    assert classify("GET", path) == "probe"
+    assert controller.rejection_reason("probe") is None
+
+
+# The warm-up opens connections of the pool, and leaves them in the pool with the hot queries prepared on them.
+def test_warm_up(session):
+    engine.dispose()
+    timings = warmup.warm_up(engine, connections=2)
+    assert set(timings) == {"pool", "queries", "bcrypt", "jwt"}
+    assert engine.pool.checkedin() == 2
+
+    with engine.connect() as connection:
+        assert len(connection.connection.info["prepared_statements"]) == len(warmup.hot_queries())
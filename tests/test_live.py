@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from app import live
+
+from .conftest import engine
+
+
+# Votes are published with NOTIFY once committed. Listening on a connection of its own to the test DB.
+# Committed, as notifications are only sent once the transaction commits.
+@pytest.mark.committed
+def test_vote_publishes_change(authorized_client, test_posts):
+    post_id = test_posts[0].id
+    connection = engine.raw_connection()
+    try:
+        connection.connection.autocommit = True
+        connection.cursor().execute(f"LISTEN {live.CHANNEL}")
+
+        res = authorized_client.post(
+            "/votes/", json={"post_id": post_id, "dir": 1})
+        assert res.status_code == 201  # Created.
+
+        connection.connection.poll()
+        assert [int(notify.payload) for notify in connection.connection.notifies] == [post_id]
+    finally:
+        connection.connection.autocommit = False
+        connection.close()
+
+
+# Many changes of the same post within one tick are read and sent once, and only to the subscribers of that post.
+def test_hub_coalesces_changes_per_tick():
+    loaded = []
+
+    def load_counts(post_ids):
+        loaded.append(sorted(post_ids))
+        return {post_id: 7 for post_id in post_ids}
+
+    async def scenario():
+        hub = live.VoteHub(load_counts)
+        hub.run = lambda: asyncio.sleep(0)  # Not listening on the DB.
+        first = hub.subscribe([1, 2])
+        second = hub.subscribe([2])
+
+        for post_id in (1, 1, 1, 3):  # Nobody is subscribed to post 3.
+            hub.mark_dirty(post_id)
+        await hub.tick()
+
+        assert loaded == [[1]]
+        assert first.take() == {1: 7}
+        assert not second.ready.is_set()
+
+        hub.unsubscribe(first)
+        hub.mark_dirty(1)
+        await hub.tick()
+        assert loaded == [[1]]  # No subscribers of post 1 left.
+
+    asyncio.run(scenario())
+
+
+# A slow client only gets the latest count of each post, however many updates it missed.
+def test_subscription_keeps_latest_count_only():
+    async def scenario():
+        subscription = live.Subscription([1, 2])
+        for votes in range(100):
+            subscription.push({1: votes})
+        subscription.push({2: 5})
+        assert subscription.take() == {1: 99, 2: 5}
+        assert subscription.take() == {}
+
+    asyncio.run(scenario())
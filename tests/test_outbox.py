@@ -0,0 +1,66 @@
+import pytest
+
+from app import models, outbox
+
+
+# Fixture for registering a handler for a topic during a test. Returns the list of payloads the handler was called with.
+@pytest.fixture
+def delivered(monkeypatch):
+    payloads = []
+    monkeypatch.setitem(outbox.handlers, "post.created",
+                        [lambda db, payload: payloads.append(payload)])
+    return payloads
+
+
+# The event is committed along with the post itself.
+def test_create_post_writes_outbox_event(authorized_client, test_user, session):
+    res = authorized_client.post(
+        "/posts/", json={"title": "title", "content": "content"})
+    assert res.status_code == 201  # Created.
+
+    event = session.query(models.OutboxEvent).one()
+    assert event.topic == "post.created"
+    assert event.payload == {"post_id": res.json()["id"],
+                             "users_id": test_user["id"]}
+
+
+@pytest.mark.parametrize("dir, topic", [(1, "vote.created"), (0, "vote.deleted")])
+def test_vote_writes_outbox_event(authorized_client, test_posts, session, dir, topic):
+    post_id = test_posts[0].id
+    if dir == 0:
+        authorized_client.post(
+            "/votes/", json={"post_id": post_id, "dir": 1})
+    res = authorized_client.post(
+        "/votes/", json={"post_id": post_id, "dir": dir})
+    assert res.status_code == 201  # Created.
+
+    event = session.query(models.OutboxEvent).order_by(
+        models.OutboxEvent.id.desc()).first()
+    assert event.topic == topic
+    assert event.payload["post_id"] == post_id
+
+
+# Delivered events are removed from the outbox.
+def test_drain_delivers_and_removes_events(authorized_client, test_user, session, delivered):
+    authorized_client.post(
+        "/posts/", json={"title": "title", "content": "content"})
+
+    assert outbox.drain(session) == 1
+    assert len(delivered) == 1
+    assert session.query(models.OutboxEvent).count() == 0
+
+
+# Failing events are kept for a later retry, and not delivered again before their backoff has passed.
+def test_drain_retries_failed_events(session, test_user, monkeypatch):
+    def failing_handler(db, payload):
+        raise RuntimeError("handler failed")
+
+    monkeypatch.setitem(outbox.handlers, "post.created", [failing_handler])
+    outbox.enqueue(session, "post.created", post_id=1)
+    session.commit()
+
+    assert outbox.drain(session) == 1
+    event = session.query(models.OutboxEvent).one()
+    assert event.attempts == 1
+    assert "handler failed" in event.last_error
+    assert outbox.drain(session) == 0  # Backing off.
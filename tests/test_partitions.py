@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from app import models, partitions, stats
+
+from .conftest import engine
+
+
+def partition_of(session, post_id):
+    return session.execute(text("SELECT tableoid::regclass::text FROM posts WHERE id = :id UNION ALL "
+                                "SELECT tableoid::regclass::text FROM posts_archive WHERE id = :id"), {"id": post_id}).scalar()
+
+
+def test_months():
+    month = datetime(2026, 11, 1, tzinfo=timezone.utc)
+    assert partitions.add_months(month, 2) == datetime(2027, 1, 1, tzinfo=timezone.utc)
+    assert partitions.add_months(month, -11) == datetime(2025, 12, 1, tzinfo=timezone.utc)
+    # Months are in UTC.
+    assert partitions.month_of(datetime(2026, 12, 1, 0, 30, tzinfo=timezone(timedelta(hours=1)))) == month
+    assert partitions.partition_name(month) == "posts_2026_11"
+
+
+# Posts written before their partition existed are moved into it, or into the archive for old months. Old partitions are archived whole.
+def test_maintain(test_posts, session):
+    now = datetime.now(timezone.utc)
+    recent_id = test_posts[0].id
+    old = models.Post(title="old", content="old", users_id=test_posts[0].users_id, created_at=now - timedelta(days=400))
+    session.add(old)
+    session.commit()
+    old_id = old.id
+    assert partition_of(session, recent_id) == "posts_default"
+
+    created, archived = partitions.maintain(session, now=now)
+    current = partitions.month_of(now)
+    assert created == [partitions.add_months(current, offset) for offset in range(-5, 3)]
+    assert archived == [partitions.month_of(now - timedelta(days=400))]
+    assert partition_of(session, recent_id) == partitions.partition_name(current)
+    assert partition_of(session, old_id) == partitions.partition_name(archived[0])
+    # Nothing left to do.
+    assert partitions.maintain(session, now=now) == ([], [])
+
+    # Half a year later, the month of the recent posts is archived, and the months ahead are created.
+    created, archived = partitions.maintain(session, now=partitions.add_months(current, 6))
+    assert archived == [partitions.add_months(current, offset) for offset in range(-5, 1)]
+    assert created == [partitions.add_months(current, offset) for offset in range(3, 9)]
+    assert session.query(models.Post).count() == 0
+    assert session.query(models.ArchivedPost).count() == len(test_posts) + 1
+    assert partition_of(session, recent_id) == partitions.partition_name(current)
+
+
+# A maintainer skips a shard while another one (i.e. of another worker of the app) holds its lock, and runs once it's released.
+def test_maintain_exclusively(test_posts, session):
+    with engine.connect() as other:
+        assert other.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": partitions.MAINTAIN_LOCK}).scalar()
+        assert partitions.maintain_exclusively(session) == ([], [])
+        assert partition_of(session, test_posts[0].id) == "posts_default"
+        other.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": partitions.MAINTAIN_LOCK})
+
+    created, archived = partitions.maintain_exclusively(session)
+    assert partitions.month_of(datetime.now(timezone.utc)) in created
+    assert partition_of(session, test_posts[0].id) != "posts_default"
+    # The lock was released.
+    with engine.connect() as other:
+        assert other.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": partitions.MAINTAIN_LOCK}).scalar()
+        other.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": partitions.MAINTAIN_LOCK})
+
+
+# Archived posts are only read when asked for, and can't be changed.
+def test_archived_posts(authorized_client, test_user, test_posts, session):
+    post_id, other_post_id = test_posts[0].id, test_posts[1].id
+    # The archived post is the oldest, so it comes first in the feed with the archive.
+    ids = [post_id] + sorted(post.id for post in test_posts if post.id != post_id)
+    session.query(models.Post).filter(models.Post.id == post_id).update(
+        {"created_at": datetime.now(timezone.utc) - timedelta(days=400)}, synchronize_session=False)
+    session.commit()
+    partitions.maintain(session)
+
+    assert authorized_client.get(f"/posts/{post_id}").status_code == 404
+    res = authorized_client.get(f"/posts/{post_id}?archive=true")
+    assert res.status_code == 200
+    assert res.json()["Post"]["id"] == post_id and res.json()["Post"]["owner"]["id"] == test_user["id"]
+    assert authorized_client.get(f"/posts/{other_post_id}?archive=true").status_code == 200
+
+    assert [post["Post"]["id"] for post in authorized_client.get("/posts/").json()] == ids[1:]
+    assert [post["Post"]["id"] for post in authorized_client.get("/posts/?archive=true").json()] == ids
+    assert [post["id"] for post in authorized_client.get("/posts/?archive=true&fields=id,title&limit=2").json()] == ids[:2]
+
+    assert authorized_client.post("/votes/", json={"post_id": post_id, "dir": 1}).status_code == 404
+    assert authorized_client.put(f"/posts/{post_id}", json={"title": "title", "content": "content"}).status_code == 404
+    assert authorized_client.delete(f"/posts/{post_id}").status_code == 404
+    # Still counted in the statistics of the author.
+    session.query(models.UserStats).delete()
+    session.commit()
+    stats.reconcile(session)
+    assert session.get(models.UserStats, test_user["id"]).posts == 3
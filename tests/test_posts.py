@@ -1,5 +1,7 @@
+from datetime import datetime, timedelta, timezone
+
 import pytest
-from app import schemas
+from app import models, schemas, sharding
 
 # Dependant on fixtures in conftest.py. Testing for getting all posts.
 # Users must be authorized and test posts must be created first, which is handled in conftest.
@@ -12,6 +14,29 @@ def test_get_all_posts(authorized_client, test_posts):
     assert res.status_code == 200  # OK.
 
 
+# The page of the feed is bounded - negative values and pages too large or too deep are rejected before reaching the DB.
+@pytest.mark.parametrize("query", ["limit=0", "limit=101", "skip=-1", "skip=1001", "limit=-5&archive=true", "skip=10000000&archive=true"])
+def test_get_all_posts_page_out_of_bounds(authorized_client, test_posts, query):
+    res = authorized_client.get(f"/posts/?{query}")
+    assert res.status_code == 422  # Unprocessable Entity.
+
+
+# The feed is in the order the posts were created - not grouped by author, as the ids of the posts are (see app/sharding.py).
+def test_get_all_posts_in_time_order(authorized_client, test_user, test_user_two, session):
+    start = datetime.now(timezone.utc)
+    post_ids = []
+    for number in range(4):
+        user = test_user if number % 2 == 0 else test_user_two
+        post = models.Post(id=sharding.make_post_id(user["id"], number + 1), title=f"post {number}", content="content",
+                           users_id=user["id"], created_at=start + timedelta(seconds=number))
+        session.add(post)
+        post_ids.append(post.id)
+    session.commit()
+
+    assert [post["Post"]["id"] for post in authorized_client.get("/posts/").json()] == post_ids
+    assert [post["id"] for post in authorized_client.get("/posts/?fields=id&skip=1&limit=2").json()] == post_ids[1:3]
+
+
 # Client is a non-logged in user, who doesn't have authorized credentials
 def test_unauthorized_user_get_all_posts(client, test_posts):
     res = client.get("/posts/")
@@ -154,3 +179,75 @@ def test_authorized_user_update_own_post_with_wrong_id(authorized_client, test_u
         f"/posts/89494654889", json=data)  # Wrong ID.
 
     assert res.status_code == 404  # Not Found.
+
+
+# Getting a post again with its ETag returns "304 Not Modified" with no body, until it's voted on.
+def test_get_one_post_not_modified(authorized_client, test_posts):
+    post_id = test_posts[0].id
+    res = authorized_client.get(f"/posts/{post_id}")
+    etag = res.headers["ETag"]
+
+    res = authorized_client.get(
+        f"/posts/{post_id}", headers={"If-None-Match": etag})
+    assert res.status_code == 304  # Not Modified.
+    assert res.headers["ETag"] == etag
+    assert res.content == b""
+    assert "Accept" in res.headers["Vary"]
+
+    authorized_client.post("/votes/", json={"post_id": post_id, "dir": 1})
+    res = authorized_client.get(
+        f"/posts/{post_id}", headers={"If-None-Match": etag})
+    assert res.status_code == 200  # OK.
+    assert res.headers["ETag"] != etag
+
+
+# Updating a post bumps its version, which changes the ETags of the post and of the feed.
+def test_update_post_changes_etags(authorized_client, test_posts):
+    post_id = test_posts[0].id
+    post_etag = authorized_client.get(f"/posts/{post_id}").headers["ETag"]
+    feed_etag = authorized_client.get("/posts/").headers["ETag"]
+
+    authorized_client.put(
+        f"/posts/{post_id}", json={"title": "updated", "content": "updated"})
+
+    res = authorized_client.get(
+        f"/posts/{post_id}", headers={"If-None-Match": post_etag})
+    assert res.status_code == 200  # OK.
+    res = authorized_client.get("/posts/", headers={"If-None-Match": feed_etag})
+    assert res.status_code == 200  # OK.
+    assert len(res.json()) == len(test_posts)
+
+
+def test_get_all_posts_not_modified(authorized_client, test_posts):
+    res = authorized_client.get("/posts/?limit=2")
+    etag = res.headers["ETag"]
+
+    res = authorized_client.get(
+        "/posts/?limit=2", headers={"If-None-Match": f'"stale", W/{etag}'})
+    assert res.status_code == 304  # Not Modified.
+
+
+# Only the requested fields are returned, with the owner nested as in the full posts.
+def test_get_all_posts_sparse_fields(authorized_client, test_user, test_posts):
+    res = authorized_client.get("/posts/?fields=title,votes,owner")
+    assert res.status_code == 200  # OK.
+    posts = res.json()
+    assert len(posts) == len(test_posts)
+    assert set(posts[0]) == {"title", "votes", "owner"}
+    assert posts[0]["owner"]["email"] == test_user["email"]
+
+
+def test_get_all_posts_summary(authorized_client, test_posts):
+    authorized_client.put(f"/posts/{test_posts[0].id}",
+                          json={"title": "long", "content": "x" * 1000})
+    res = authorized_client.get("/posts/?view=summary")
+    assert res.status_code == 200  # OK.
+    summaries = res.json()
+    assert len(summaries) == len(test_posts)
+    assert all(set(summary) == {"id", "title", "snippet", "votes", "created_at", "users_id"} for summary in summaries)
+    assert max(len(summary["snippet"]) for summary in summaries) == 200
+
+
+def test_get_all_posts_unknown_field(authorized_client, test_posts):
+    res = authorized_client.get("/posts/?fields=title,password")
+    assert res.status_code == 400  # Bad Request.
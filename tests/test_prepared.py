@@ -0,0 +1,60 @@
+import pytest
+from sqlalchemy import text
+
+from app import prepared, queries
+from app.config import settings
+from .conftest import engine
+
+# The rows of these tests are read by other connections, so they're committed (see tests/conftest.py).
+pytestmark = pytest.mark.committed
+
+
+def test_parse_numbers_parameters_in_order():
+    name, sql, names = prepared.parse(
+        "SELECT * FROM posts WHERE title LIKE '%%' || %(search)s || '%%' AND id > %(id)s OR users_id = %(id)s LIMIT %(limit)s")
+    assert name.startswith("q_")
+    assert sql == "SELECT * FROM posts WHERE title LIKE '%' || $1 || '%' AND id > $2 OR users_id = $2 LIMIT $3"
+    assert names == ["search", "id", "limit"]
+    # The name depends on the statement only, so every connection and process uses the same one.
+    assert prepared.parse("SELECT 1")[0] == prepared.parse("SELECT 1")[0] != name
+
+
+def prepared_on_server(connection):
+    return {row.name for row in connection.execute(text("SELECT name FROM pg_prepared_statements"))}
+
+
+# A statement is prepared the first time a connection runs it, and executed by name after that.
+def test_hot_queries_are_prepared_once_per_connection(test_user):
+    with engine.connect() as connection:
+        connection.connection.info.pop("prepared_statements", None)
+        connection.exec_driver_sql("DEALLOCATE ALL")
+
+        for _ in range(2):
+            user = connection.execute(queries.user_by_id, {"id": test_user["id"]}).first()
+            assert user.email == test_user["email"]
+        assert connection.execute(queries.user_by_id, {"id": 89478956165}).first() is None
+
+        assert len(connection.connection.info["prepared_statements"]) == 1
+        assert connection.connection.info["prepared_statements"] <= prepared_on_server(connection)
+
+
+# Behind pgbouncer in transaction mode, preparing is turned off and the statements are sent as they are.
+def test_preparing_can_be_turned_off(test_user, monkeypatch):
+    monkeypatch.setattr(settings, "db_prepared_statements", False)
+    with engine.connect() as connection:
+        connection.connection.info.pop("prepared_statements", None)
+        connection.exec_driver_sql("DEALLOCATE ALL")
+
+        assert connection.execute(queries.user_by_id, {"id": test_user["id"]}).first().email == test_user["email"]
+        assert not connection.connection.info.get("prepared_statements")
+        assert prepared_on_server(connection) == set()
+
+
+@pytest.mark.parametrize("fields", [None, ("id", "title", "votes"), ("snippet", "owner")])
+def test_feed_pages_are_prepared(test_posts, fields):
+    with engine.connect() as connection:
+        rows = connection.execute(queries.feed_page(fields), {"limit": 2, "skip": 1, "search": "test"}).all()
+        assert prepared.parse(str(queries.feed_page(fields).compile(engine)))[0] in prepared_on_server(connection)
+    assert [row.votes for row in rows] == [0, 0]
+    # The statement is built once for each combination of fields.
+    assert queries.feed_page(fields) is queries.feed_page(fields)
@@ -0,0 +1,109 @@
+import threading
+
+import pytest
+from sqlalchemy import text
+
+from app import profiler
+from app.config import settings
+from .conftest import engine
+
+
+def busy_loop(stopping):
+    while not stopping.is_set():
+        sum(range(1000))
+
+
+def run_in_thread(function, *args):
+    thread = threading.Thread(target=function, args=args, name="busy")
+    thread.start()
+    return thread
+
+
+def test_unauthorized_user_profile(client):
+    assert client.get("/admin/profile?seconds=0.1").status_code == 401
+
+
+def test_profile_requires_admin(authorized_client):
+    assert authorized_client.get("/admin/profile?seconds=0.1").status_code == 403
+
+
+# Samples all threads - the busy thread shows up in the collapsed stacks, under its name.
+def test_profile_collapsed(authorized_client, test_user, monkeypatch):
+    monkeypatch.setattr(settings, "admin_user_ids", [test_user["id"]])
+    stopping = threading.Event()
+    thread = run_in_thread(busy_loop, stopping)
+    try:
+        res = authorized_client.get("/admin/profile?seconds=0.3&interval_ms=5&format=collapsed")
+    finally:
+        stopping.set()
+        thread.join()
+
+    assert res.status_code == 200
+    assert res.headers["content-disposition"].endswith('.collapsed.txt"')
+    lines = [line for line in res.text.splitlines() if line.startswith("busy;")]
+    assert lines and all("test_profiler.busy_loop" in line for line in lines)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) > 10
+
+
+def test_profile_speedscope(authorized_client, test_user, monkeypatch):
+    monkeypatch.setattr(settings, "admin_user_ids", [test_user["id"]])
+    res = authorized_client.get("/admin/profile?seconds=0.1&idle=true")
+    assert res.status_code == 200
+
+    profile = res.json()
+    assert profile["$schema"] == "https://www.speedscope.app/file-format-schema.json"
+    assert profile["profiles"]
+    for thread_profile in profile["profiles"]:
+        assert thread_profile["type"] == "sampled"
+        assert len(thread_profile["samples"]) == len(thread_profile["weights"])
+        assert all(0 <= index < len(profile["shared"]["frames"])
+                   for sample in thread_profile["samples"] for index in sample)
+
+
+# The DB session of the request is given back before sampling starts, rather than held for the whole profile.
+def test_profile_releases_db_session(authorized_client, test_user, session, monkeypatch):
+    monkeypatch.setattr(settings, "admin_user_ids", [test_user["id"]])
+    events = []
+    close, start = session.close, profiler.Sampler.start
+
+    def closing():
+        events.append("close")
+        close()
+
+    def starting(sampler):
+        events.append("start")
+        start(sampler)
+
+    monkeypatch.setattr(session, "close", closing)
+    monkeypatch.setattr(profiler.Sampler, "start", starting)
+    assert authorized_client.get("/admin/profile?seconds=0.1").status_code == 200
+    assert events[:2] == ["close", "start"]
+
+
+# Stacks are labelled with the route at the root, and the SQL statement being executed at the leaf.
+def test_route_and_sql_labels():
+    def get_slow_thing():
+        with engine.connect() as connection:
+            connection.execute(text("SELECT pg_sleep(0.3)"))
+
+    sampler = profiler.Sampler(5, routes={get_slow_thing.__code__: "route:GET /slow"})
+    sampler.start()
+    try:
+        run_in_thread(get_slow_thing).join()
+    finally:
+        sampler.stop()
+
+    stacks = [stack for thread_name, stack, _ in sampler.samples if thread_name == "busy"]
+    labelled = [stack for stack in stacks if stack[-1][0] == "sql:SELECT pg_sleep(0.3)"]
+    assert len(labelled) > 10
+    assert all(stack[0][0] == "route:GET /slow" for stack in labelled)
+
+
+def test_one_profile_at_a_time():
+    sampler = profiler.Sampler()
+    sampler.start()
+    try:
+        with pytest.raises(profiler.Busy):
+            profiler.Sampler().start()
+    finally:
+        sampler.stop()
@@ -0,0 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from app import models, utils
+from app.provision import provision
+
+
+# Users are created in batches, with hashed passwords. Invalid rows are skipped, and an email listed twice is created once.
+def test_provision_creates_users(client, test_user, session):
+    rows = [{"email": "a@example.com", "password": "a"},
+            {"email": "not an email", "password": "b"},
+            {"email": "c@example.com", "password": "c"},
+            {"email": test_user["email"], "password": "other"},
+            {"email": "c@example.com", "password": "c2"},
+            {"email": "e@example.com"}]
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        counts = provision(session, rows, batch_size=3, executor=executor, total=len(rows))
+    assert counts == {"created": 2, "existing": 2, "invalid": 2}
+
+    users = {user.email: user for user in session.query(models.User)}
+    assert set(users) == {"a@example.com", "c@example.com", test_user["email"]}
+    assert utils.verify("a", users["a@example.com"].password)
+    # The existing user is left as it was.
+    assert utils.verify(test_user["password"], users[test_user["email"]].password)
+    assert client.post("/login", data={"username": "a@example.com", "password": "a"}).status_code == 200
+
+
+# Running it again (i.e. after a crash) creates only the users missing, without hashing the passwords of the others.
+def test_provision_is_restartable(client, session, monkeypatch):
+    rows = [{"email": f"{number}@example.com", "password": str(number)} for number in range(4)]
+    provision(session, rows[:2])
+
+    hashed = []
+    monkeypatch.setattr(utils, "hash", lambda password: hashed.append(password) or f"hash of {password}")
+    assert provision(session, rows, batch_size=2) == {"created": 2, "existing": 2, "invalid": 0}
+    assert hashed == ["2", "3"]
+    assert session.query(models.User).count() == 4
@@ -0,0 +1,47 @@
+from app import models, purger
+
+
+def delete_post(client, post_id):
+    assert client.delete(f"/posts/{post_id}").status_code == 204
+
+
+# A deleted post is hidden from every read right away, while its row and votes are still there.
+def test_deleted_post_is_hidden(authorized_client, test_user, test_posts, session):
+    post_id = test_posts[0].id
+    delete_post(authorized_client, post_id)
+
+    assert authorized_client.get(f"/posts/{post_id}").status_code == 404
+    assert authorized_client.get(
+        f"/posts/{post_id}", headers={"If-None-Match": "*"}).status_code == 404
+    assert post_id not in [post["Post"]["id"] for post in authorized_client.get("/posts/").json()]
+    assert post_id not in [post["id"] for post in authorized_client.get("/posts/?fields=id").json()]
+    assert post_id not in [post["Post"]["id"] for post in authorized_client.get(
+        f"/users/{test_user['id']}/posts").json()["data"]]
+    assert authorized_client.post(
+        "/votes/", json={"post_id": post_id, "dir": 1}).status_code == 404
+    assert authorized_client.put(
+        f"/posts/{post_id}", json={"title": "title", "content": "content"}).status_code == 404
+    # Deleting it again doesn't find it.
+    assert authorized_client.delete(f"/posts/{post_id}").status_code == 404
+
+    assert session.query(models.Post).filter(models.Post.id == post_id).one().deleted_at is not None
+
+
+# The purger removes the votes of a deleted post in batches, then the post itself. Other posts are left alone.
+def test_purge_removes_votes_in_batches(authorized_client, test_user, test_user_two, test_posts, session):
+    post_id, other_post_id = test_posts[0].id, test_posts[1].id
+    session.add_all([models.Vote(post_id=post_id, user_id=test_user["id"]),
+                     models.Vote(post_id=post_id, user_id=test_user_two["id"]),
+                     models.Vote(post_id=other_post_id, user_id=test_user["id"])])
+    session.commit()
+    assert purger.purge(session) == 0  # Nothing deleted yet.
+
+    delete_post(authorized_client, post_id)
+    assert purger.purge(session, batch_size=1) == 1
+    assert session.query(models.Vote).filter(models.Vote.post_id == post_id).count() == 1
+    assert purger.purge(session, batch_size=1) == 1
+    assert purger.purge(session, batch_size=1) == 1  # The post itself.
+    assert purger.purge(session, batch_size=1) == 0
+
+    assert session.query(models.Post).filter(models.Post.id == post_id).count() == 0
+    assert session.query(models.Vote).filter(models.Vote.post_id == other_post_id).count() == 1
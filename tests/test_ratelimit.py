@@ -0,0 +1,86 @@
+import pytest
+
+from app import ratelimit
+from app.config import settings
+from app.oauth2 import create_access_token
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    def set_limit(policy, burst, per_minute=1):
+        per_minute_setting, burst_setting = ratelimit.POLICIES[policy]
+        monkeypatch.setattr(settings, per_minute_setting, per_minute)
+        monkeypatch.setattr(settings, burst_setting, burst)
+    return set_limit
+
+
+def test_refill():
+    # A full bucket gives a token. An empty one tells how long until the next token.
+    assert ratelimit.refill(5, 0, 0, rate=1, burst=5) == (4, 0)
+    assert ratelimit.refill(0, 0, 0, rate=2, burst=5) == (0, 0.5)
+    # Refilled with the time passed, up to the burst.
+    assert ratelimit.refill(0, 0, 1.5, rate=2, burst=5) == (2, 0)
+    assert ratelimit.refill(0, 0, 100, rate=2, burst=5) == (4, 0)
+
+
+# Login attempts are limited by IP address, before any password is checked.
+def test_login_is_limited_by_ip(client, limits):
+    limits("auth", burst=3)
+    for attempt in range(3):
+        assert client.post("/login", data={"username": f"{attempt}@example.com", "password": "wrong"}).status_code == 403
+    res = client.post("/login", data={"username": "other@example.com", "password": "wrong"})
+    assert res.status_code == 429
+    assert int(res.headers["retry-after"]) >= 1
+    # Not limited: the probes.
+    assert client.get("/healthz").status_code == 200
+
+
+# Login attempts on the same account are limited as well, from any IP address.
+def test_login_is_limited_by_account(client, test_user, limits):
+    limits("login_account", burst=2)
+    assert client.post("/login", data={"username": "1@1.com", "password": "wrong"}).status_code == 403
+    assert client.post("/login", data={"username": "1@1.com", "password": "1"}).status_code == 200
+    assert client.post("/login", data={"username": "1@1.com", "password": "1"}).status_code == 429
+    assert client.post("/login", data={"username": "2@2.com", "password": "wrong"}).status_code == 403
+
+
+# Logged in clients are limited by their user, each route class on its own.
+def test_requests_are_limited_by_user(client, test_user, test_user_two, limits):
+    limits("read", burst=2)
+    user_one = {"Authorization": f"Bearer {create_access_token({'user_id': test_user['id']})}"}
+    user_two = {"Authorization": f"Bearer {create_access_token({'user_id': test_user_two['id']})}"}
+    assert [client.get("/posts/", headers=user_one).status_code for _ in range(3)] == [200, 200, 429]
+    assert client.get("/posts/", headers=user_two).status_code == 200
+    assert client.post("/posts/", json={"title": "title", "content": "content"}, headers=user_one).status_code == 201
+    # A token which doesn't verify counts for the IP address, not for the user it names.
+    forged = {"Authorization": f"Bearer {create_access_token({'user_id': test_user['id']})}x"}
+    assert client.get("/posts/", headers=forged).status_code == 401
+
+
+def test_memory_backend_is_bounded():
+    backend = ratelimit.MemoryBackend(max_keys=2)
+    assert backend.take("a", rate=1, burst=1).allowed
+    assert not backend.take("a", rate=1, burst=1).allowed
+    backend.take("b", rate=1, burst=1)
+    backend.take("c", rate=1, burst=1)
+    # The least recently used bucket was dropped - along with the debt of its client.
+    assert len(backend._buckets) == 2
+    assert backend.take("a", rate=1, burst=1).allowed
+
+
+# Workers on the same host map the same file, so the limits hold across them.
+def test_shared_backend_across_workers(tmp_path):
+    path = str(tmp_path / "buckets")
+    worker_one = ratelimit.SharedMemoryBackend(path, max_keys=64)
+    worker_two = ratelimit.SharedMemoryBackend(path, max_keys=64)
+    assert worker_one.take("ip:1.2.3.4", rate=1, burst=2).allowed
+    assert worker_two.take("ip:1.2.3.4", rate=1, burst=2).allowed
+    decision = worker_one.take("ip:1.2.3.4", rate=1, burst=2)
+    assert not decision.allowed and 0 < decision.retry_after <= 1
+    assert worker_two.take("ip:5.6.7.8", rate=1, burst=2).allowed
+
+    # The table has a fixed size. Once a set is full, its least recently used bucket is taken over.
+    small = ratelimit.SharedMemoryBackend(str(tmp_path / "small"), max_keys=1)
+    for number in range(small.ways + 1):
+        assert small.take(f"ip:{number}", rate=1, burst=1).allowed
+    assert small.take("ip:0", rate=1, burst=1).allowed
@@ -0,0 +1,138 @@
+# Contract tests of the repository (app/repository.py). Every test runs on both backends, so the in-memory one keeps the semantics of Postgres.
+import pytest
+from fastapi.testclient import TestClient
+
+from app import sharding
+from app.main import app
+from app.repository import Conflict, MemoryRepository, NotFound, Repository, SqlRepository, get_repository
+
+
+@pytest.fixture(params=["memory", "postgres"])
+def repository(request):
+    if request.param == "memory":
+        return MemoryRepository()
+    return SqlRepository(request.getfixturevalue("session"))
+
+
+@pytest.fixture
+def users(repository):
+    users = [repository.create_user(f"{number}@{number}.com", "not a hash") for number in (1, 2)]
+    repository.commit()
+    return users
+
+
+def test_users(repository, users):
+    assert repository.get_user(users[0].id).email == "1@1.com"
+    assert repository.get_user_by_email("2@2.com").id == users[1].id
+    assert repository.get_user(users[1].id + 1) is None
+    assert repository.get_user_by_email("3@3.com") is None
+    assert users[0].created_at is not None
+
+    with pytest.raises(Conflict):
+        repository.create_user("1@1.com", "another hash")
+    # Nothing else is lost along with the failed insert.
+    repository.commit()
+    assert repository.get_user_by_email("1@1.com").password == "not a hash"
+
+
+def test_posts(repository, users):
+    first = repository.create_post(users[0].id, "first", "content")
+    second = repository.create_post(users[1].id, "second", "content", published=False)
+    third = repository.create_post(users[0].id, "third", "content")
+    repository.commit()
+    assert sharding.post_owner(first.id) == users[0].id
+    assert third.id == first.id + 1
+    with pytest.raises(NotFound):
+        repository.create_post(users[1].id + 1, "nobody's", "content")
+
+    row = repository.get_post(second.id)
+    assert (row.Post.title, row.Post.published, row.Post.owner.email, row.votes) == ("second", False, "2@2.com", 0)
+
+    # In the order the posts were created (posts created at the same time, in one transaction of Postgres, by id), paged and searched in the titles.
+    created = [post.id for post in sorted([first, second, third], key=lambda post: (post.created_at, post.id))]
+    assert [row.Post.id for row in repository.feed()] == created
+    assert [row.Post.id for row in repository.feed(limit=1, skip=1)] == [created[1]]
+    assert [row.Post.title for row in repository.feed(search="ir")] == ["first", "third"]
+
+    updated = repository.update_post(first.id, "first, edited", "new content")
+    assert (updated.title, updated.content, updated.version) == ("first, edited", "new content", 2)
+
+    # Deleted posts are hidden, and can't be changed again.
+    assert repository.delete_post(first.id)
+    repository.commit()
+    assert repository.get_post(first.id) is None
+    assert first.id not in [row.Post.id for row in repository.feed()]
+    assert not repository.delete_post(first.id)
+    assert repository.update_post(first.id, "title", "content") is None
+
+
+def test_votes(repository, users):
+    post = repository.create_post(users[0].id, "post", "content")
+    repository.add_vote(users[0].id, post.id)
+    repository.add_vote(users[1].id, post.id)
+    with pytest.raises(Conflict):
+        repository.add_vote(users[1].id, post.id)
+    repository.commit()
+    assert repository.count_votes(post.id) == 2
+    assert repository.get_post(post.id).votes == 2
+
+    repository.remove_vote(users[0].id, post.id)
+    with pytest.raises(NotFound):
+        repository.remove_vote(users[0].id, post.id)
+    with pytest.raises(NotFound):
+        repository.add_vote(users[0].id, post.id + 1)
+    with pytest.raises(NotFound):
+        repository.add_vote(users[1].id + 1, post.id)
+    repository.commit()
+    assert repository.count_votes(post.id) == 1
+
+    repository.delete_post(post.id)
+    with pytest.raises(NotFound):
+        repository.add_vote(users[0].id, post.id)
+
+
+# Deleting a user deletes their posts and votes, and the votes of others on their posts.
+def test_delete_user_cascades(repository, users):
+    their_post = repository.create_post(users[0].id, "theirs", "content")
+    other_post = repository.create_post(users[1].id, "other", "content")
+    repository.add_vote(users[1].id, their_post.id)
+    repository.add_vote(users[0].id, other_post.id)
+    their_id, their_post_id, other_post_id = users[0].id, their_post.id, other_post.id
+    repository.commit()
+
+    assert repository.delete_user(their_id)
+    repository.commit()
+    assert not repository.delete_user(their_id)
+    assert repository.get_user(their_id) is None
+    assert repository.get_user_by_email("1@1.com") is None
+    assert repository.get_post(their_post_id) is None
+    assert repository.count_votes(their_post_id) == 0
+    assert repository.get_post(other_post_id).votes == 0
+    # The email can be used again.
+    repository.create_user("1@1.com", "not a hash")
+
+
+# A backend missing an operation fails when it's created, rather than when the operation is first used.
+def test_backends_implement_every_operation():
+    class PartialRepository(Repository):
+        def create_user(self, email: str, password: str, shard: int = 0):
+            pass
+
+    with pytest.raises(TypeError):
+        PartialRepository()
+
+
+# The routes using the repository run without a database, on the in-memory backend.
+def test_routes_on_memory_repository():
+    repository = MemoryRepository()
+    app.dependency_overrides[get_repository] = lambda: repository
+    try:
+        client = TestClient(app)
+        res = client.post("/users/", json={"email": "1@1.com", "password": "1"})
+        assert res.status_code == 201
+        assert client.post("/users/", json={"email": "1@1.com", "password": "2"}).status_code == 409
+        assert client.get(f"/users/{res.json()['id']}").json()["email"] == "1@1.com"
+        assert client.post("/login", data={"username": "1@1.com", "password": "1"}).status_code == 200
+        assert client.post("/login", data={"username": "1@1.com", "password": "2"}).status_code == 403
+    finally:
+        del app.dependency_overrides[get_repository]
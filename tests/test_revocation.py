@@ -0,0 +1,78 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from jose import jwt
+
+from app import models, revocation
+from app.config import settings
+
+
+def login(client, email="1@1.com", password="1"):
+    res = client.post("/login", data={"username": email, "password": password})
+    assert res.status_code == 200
+    return {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+
+def claims(headers):
+    return jwt.decode(headers["Authorization"].split()[1], settings.secret_key, algorithms=[settings.algorithm])
+
+
+def test_tokens_have_an_id(client, test_user):
+    first, second = claims(login(client)), claims(login(client))
+    assert len(first["jti"]) == 32 and first["jti"] != second["jti"]
+    assert first["iat"] <= time.time() < first["exp"]
+
+
+# A token logged out with is refused from then on - the other tokens of the user still work.
+def test_logout(client, test_user, session):
+    headers, other_headers = login(client), login(client)
+    assert client.get("/posts/", headers=headers).status_code == 200
+    assert client.post("/logout", headers=headers).status_code == 204
+    assert client.get("/posts/", headers=headers).status_code == 401
+    assert client.post("/logout", headers=headers).status_code == 401
+    assert client.get("/posts/", headers=other_headers).status_code == 200
+
+    entry = session.query(models.RevokedToken).one()
+    assert entry.jti == claims(headers)["jti"]
+    assert entry.expires_at.timestamp() == claims(headers)["exp"]
+
+
+def test_logout_everywhere(client, test_user, test_user_two):
+    headers, other_headers, user_two_headers = login(client), login(client), login(client, "2@2.com", "2")
+    assert client.post("/logout/all", headers=headers).status_code == 204
+    assert client.get("/posts/", headers=headers).status_code == 401
+    assert client.get("/posts/", headers=other_headers).status_code == 401
+    # Streams aren't opened with the revoked tokens either.
+    assert client.get("/live/votes?post_ids=1", headers=other_headers).status_code == 401
+    assert client.get("/posts/", headers=user_two_headers).status_code == 200
+    # Logging in again gives a working token.
+    assert client.get("/posts/", headers=login(client)).status_code == 200
+
+
+# Other workers pick up the revocations from the DB, reading only the new ones on each refresh. Entries are dropped once their token expires.
+def test_denylist_refresh(session):
+    worker = revocation.Denylist()
+    now = datetime.now(timezone.utc)
+    revocation.revoke(session, "a" * 32, (now + timedelta(minutes=5)).timestamp())
+    session.add(models.RevokedToken(jti="b" * 32, expires_at=now - timedelta(minutes=1)))
+    session.commit()
+    worker.refresh(session)
+    assert worker.is_revoked("a" * 32) and not worker.is_revoked("b" * 32)
+
+    revocation.revoke(session, "c" * 32, (now + timedelta(seconds=1)).timestamp())
+    session.commit()
+    worker.refresh(session)
+    assert worker.is_revoked("c" * 32) and len(worker) == 2
+    worker.expire(now=(now + timedelta(seconds=2)).timestamp())
+    assert not worker.is_revoked("c" * 32) and worker.is_revoked("a" * 32)
+
+    assert revocation.purge(session) == 1
+
+
+def test_admin_logs_a_user_out(client, test_user, test_user_two, monkeypatch):
+    monkeypatch.setattr(settings, "admin_user_ids", [test_user["id"]])
+    admin_headers, user_two_headers = login(client), login(client, "2@2.com", "2")
+    assert client.post(f"/admin/users/{test_user['id']}/logout", headers=user_two_headers).status_code == 403
+    assert client.post(f"/admin/users/{test_user_two['id']}/logout", headers=admin_headers).status_code == 204
+    assert client.get("/posts/", headers=user_two_headers).status_code == 401
+    assert client.post("/admin/users/12345/logout", headers=admin_headers).status_code == 404
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+
+from app import models, outbox, rollups
+
+
+def hours_ago(hours: int):
+    return (datetime.now(timezone.utc) - timedelta(hours=hours)).replace(minute=0, second=0, microsecond=0)
+
+
+# Votes are counted in the bucket of the current hour once their events are delivered.
+def test_votes_are_counted_in_hourly_buckets(authorized_client, test_posts, session):
+    post_id = test_posts[0].id
+    authorized_client.post("/votes/", json={"post_id": post_id, "dir": 1})
+    authorized_client.post("/votes/", json={"post_id": post_id, "dir": 0})
+    authorized_client.post("/votes/", json={"post_id": post_id, "dir": 1})
+    res = authorized_client.get(f"/analytics/posts/{post_id}/votes")
+    assert res.status_code == 200
+    assert res.json() == []  # Not delivered yet.
+
+    outbox.drain(session)
+    buckets = authorized_client.get(f"/analytics/posts/{post_id}/votes").json()
+    assert [(bucket["likes"], bucket["unlikes"]) for bucket in buckets] == [(2, 1)]
+    assert datetime.fromisoformat(buckets[0]["bucket_start"]) == hours_ago(0)
+
+
+def test_votes_of_unknown_post(authorized_client):
+    assert authorized_client.get("/analytics/posts/8945879878/votes").status_code == 404
+
+
+# Events of posts deleted before they're delivered are dropped, rather than failing.
+def test_votes_on_deleted_posts_are_dropped(test_posts, session):
+    rollups.count_like(session, {"post_id": 8945879878, "at": rollups.now()})
+    assert session.query(models.PostVoteBucket).count() == 0
+
+
+def test_top_posts(authorized_client, test_posts, session):
+    post_ids = [post.id for post in test_posts]
+    session.add_all([models.PostVoteBucket(post_id=post_ids[0], resolution="hour", bucket_start=hours_ago(1), likes=3),
+                     models.PostVoteBucket(post_id=post_ids[1], resolution="hour", bucket_start=hours_ago(0), likes=4, unlikes=1),
+                     models.PostVoteBucket(post_id=post_ids[0], resolution="hour", bucket_start=hours_ago(2), likes=2),
+                     models.PostVoteBucket(post_id=post_ids[2], resolution="hour", bucket_start=hours_ago(30), likes=9)])
+    session.commit()
+
+    res = authorized_client.get("/analytics/top-posts?hours=24")
+    assert res.status_code == 200
+    assert res.json() == [{"post_id": post_ids[0], "likes": 5, "unlikes": 0},
+                          {"post_id": post_ids[1], "likes": 4, "unlikes": 1}]
+    assert authorized_client.get("/analytics/top-posts?hours=48&limit=1").json()[0]["post_id"] == post_ids[2]
+
+
+# Hourly buckets older than the retention are compacted into daily buckets - the totals stay the same.
+def test_compact_moves_old_hours_into_days(authorized_client, test_posts, session):
+    post_id = test_posts[0].id
+    old_day = hours_ago(24 * 10).replace(hour=0)
+    session.add_all([models.PostVoteBucket(post_id=post_id, resolution="hour", bucket_start=old_day + timedelta(hours=3), likes=1),
+                     models.PostVoteBucket(post_id=post_id, resolution="hour", bucket_start=old_day + timedelta(hours=5), likes=2, unlikes=1),
+                     models.PostVoteBucket(post_id=post_id, resolution="hour", bucket_start=hours_ago(1), likes=7)])
+    session.commit()
+
+    assert rollups.compact(session, batch_size=1) == 2
+    buckets = session.query(models.PostVoteBucket).order_by(models.PostVoteBucket.bucket_start).all()
+    assert [(bucket.resolution, bucket.bucket_start, bucket.likes, bucket.unlikes) for bucket in buckets] == [
+        ("day", old_day, 3, 1), ("hour", hours_ago(1), 7, 0)]
+
+    days = authorized_client.get(f"/analytics/posts/{post_id}/votes?hours={24 * 12}&resolution=day").json()
+    assert [(day["likes"], day["unlikes"]) for day in days] == [(3, 1), (7, 0)]
+
+
+# The backfill counts the votes given before the rollups existed, by the time they were given - once, however many times it's run.
+def test_backfill_counts_existing_votes(test_user, test_user_two, test_posts, session):
+    post_id = test_posts[0].id
+    session.add_all([models.RollupBackfill(votes_until=hours_ago(1)),
+                     models.Vote(post_id=post_id, user_id=test_user["id"], created_at=hours_ago(5)),
+                     models.Vote(post_id=post_id, user_id=test_user_two["id"], created_at=hours_ago(5) + timedelta(minutes=20))])
+    session.commit()
+
+    assert rollups.backfill(session, batch_size=1) == 1
+    assert rollups.backfill(session) == 0
+    buckets = session.query(models.PostVoteBucket).all()
+    assert [(bucket.post_id, bucket.bucket_start, bucket.likes) for bucket in buckets] == [(post_id, hours_ago(5), 2)]
+
+
+# A post voted on in the hour of the migration, before the backfill runs, keeps the votes from before the migration as well.
+def test_backfill_adds_to_buckets_of_the_migration_hour(authorized_client, test_user, test_user_two, test_posts, session):
+    post_id = test_posts[0].id
+    migrated_at = hours_ago(0)
+    session.add_all([models.RollupBackfill(votes_until=migrated_at),
+                     models.Vote(post_id=post_id, user_id=test_user_two["id"], created_at=migrated_at)])
+    session.commit()
+    authorized_client.post("/votes/", json={"post_id": post_id, "dir": 1})
+    outbox.drain(session)
+
+    assert rollups.backfill(session) == 1
+    buckets = session.query(models.PostVoteBucket).all()
+    assert [(bucket.post_id, bucket.bucket_start, bucket.likes) for bucket in buckets] == [(post_id, migrated_at, 2)]
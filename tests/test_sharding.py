@@ -0,0 +1,218 @@
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import create_engine, func
+
+from app import models, outbox, partitions, purger, rebalance, sharding
+from app.config import settings
+from app.oauth2 import create_access_token
+from app.vote_buffer import VoteBuffer
+from .conftest import engine, SQLALCHEMY_DATABASE_URL, create_database, create_tables, empty_tables
+
+# Two more databases on the server of the tests, created when missing. The test database is the main database (shard 0).
+SHARD_URLS = [f"{SQLALCHEMY_DATABASE_URL}_shard_{number}" for number in (1, 2)]
+
+# Each shard is read and written with connections of its own, so the tests commit (see tests/conftest.py).
+pytestmark = pytest.mark.committed
+
+
+# The tables of the shards are created once for the module, and emptied after each test.
+@pytest.fixture(scope="module")
+def shard_engines():
+    engines = {}
+    for shard, url in enumerate(SHARD_URLS, start=1):
+        create_database(url)
+        engines[shard] = create_engine(url)
+        create_tables(engines[shard])
+    yield engines
+    for shard_engine in engines.values():
+        shard_engine.dispose()
+
+
+@pytest.fixture
+def shards(session, shard_engines, monkeypatch):
+    router = sharding.ShardRouter(SHARD_URLS, main_engine=engine)
+    # The users of the fixtures are placed by their emails: "1@1.com" on shard 1, and "2@2.com" on shard 2.
+    monkeypatch.setattr(router, "place", lambda email: int(email[0]) % router.count)
+    monkeypatch.setattr(sharding, "router", router)
+    yield router
+    for shard in (1, 2):
+        router.engine(shard).dispose()
+        empty_tables(shard_engines[shard])
+
+
+def headers(user):
+    return {"Authorization": f"Bearer {create_access_token({'user_id': user['id']})}"}
+
+
+def create_post(client, user, title):
+    res = client.post("/posts/", json={"title": title, "content": "content"}, headers=headers(user))
+    assert res.status_code == 201
+    return res.json()["id"]
+
+
+def count(router, shard, model, *criteria):
+    db = router.session(shard)
+    try:
+        return db.query(func.count()).select_from(model).filter(*criteria).scalar()
+    finally:
+        db.close()
+
+
+def test_post_ids():
+    post_id = sharding.make_post_id(2 ** 31 - 1, 2 ** 21 - 1)
+    assert post_id < 2 ** 53
+    assert sharding.post_owner(post_id) == 2 ** 31 - 1
+    assert sharding.post_owner(sharding.make_post_id(7, 1)) == 7
+    # Posts numbered by the sequence.
+    assert sharding.post_owner(12345) is None
+    with pytest.raises(ValueError):
+        sharding.make_post_id(7, 2 ** 21)
+
+
+# Users are copied to every shard, and their posts are created on their own shard - where they're read from.
+def test_posts_live_on_the_shard_of_their_author(shards, client, test_user, test_user_two):
+    for shard in (1, 2):
+        assert count(shards, shard, models.User) == 2
+    post_id = create_post(client, test_user, "first")
+    assert sharding.post_owner(post_id) == test_user["id"]
+    assert count(shards, 1, models.Post) == 1
+    assert count(shards, 0, models.Post) == count(shards, 2, models.Post) == 0
+
+    res = client.get(f"/posts/{post_id}", headers=headers(test_user_two))
+    assert res.status_code == 200
+    assert res.json()["Post"]["owner"]["email"] == "1@1.com"
+    assert client.get(f"/posts/{post_id + 1}", headers=headers(test_user)).status_code == 404
+
+    res = client.put(f"/posts/{post_id}", json={"title": "edited", "content": "content"}, headers=headers(test_user))
+    assert res.status_code == 202
+    assert client.get(f"/users/{test_user['id']}/posts", headers=headers(test_user)).json()["data"][0]["Post"]["title"] == "edited"
+
+
+# The feed of several shards is the same as the feed of one database: in the order the posts were created, with the same pages.
+# The authors post in turn, on different shards - the feed isn't grouped by author, as the ids are.
+def test_feed_merges_shards(shards, client, test_user, test_user_two, test_posts):
+    # Posts from before sharding stay on the main database. Created at the same time, so in the order of their ids.
+    post_ids = sorted(post.id for post in test_posts)
+    for number in range(3):
+        post_ids.append(create_post(client, test_user, f"test {number}"))
+        post_ids.append(create_post(client, test_user_two, f"test {number}"))
+
+    feed = client.get("/posts/?limit=100", headers=headers(test_user)).json()
+    assert [post["Post"]["id"] for post in feed] == post_ids
+    for skip, limit in [(0, 3), (2, 4), (8, 5)]:
+        page = client.get(f"/posts/?limit={limit}&skip={skip}&view=summary", headers=headers(test_user)).json()
+        assert [post["id"] for post in page] == post_ids[skip:skip + limit]
+
+    # Single posts from before sharding are found as well.
+    assert client.get(f"/posts/{test_posts[0].id}", headers=headers(test_user)).status_code == 200
+
+
+# The timelines are on the main database, filled from the posts of the other shards - and merged with the posts of celebrities there when read.
+def test_timeline_across_shards(shards, client, test_user, test_user_two, monkeypatch):
+    old_post_id = create_post(client, test_user_two, "old")
+    assert client.post(f"/users/{test_user_two['id']}/follow", headers=headers(test_user)).status_code == 201
+    new_post_id = create_post(client, test_user_two, "new")
+    outbox.drain_once()
+    assert count(shards, 0, models.TimelineEntry) == 2
+
+    def timeline():
+        return [post["Post"]["id"] for post in client.get("/timeline", headers=headers(test_user)).json()["data"]]
+    assert timeline() == [new_post_id, old_post_id]
+
+    monkeypatch.setattr(settings, "timeline_celebrity_followers", 1)
+    newest_post_id = create_post(client, test_user_two, "newest")
+    outbox.drain_once()
+    assert count(shards, 0, models.TimelineEntry) == 2
+    assert timeline() == [newest_post_id, new_post_id, old_post_id]
+
+
+# A vote is written on the shard of the post, and the statistics of each shard are summed up.
+def test_votes_and_stats_across_shards(shards, client, test_user, test_user_two):
+    post_one = create_post(client, test_user, "one")
+    post_two = create_post(client, test_user_two, "two")
+    assert client.post("/votes/", json={"post_id": post_one, "dir": 1}, headers=headers(test_user_two)).status_code == 201
+    assert client.post("/votes/", json={"post_id": post_two, "dir": 1}, headers=headers(test_user_two)).status_code == 201
+    assert count(shards, 1, models.Vote) == count(shards, 2, models.Vote) == 1
+
+    stats = client.get(f"/users/{test_user_two['id']}/stats").json()
+    assert stats == {"users_id": test_user_two["id"], "posts": 1, "likes_received": 1, "likes_given": 2}
+
+    # The rollups are counted on the shard of the post, by the outbox of that shard.
+    assert outbox.drain_once() == 2  # The created post and the vote, on each shard.
+    assert count(shards, 1, models.PostVoteBucket) == count(shards, 2, models.PostVoteBucket) == 1
+    res = client.get("/analytics/top-posts", headers=headers(test_user))
+    assert [post["post_id"] for post in res.json()] == sorted([post_one, post_two])
+
+    # Deleted posts are purged on their shard.
+    assert client.delete(f"/posts/{post_one}", headers=headers(test_user)).status_code == 204
+    while purger.purge_once():
+        pass
+    assert count(shards, 1, models.Post) == 0
+    assert client.get(f"/users/{test_user_two['id']}/stats").json()["likes_given"] == 1
+
+
+# Buffered votes are written to the shards of their posts.
+def test_vote_buffer_writes_to_every_shard(shards, client, test_user, test_user_two):
+    post_one = create_post(client, test_user, "one")
+    post_two = create_post(client, test_user_two, "two")
+    votes = VoteBuffer()
+    votes.add(test_user_two["id"], post_one, 1)
+    votes.add(test_user["id"], post_two, 1)
+    assert votes.flush_once() == 2
+    assert count(shards, 1, models.Vote, models.Vote.post_id == post_one) == 1
+    assert count(shards, 2, models.Vote, models.Vote.post_id == post_two) == 1
+    assert count(shards, 0, models.Vote) == 0
+
+
+# Moving a user takes their posts, the votes on them and their statistics along. Moving them again to the same shard changes nothing.
+def test_move_user(shards, client, test_user, test_user_two):
+    post_ids = [create_post(client, test_user, f"post {number}") for number in range(3)]
+    assert client.post("/votes/", json={"post_id": post_ids[0], "dir": 1}, headers=headers(test_user_two)).status_code == 201
+    stats_before = [client.get(f"/users/{user['id']}/stats").json() for user in (test_user, test_user_two)]
+
+    assert rebalance.move_user(shards, test_user["id"], 2) == 3
+    assert rebalance.move_user(shards, test_user["id"], 2) == 0
+    assert count(shards, 1, models.Post) == count(shards, 1, models.Vote) == 0
+    assert count(shards, 2, models.Post, models.Post.users_id == test_user["id"]) == 3
+    assert count(shards, 2, models.Vote) == 1
+    assert [client.get(f"/users/{user['id']}/stats").json() for user in (test_user, test_user_two)] == stats_before
+
+    res = client.get(f"/posts/{post_ids[0]}", headers=headers(test_user_two))
+    assert res.status_code == 200
+    assert res.json()["votes"] == 1
+    # New posts continue the numbering of the user, on the new shard.
+    assert create_post(client, test_user, "after the move") == post_ids[-1] + 1
+    assert count(shards, 2, models.Post, models.Post.users_id == test_user["id"]) == 4
+
+
+# Archived posts are moved as well, into the partition of their month on the new shard.
+def test_move_user_with_archived_posts(shards, client, test_user, test_user_two):
+    post_ids = [create_post(client, test_user, f"post {number}") for number in range(2)]
+    db = shards.session(1)
+    try:
+        db.query(models.Post).filter(models.Post.id == post_ids[0]).update(
+            {"created_at": func.now() - timedelta(days=400)}, synchronize_session=False)
+        db.commit()
+        partitions.maintain(db)
+    finally:
+        db.close()
+
+    assert rebalance.move_user(shards, test_user["id"], 2) == 2
+    assert count(shards, 1, models.Post) == count(shards, 1, models.ArchivedPost) == 0
+    assert count(shards, 2, models.Post) == count(shards, 2, models.ArchivedPost) == 1
+    assert client.get(f"/posts/{post_ids[0]}?archive=true", headers=headers(test_user_two)).status_code == 200
+    assert client.get(f"/users/{test_user['id']}/stats").json()["posts"] == 2
+
+
+# Users missing on a shard (i.e. a shard added later) are copied by "sync-users".
+def test_sync_users(shards, client, test_user, test_user_two):
+    db = shards.session(2)
+    try:
+        db.query(models.User).delete()
+        db.commit()
+    finally:
+        db.close()
+
+    assert rebalance.sync_users(shards) == 2
+    assert count(shards, 2, models.User) == 2
@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import pytest
+
+from app import models
+from app.routers import post
+from app.singleflight import SingleFlight
+
+
+# Concurrent calls with the same key run the function once, and all get its result. Calls with another key run on their own.
+def test_concurrent_calls_share_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    def load(key):
+        calls.append(key)
+        time.sleep(0.05)
+        return [key]
+
+    async def main():
+        return await asyncio.gather(*[flight.do(key, load, key) for key in ["a", "a", "a", "b"]])
+
+    results = asyncio.run(main())
+    assert sorted(calls) == ["a", "b"]
+    assert results == [["a"], ["a"], ["a"], ["b"]]
+    # The result of the leader is shared, not copied.
+    assert results[0] is results[1]
+
+
+# A failing call fails all calls waiting for it, and the next call runs again.
+def test_errors_are_shared_and_not_kept():
+    flight = SingleFlight(ttl_ms=60000)
+
+    def fail():
+        time.sleep(0.05)
+        raise RuntimeError("DB is down")
+
+    async def main():
+        return await asyncio.gather(flight.do("a", fail), flight.do("a", fail), return_exceptions=True)
+
+    errors = asyncio.run(main())
+    assert [type(error) for error in errors] == [RuntimeError, RuntimeError]
+    assert asyncio.run(flight.do("a", lambda: "recovered")) == "recovered"
+
+
+# A leader whose request is cancelled (its client disconnected) doesn't take the call away from the followers waiting for it.
+def test_cancelled_leader_does_not_fail_followers():
+    flight = SingleFlight()
+    calls = []
+
+    def load():
+        calls.append("a")
+        time.sleep(0.1)
+        return "page"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do("a", load))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(flight.do("a", load))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "page"
+    assert calls == ["a"]
+
+
+# Without a TTL every call after the previous one finished runs again. With a TTL the result is kept until it expires.
+def test_results_are_kept_for_the_ttl():
+    flight = SingleFlight()
+    assert asyncio.run(flight.do("a", lambda: 1)) == 1
+    assert asyncio.run(flight.do("a", lambda: 2)) == 2
+
+    flight = SingleFlight(ttl_ms=50)
+    assert asyncio.run(flight.do("a", lambda: 1)) == 1
+    assert asyncio.run(flight.do("a", lambda: 2)) == 1
+    time.sleep(0.06)
+    assert asyncio.run(flight.do("a", lambda: 3)) == 3
+
+
+def test_expired_results_are_dropped():
+    flight = SingleFlight(ttl_ms=1, max_entries=2)
+    asyncio.run(flight.do("a", lambda: 1))
+    asyncio.run(flight.do("b", lambda: 2))
+    time.sleep(0.01)
+    asyncio.run(flight.do("c", lambda: 3))
+    assert list(flight._results) == ["c"]
+
+
+# Requests for the feed give back the connection they were authenticated with before waiting for the page.
+def test_feed_waits_without_a_connection(authorized_client, test_posts, monkeypatch):
+    in_transaction = []
+
+    class RecordingFlight(SingleFlight):
+        async def do(self, key, function, shards, *args):
+            in_transaction.append(shards.db.in_transaction())
+            return await super().do(key, function, shards, *args)
+
+    monkeypatch.setattr(post, "feed_flight", RecordingFlight())
+    etag = authorized_client.get("/posts/").headers["ETag"]
+    assert authorized_client.get("/posts/", headers={"If-None-Match": etag}).status_code == 304
+    assert in_transaction == [False, False]
+
+
+# With the micro-cache enabled, identical requests for the feed are served the same page, in either format.
+@pytest.mark.parametrize("accept", ["application/json", "application/msgpack"])
+def test_feed_is_served_from_the_micro_cache(authorized_client, test_posts, session, monkeypatch, accept):
+    monkeypatch.setattr(post, "feed_flight", SingleFlight(ttl_ms=60000))
+    first = authorized_client.get("/posts/?limit=10")
+    assert first.status_code == 200
+
+    session.add(models.Post(title="new title", content="new content",
+                users_id=test_posts[0].users_id))
+    session.commit()
+
+    cached = authorized_client.get("/posts/?limit=10", headers={"Accept": accept})
+    assert cached.status_code == 200
+    assert cached.headers["content-type"].startswith(accept)
+    assert len(authorized_client.get("/posts/?limit=10").json()) == len(test_posts)
+    # Another page is another key, and sees the new post.
+    assert len(authorized_client.get("/posts/?limit=11").json()) == len(test_posts) + 1
@@ -0,0 +1,81 @@
+from app import models, stats, purger
+from app.vote_buffer import VoteBuffer
+
+
+def get_stats(client, users_id):
+    res = client.get(f"/users/{users_id}/stats")
+    assert res.status_code == 200
+    return {key: value for key, value in res.json().items() if key != "users_id"}
+
+
+# The statistics follow creating posts, voting on them, and removing the votes - each counted in the same transaction.
+def test_stats_follow_posts_and_votes(authorized_client, test_user, test_user_two, session):
+    assert get_stats(authorized_client, test_user["id"]) == {
+        "posts": 0, "likes_received": 0, "likes_given": 0}
+
+    post_id = authorized_client.post(
+        "/posts/", json={"title": "title", "content": "content"}).json()["id"]
+    assert authorized_client.post(
+        "/votes/", json={"post_id": post_id, "dir": 1}).status_code == 201
+    assert get_stats(authorized_client, test_user["id"]) == {
+        "posts": 1, "likes_received": 1, "likes_given": 1}
+
+    assert authorized_client.post(
+        "/votes/", json={"post_id": post_id, "dir": 0}).status_code == 201
+    assert get_stats(authorized_client, test_user["id"]) == {
+        "posts": 1, "likes_received": 0, "likes_given": 0}
+
+
+# Deleting a post takes it off the statistics of its author right away. Its likes, and the likes given by its voters, once its votes are purged.
+def test_stats_after_deleting_post(authorized_client, test_user, test_user_two, session):
+    post_id = authorized_client.post(
+        "/posts/", json={"title": "title", "content": "content"}).json()["id"]
+    session.add(models.Vote(post_id=post_id, user_id=test_user_two["id"]))
+    stats.Deltas().add(test_user_two["id"], likes_given=1).add(test_user["id"], likes_received=1).apply(session)
+    session.commit()
+    assert get_stats(authorized_client, test_user_two["id"])["likes_given"] == 1
+
+    assert authorized_client.delete(f"/posts/{post_id}").status_code == 204
+    assert get_stats(authorized_client, test_user["id"]) == {
+        "posts": 0, "likes_received": 1, "likes_given": 0}
+
+    while purger.purge(session):
+        pass
+    assert get_stats(authorized_client, test_user["id"]) == {
+        "posts": 0, "likes_received": 0, "likes_given": 0}
+    assert get_stats(authorized_client, test_user_two["id"]) == {
+        "posts": 0, "likes_received": 0, "likes_given": 0}
+
+
+def test_stats_of_unknown_user(client):
+    assert client.get("/users/8945879878/stats").status_code == 404
+
+
+# Votes written by the vote buffer are counted as well.
+def test_stats_after_flushing_vote_buffer(client, test_user, test_user_two, test_posts, session):
+    post_ids = [post.id for post in test_posts]
+    votes = VoteBuffer()
+    votes.add(test_user_two["id"], post_ids[0], 1)
+    votes.add(test_user_two["id"], post_ids[1], 1)
+    votes.add(test_user["id"], post_ids[3], 1)
+    votes.flush(session)
+
+    assert get_stats(client, test_user["id"]) == {
+        "posts": 0, "likes_received": 2, "likes_given": 1}
+    assert get_stats(client, test_user_two["id"]) == {
+        "posts": 0, "likes_received": 1, "likes_given": 2}
+
+
+# The posts of the fixture are added directly to the DB, so their statistics are off - until they're reconciled.
+def test_reconcile_fixes_drifted_stats(client, test_user, test_user_two, test_posts, session):
+    session.add(models.Vote(post_id=test_posts[3].id, user_id=test_user["id"]))
+    stats.update(session, test_user_two["id"], posts=1, likes_received=5)
+    session.commit()
+
+    assert sorted(stats.reconcile(session, batch_size=1)) == sorted([test_user["id"], test_user_two["id"]])
+    assert get_stats(client, test_user["id"]) == {
+        "posts": 3, "likes_received": 0, "likes_given": 1}
+    assert get_stats(client, test_user_two["id"]) == {
+        "posts": 1, "likes_received": 1, "likes_given": 0}
+    # Nothing is off anymore.
+    assert stats.reconcile(session) == []
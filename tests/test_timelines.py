@@ -0,0 +1,84 @@
+import pytest
+
+from app import models, outbox, timelines
+from app.config import settings
+from app.oauth2 import create_access_token
+
+
+@pytest.fixture
+def user_two_headers(test_user_two):
+    return {"Authorization": f"Bearer {create_access_token({'user_id': test_user_two['id']})}"}
+
+
+def timeline_ids(client, **params):
+    res = client.get("/timeline", params=params)
+    assert res.status_code == 200
+    return [post["Post"]["id"] for post in res.json()["data"]], res.json()["next_cursor"]
+
+
+def test_follow(authorized_client, test_user, test_user_two, session):
+    assert authorized_client.post(f"/users/{test_user_two['id']}/follow").status_code == 201
+    assert authorized_client.post(f"/users/{test_user_two['id']}/follow").status_code == 409
+    assert authorized_client.post(f"/users/{test_user['id']}/follow").status_code == 400
+    assert authorized_client.post("/users/12345/follow").status_code == 404
+    assert session.query(models.User.followers).filter(models.User.id == test_user_two["id"]).scalar() == 1
+
+    assert authorized_client.delete(f"/users/{test_user_two['id']}/follow").status_code == 204
+    assert authorized_client.delete(f"/users/{test_user_two['id']}/follow").status_code == 404
+    session.expire_all()
+    assert session.query(models.User.followers).filter(models.User.id == test_user_two["id"]).scalar() == 0
+
+
+# New posts are written to the timelines of the followers of their author by the outbox worker. Following copies the latest posts in.
+def test_fan_out_on_write(authorized_client, test_user_two, test_posts, user_two_headers, session):
+    old_post_id = test_posts[3].id
+    authorized_client.post(f"/users/{test_user_two['id']}/follow")
+    assert timeline_ids(authorized_client) == ([], None)
+    outbox.drain(session)
+    assert timeline_ids(authorized_client) == ([old_post_id], None)
+
+    new_post_id = authorized_client.post("/posts/", json={"title": "new", "content": "new"}, headers=user_two_headers).json()["id"]
+    outbox.drain(session)
+    assert timeline_ids(authorized_client) == ([new_post_id, old_post_id], None)
+    # Only the posts of the users followed.
+    assert session.query(models.TimelineEntry).count() == 2
+
+    assert authorized_client.delete(f"/posts/{new_post_id}", headers=user_two_headers).status_code == 204
+    assert timeline_ids(authorized_client) == ([old_post_id], None)
+    outbox.drain(session)
+    assert session.query(models.TimelineEntry).count() == 1
+
+    authorized_client.delete(f"/users/{test_user_two['id']}/follow")
+    assert timeline_ids(authorized_client) == ([], None)
+
+
+# The posts of celebrities aren't fanned out, and are merged into the timeline when it's read.
+def test_celebrities_are_merged_on_read(authorized_client, test_user_two, test_posts, user_two_headers, session, monkeypatch):
+    old_post_id = test_posts[3].id
+    authorized_client.post(f"/users/{test_user_two['id']}/follow")
+    outbox.drain(session)
+    monkeypatch.setattr(settings, "timeline_celebrity_followers", 1)
+
+    new_post_id = authorized_client.post("/posts/", json={"title": "new", "content": "new"}, headers=user_two_headers).json()["id"]
+    outbox.drain(session)
+    assert session.query(models.TimelineEntry.post_id).all() == [(old_post_id,)]
+    # The post fanned out before is in the timeline, and among the posts of the celebrity - it's only listed once.
+    assert timeline_ids(authorized_client) == ([new_post_id, old_post_id], None)
+
+
+def test_timeline_pages_and_trim(authorized_client, test_user_two, user_two_headers, session, monkeypatch):
+    authorized_client.post(f"/users/{test_user_two['id']}/follow")
+    post_ids = [authorized_client.post("/posts/", json={"title": str(number), "content": "content"}, headers=user_two_headers).json()["id"]
+                for number in range(5)]
+    outbox.drain(session)
+
+    first_page, cursor = timeline_ids(authorized_client, limit=2)
+    second_page, cursor = timeline_ids(authorized_client, limit=2, cursor=cursor)
+    last_page, cursor = timeline_ids(authorized_client, limit=2, cursor=cursor)
+    assert first_page + second_page + last_page == post_ids[::-1]
+    assert cursor is None
+    assert authorized_client.get("/timeline?cursor=nonsense").status_code == 400
+
+    monkeypatch.setattr(settings, "timeline_max_entries", 3)
+    assert timelines.trim(session, batch_size=1) == 2
+    assert timeline_ids(authorized_client) == (post_ids[:1:-1], None)
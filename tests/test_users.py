@@ -48,3 +48,42 @@ def test_incorrect_login(client, email, password, status_code):  # Pass in the p
     res = client.post(
         "/login", data={"username": email, "password": password})  # Testing for wrong credentials.
     assert res.status_code == status_code
+
+
+# Paging through all posts of test user 1 with a page size of 2. The test posts are created in one transaction and share created_at, so the id breaks the ties.
+def test_get_user_posts_paginated(authorized_client, test_user, test_posts):
+    own_posts = [post for post in test_posts if post.users_id == test_user["id"]]
+
+    res = authorized_client.get(f"/users/{test_user['id']}/posts?limit=2")
+    first_page = schemas.PostVotesPage(**res.json())
+    assert res.status_code == 200  # OK.
+    assert len(first_page.data) == 2
+    assert first_page.next_cursor is not None
+
+    res = authorized_client.get(
+        f"/users/{test_user['id']}/posts?limit=2&cursor={first_page.next_cursor}")
+    second_page = schemas.PostVotesPage(**res.json())
+    assert res.status_code == 200  # OK.
+    assert second_page.next_cursor is None  # Last page.
+
+    ids = [post.Post.id for post in first_page.data + second_page.data]
+    # Newest first, no post repeated or skipped between pages, and only the posts of the requested user.
+    assert ids == sorted([post.id for post in own_posts], reverse=True)
+    assert all(post.Post.users_id == test_user["id"]
+               for post in first_page.data + second_page.data)
+
+
+def test_get_user_posts_with_invalid_cursor(authorized_client, test_user, test_posts):
+    res = authorized_client.get(
+        f"/users/{test_user['id']}/posts?cursor=not-a-cursor")
+    assert res.status_code == 400  # Bad Request.
+
+
+def test_get_user_posts_of_non_existing_user(authorized_client, test_posts):
+    res = authorized_client.get("/users/89478956/posts")
+    assert res.status_code == 404  # Not Found.
+
+
+def test_unauthorized_user_get_user_posts(client, test_user, test_posts):
+    res = client.get(f"/users/{test_user['id']}/posts")
+    assert res.status_code == 401  # Unauthorized.
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app import models, rollups
+from app.config import settings
+from app.vote_buffer import VoteBuffer, BufferFull, buffer
+
+
+def directions(votes):
+    return {key: dir for key, (dir, _) in votes.items()}
+
+
+# Votes of the same user on the same post are deduplicated, and the latest one wins.
+def test_buffer_keeps_latest_vote_per_user_and_post():
+    votes = VoteBuffer()
+    votes.add(1, 10, 1)
+    votes.add(1, 10, 0)
+    votes.add(1, 10, 1)
+    votes.add(2, 10, 1)
+    assert directions(votes.take()) == {(1, 10): 1, (2, 10): 1}
+    assert len(votes) == 0
+
+
+# Any direction but a like removes the vote, as it does without the buffer.
+def test_buffer_normalizes_directions():
+    votes = VoteBuffer()
+    votes.add(1, 10, -1)
+    votes.add(2, 10, 1)
+    assert directions(votes.take()) == {(1, 10): 0, (2, 10): 1}
+
+
+def test_buffer_rejects_votes_when_full(monkeypatch):
+    monkeypatch.setattr(settings, "vote_buffer_max_votes", 1)
+    votes = VoteBuffer()
+    for post_id in range(10):
+        votes.add(1, post_id, 1)
+    with pytest.raises(BufferFull):
+        votes.add(1, 10, 1)
+    votes.add(1, 0, 0)  # Replacing a waiting vote doesn't take more memory.
+
+
+# Votes failing to be written are put back, without overwriting newer votes.
+def test_restore_keeps_newer_votes():
+    votes = VoteBuffer()
+    votes.add(1, 10, 0)
+    votes.restore({(1, 10): (1, rollups.now()), (2, 10): (1, rollups.now())})
+    assert directions(votes.take()) == {(1, 10): 0, (2, 10): 1}
+
+
+# One flush creates and removes votes, skips votes on posts that don't exist, and writes outbox events for the real changes only.
+def test_flush_writes_votes(test_user, test_user_two, test_posts, session):
+    post_ids = [post.id for post in test_posts]
+    session.add(models.Vote(post_id=post_ids[1], user_id=test_user["id"]))
+    session.commit()
+
+    votes = VoteBuffer()
+    votes.add(test_user["id"], post_ids[0], 1)
+    votes.add(test_user_two["id"], post_ids[0], 1)
+    votes.add(test_user["id"], post_ids[1], 0)
+    votes.add(test_user["id"], post_ids[2], 0)  # Never voted on.
+    votes.add(test_user["id"], 8945879878, 1)  # No such post.
+    assert votes.flush(session) == 5
+
+    assert sorted((vote.user_id, vote.post_id) for vote in session.query(models.Vote)) == sorted(
+        [(test_user["id"], post_ids[0]), (test_user_two["id"], post_ids[0])])
+    topics = sorted(event.topic for event in session.query(models.OutboxEvent))
+    assert topics == ["vote.created", "vote.created", "vote.deleted"]
+
+
+# Votes are written, and counted in the rollups, with the time they were given rather than the time of the flush.
+def test_flush_keeps_vote_times(test_user, test_posts, session, monkeypatch):
+    given = datetime.now(timezone.utc) - timedelta(hours=3)
+    monkeypatch.setattr(rollups, "now", lambda: given.isoformat())
+    votes = VoteBuffer()
+    votes.add(test_user["id"], test_posts[0].id, 1)
+    votes.flush(session)
+
+    assert session.query(models.Vote).one().created_at == given
+    assert session.query(models.OutboxEvent).one().payload["at"] == given.isoformat()
+
+
+# In buffered mode votes are accepted with "202", and not written until the buffer is flushed.
+def test_vote_buffered(authorized_client, test_user, test_posts, session, monkeypatch):
+    monkeypatch.setattr(settings, "vote_buffer_enabled", True)
+    post_id = test_posts[0].id
+    res = authorized_client.post(
+        "/votes/", json={"post_id": post_id, "dir": 1})
+    assert res.status_code == 202  # Accepted.
+    assert directions(buffer.take()) == {(test_user["id"], post_id): 1}
+    assert session.query(models.Vote).count() == 0
@@ -1,5 +1,7 @@
 import pytest
-from app import models
+from sqlalchemy import text
+
+from app import models, queries
 
 
 # Fixture for creating a vote on a post from a particular user.
@@ -40,6 +42,20 @@ def test_remove_vote_not_already_existing(authorized_client, test_posts):
     assert res.status_code == 404  # Not Found.
 
 
+# Two unlikes at once both find the vote, but only the one deleting it counts it - the other is answered as if there was no vote.
+def test_remove_vote_deleted_concurrently(authorized_client, test_posts, test_vote, session, monkeypatch):
+    post_id = test_posts[0].id
+    session.query(models.Vote).delete()
+    session.commit()
+    # The vote is still found, as by a request which read it before it was deleted.
+    monkeypatch.setattr(queries, "vote_by_user_and_post", text("SELECT 1"))
+    res = authorized_client.post(
+        f"/votes/", json={"post_id": post_id, "dir": 0})
+    assert res.status_code == 404  # Not Found.
+    assert session.query(models.OutboxEvent).filter(models.OutboxEvent.topic == "vote.deleted").count() == 0
+    assert session.query(models.UserStats).count() == 0
+
+
 # Voting on a post that doesn't exist.
 def test_vote_on_non_existing_post(authorized_client, test_posts):
     res = authorized_client.post(